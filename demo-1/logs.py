@@ -0,0 +1,162 @@
+import atexit
+import contextvars
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import time
+from typing import Any, Optional
+
+import msgspec
+
+# Logging for the request path: records are handed to a background thread
+# through a queue, and payloads are only serialised (redacted and size-capped)
+# if a record is actually written.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "text" for the usual "LEVEL:logger:message" lines, "json" for one JSON object per line.
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Request and response payloads are logged for 1 in N successful requests; errors always are.
+LOG_SAMPLE_RATE = max(1, int(os.environ.get("LOG_SAMPLE_RATE", "10")))
+LOG_PAYLOAD_MAX_BYTES = int(os.environ.get("LOG_PAYLOAD_MAX_BYTES", "2048"))
+# Records waiting for the writer thread; beyond this they are dropped rather than blocking requests.
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+
+# Values under keys that look like credentials are never written out
+_SECRET_KEY = re.compile(r"pass|secret|token$|auth|credential|api_?key|private", re.IGNORECASE)
+REDACTED = "[REDACTED]"
+
+# Pass as extra= on records that carry a payload, so they are sampled per request
+PAYLOAD = {"payload": True}
+
+_sample_counter = itertools.count()
+# Whether the current request logs its payloads; code outside a request always does
+_request_sampled: contextvars.ContextVar[bool] = contextvars.ContextVar("request_sampled", default=True)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def start_request() -> bool:
+    """
+    Decide whether the current request is one of the 1 in LOG_SAMPLE_RATE
+    whose payload records are written. Call at the start of a handler.
+    """
+    sampled = next(_sample_counter) % LOG_SAMPLE_RATE == 0
+    _request_sampled.set(sampled)
+    return sampled
+
+
+def redact(value: Any) -> Any:
+    """Return a copy of a payload with credential-like values replaced."""
+    if isinstance(value, msgspec.Struct):
+        # Request structs keep parts of the body encoded (msgspec.Raw); decode them all
+        value = msgspec.json.decode(msgspec.json.encode(value))
+    elif isinstance(value, msgspec.Raw):
+        value = msgspec.json.decode(value)
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if isinstance(key, str) and _SECRET_KEY.search(key) else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class PayloadPreview:
+    """
+    A request or response payload as a log argument.
+
+    Nothing is decoded or encoded until the record is formatted, so a record
+    dropped by level or sampling costs nothing, and one that is written is
+    formatted on the logging thread. The preview is compact JSON with
+    credential-like values redacted, cut to LOG_PAYLOAD_MAX_BYTES.
+
+    The payload must not be modified after it is logged.
+    """
+
+    __slots__ = ("payload", "max_bytes")
+
+    def __init__(self, payload: Any, max_bytes: int = LOG_PAYLOAD_MAX_BYTES):
+        self.payload = payload
+        self.max_bytes = max_bytes
+
+    def __str__(self) -> str:
+        payload = self.payload
+        try:
+            if isinstance(payload, (bytes, bytearray, memoryview)):
+                payload = msgspec.json.decode(payload)
+            encoded = msgspec.json.encode(redact(payload))
+        except (msgspec.DecodeError, TypeError):
+            # Not JSON: show the raw text, which cannot be redacted by key
+            encoded = bytes(payload) if isinstance(payload, (bytes, bytearray, memoryview)) else str(payload).encode()
+        if len(encoded) <= self.max_bytes:
+            return encoded.decode(errors="replace")
+        return f"{encoded[:self.max_bytes].decode(errors='ignore')}... ({len(encoded)} bytes)"
+
+
+def preview(payload: Any) -> PayloadPreview:
+    return PayloadPreview(payload)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock handler formats every record before queueing it, on the
+    # caller's thread; the queue is in-process, so formatting is left to the
+    # listener thread instead.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+class _PayloadSampler(logging.Filter):
+    # Runs on the caller's thread, so unsampled payloads are never even queued
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not getattr(record, "payload", False):
+            return True
+        return _request_sampled.get()
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return msgspec.json.encode(entry).decode()
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT) -> None:
+    """
+    Route the root logger through a bounded queue to a writer thread.
+
+    Safe to call more than once; later calls only change the level.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler()
+    stream.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(logging.BASIC_FORMAT))
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = _DeferredQueueHandler(records)
+    handler.addFilter(_PayloadSampler())
+    root.addHandler(handler)
+    _listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    _listener.start()
+    # Flush what is still queued when the process exits
+    atexit.register(_listener.stop)
@@ -1,34 +1,38 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
 from typing import Dict, Any
-import uvicorn
-import json
-import traceback
-from utils import Endpoint
+import logging
+from utils import Endpoint, JSONBytesResponse, PROTOCOL_HEADER
+from logs import configure_logging, start_request, preview, PAYLOAD
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="AWS Workshop API", version="0.1.0")
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    print("[HEALTH] Health check requested")
+    logger.info("[HEALTH] Health check requested")
     return {"status": "healthy", "service": "aws-workshop-api"}
 
 @app.post("/chat")
-async def chat(payload: Dict[str, Any] = Body(...)):
+async def chat(http_request: Request):
     """
     Simple echo endpoint that returns what the user sends.
     Accepts a message payload and echoes it back in the original complex format.
     """
+    start_request()
+    body = await http_request.body()
+    payload = Endpoint.decode(body, http_request.headers.get(PROTOCOL_HEADER))
     try:
-        
-        print(f"[CHAT REQUEST] Received payload: {json.dumps(payload, indent=2)}")
+        logger.info("[CHAT REQUEST] Received payload: %s", preview(body), extra=PAYLOAD)
 
         # Parse content from the payload using the utility method
         message = Endpoint.parse(payload)
         content = message.get("content", "")
 
-        print(f"Extracted content: {content}")
+        logger.debug("Extracted content: %s", preview(content), extra=PAYLOAD)
         
         # Create echo response
         echo_response = f"You said: {content}"
@@ -40,16 +44,14 @@ async def chat(payload: Dict[str, Any] = Body(...)):
         )
         
         # Log successful response to console for Docker
-        print(f"[CHAT SUCCESS] Echoing back: {echo_response}")
+        logger.info("[CHAT SUCCESS] Echoing back: %s", preview(echo_response), extra=PAYLOAD)
         
-        return response_payload
+        return JSONBytesResponse(response_payload)
         
     except Exception as e:
         # Log error details to console for Docker debugging
-        error_details = traceback.format_exc()
-        print(f"[CHAT ERROR] Exception occurred: {str(e)}")
-        print(f"[CHAT ERROR] Full traceback:\n{error_details}")
-        print(f"[CHAT ERROR] Original payload: {json.dumps(payload, indent=2) if payload else 'None'}")
+        logger.error("[CHAT ERROR] Exception occurred: %s", e, exc_info=True)
+        logger.error("[CHAT ERROR] Original payload: %s", preview(body))
         
         # Create error response using utility function
         error_message = f"Error processing your request: {str(e)}"
@@ -61,17 +63,12 @@ async def chat(payload: Dict[str, Any] = Body(...)):
         )
         
         # Log the error response to console for Docker
-        print(f"[CHAT ERROR RESPONSE] Sending error response: {json.dumps(error_response, indent=2)}")
+        logger.error("[CHAT ERROR RESPONSE] Sending error response: %s", preview(error_response))
         
         # Return error response with 500 status
         raise HTTPException(status_code=500, detail=error_response)
 
 if __name__ == "__main__":
-
-        uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8001,
-        reload=True,     # set True for auto-reload in dev
-        log_level="info",
-    )
\ No newline at end of file
+    # Development server with auto-reload; production runs serve.py
+    import serve
+    serve.main(["--dev"])
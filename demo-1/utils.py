@@ -1,50 +1,176 @@
-import json
+import logging
 import os
 import shutil
 import tempfile
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Union
 import datetime
+import msgspec
+from fastapi import HTTPException, Response
 import subprocess
 from strands.models.bedrock import BedrockModel
 
+from logs import preview, PAYLOAD
+
+logger = logging.getLogger(__name__)
+
+
+class CommandV1(msgspec.Struct):
+    """A command as sent by v1 clients. Its Output is never read, so it is skipped while decoding."""
+    Command: str = ""
+    execute: bool = False
+    files: Optional[List[Dict[str, Any]]] = []
+
+
+class RequestDataV1(msgspec.Struct):
+    """The data section of a v1 chat request."""
+    Cmds: Optional[List[CommandV1]] = None
+    executedCmds: Optional[List[CommandV1]] = None
+    url_configs: Optional[List[Dict[str, Any]]] = None
+
+
+class ChatRequestV1(msgspec.Struct):
+    """
+    A v1 chat request ({content, pastMessages, data: {Cmds, executedCmds}}).
+
+    pastMessages and platform_context are kept as raw JSON: they are echoed
+    back into the response as they are and only decoded when the history is
+    actually needed.
+    """
+    content: str = ""
+    pastMessages: msgspec.Raw = msgspec.Raw(b"[]")
+    thread_id: Optional[str] = ""
+    tenant_id: Optional[str] = ""
+    id: Optional[str] = ""
+    platform_context: msgspec.Raw = msgspec.Raw(b"{}")
+    agent_managed_memory: Optional[bool] = True
+    data: Optional[RequestDataV1] = None
+
+
+class MessageV2(msgspec.Struct):
+    """A single message of a v2 chat request. The content stays raw until it is read."""
+    content: msgspec.Raw = msgspec.Raw(b'""')
+    role: str = "user"
+
+
+class RequestDataV2(msgspec.Struct):
+    """The data section of a v2 chat request, already in the internal command format."""
+    cmds: List[Dict[str, Any]] = []
+    executed_cmds: List[Dict[str, Any]] = []
+    url_configs: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class ChatRequestV2(msgspec.Struct):
+    """A v2 chat request ({messages, data: {cmds, executed_cmds}})."""
+    messages: List[MessageV2] = []
+    data: RequestDataV2 = msgspec.field(default_factory=RequestDataV2)
+
+
+# Compiled once; decoding validates the body straight from the request bytes
+_request_v1_decoder = msgspec.json.Decoder(ChatRequestV1, strict=False)
+_request_v2_decoder = msgspec.json.Decoder(ChatRequestV2, strict=False)
+
+
+def decode_request_v1(body: bytes) -> ChatRequestV1:
+    """
+    Decode and validate a raw v1 request body.
+
+    Raises:
+        msgspec.ValidationError: If the body does not match the v1 schema
+        msgspec.DecodeError: If the body is not valid JSON
+    """
+    return _request_v1_decoder.decode(body)
+
+
+def decode_request_v2(body: bytes) -> ChatRequestV2:
+    """
+    Decode and validate a raw v2 request body.
+
+    Raises:
+        msgspec.ValidationError: If the body does not match the v2 schema
+        msgspec.DecodeError: If the body is not valid JSON
+    """
+    return _request_v2_decoder.decode(body)
+
+
+# Clients may pin the wire format with this header ("v1" or "v2"); otherwise
+# it is inferred from the shape of the payload.
+PROTOCOL_HEADER = "X-Chat-Protocol"
+
+
+class _ProtocolProbe(msgspec.Struct):
+    """The top-level keys that tell the formats apart; their values are skipped, not decoded."""
+    messages: msgspec.Raw = msgspec.Raw(b"")
+    pastMessages: msgspec.Raw = msgspec.Raw(b"")
+
+
+_protocol_probe_decoder = msgspec.json.Decoder(_ProtocolProbe)
+
+
+def detect_protocol(body: bytes, header: Optional[str] = None) -> str:
+    """
+    Work out which wire format a request uses.
+
+    Args:
+        body: The raw request body
+        header: The value of the X-Chat-Protocol header, if any
+
+    Returns:
+        "v2" for a body with messages and no pastMessages (or when the header
+        asks for it), otherwise "v1"
+
+    Raises:
+        ValueError: If the header names an unknown protocol or the body is not a JSON object
+    """
+    if header:
+        protocol = header.strip().lower()
+        if protocol in ("1", "v1"):
+            return "v1"
+        if protocol in ("2", "v2"):
+            return "v2"
+        raise ValueError(f"Unsupported {PROTOCOL_HEADER}: {header}")
+
+    probe = _protocol_probe_decoder.decode(body)
+    if len(probe.messages) and not len(probe.pastMessages):
+        return "v2"
+    return "v1"
+
 
 def parse_request_v1(
-        payload: Dict[str, Any],
+        payload: ChatRequestV1,
         ) -> Dict[str, Any]:
     """
     Parse the incoming chat payload and convert it to the format expected by HumanInLoop.
     
     Args:
-        payload: The incoming JSON payload from the REST API
+        payload: The decoded v1 request
         
     Returns:
-        List of message dictionaries in the format expected by HumanInLoop
-        
-    Raises:
-        ValueError: If required fields are missing or invalid
+        Dictionary with the content, the (still encoded) past messages and the
+        commands converted to the v2 format
     """
     
     response = {}
     # Extract the current message content
-    current_content = payload.get("content", "")
-
-    if current_content:
-        response["content"] = current_content
-    # Extract the past messages
-    past_messages = payload.get("pastMessages", [])
-    response["messages"] = past_messages
-    response["thread_id"] = payload.get("thread_id", "")
-    response["tenant_id"] = payload.get("tenant_id", "")
-    response["id"] = payload.get("id", "")
-    response["platform_context"] = payload.get("platform_context", {})
-    data = payload.get("data", {})
-
-    if data:
-        response["past_messages_count"] = len(past_messages)
-        response["cmds"] = [transform_v1_command_to_v2_format(cmd) for cmd in (data.get("Cmds", []) or [])]
-        response["executed_cmds"] = [transform_v1_command_to_v2_format(cmd) for cmd in (data.get("executedCmds", []) or [])]
-
-        response["url_configs"] = data.get("url_configs", [])
+    if payload.content:
+        response["content"] = payload.content
+    # The past messages stay raw until someone needs the history
+    response["messages"] = payload.pastMessages
+    response["thread_id"] = payload.thread_id
+    response["tenant_id"] = payload.tenant_id
+    response["id"] = payload.id
+    response["platform_context"] = payload.platform_context
+    data = payload.data
+
+    if data is not None:
+        response["cmds"] = [
+            {"command": cmd.Command, "execute": cmd.execute, "files": cmd.files}
+            for cmd in (data.Cmds or [])
+        ]
+        response["executed_cmds"] = [
+            {"command": cmd.Command, "execute": cmd.execute, "files": cmd.files}
+            for cmd in (data.executedCmds or [])
+        ]
+        response["url_configs"] = data.url_configs if data.url_configs is not None else []
     
     return response
 
@@ -101,70 +227,111 @@ def transform_v1_command_to_v2_format(command_dict: Dict[str, Any]) -> Dict[str,
         "files": command_dict.get("files", [])
     }
 
+class CommandRecord(msgspec.Struct):
+    """Fixed-layout v1 command entry, encoded as {Command, Output, files, execute}."""
+    Command: Any
+    Output: Any
+    files: Any
+    execute: Any
+
+
+_json_encoder = msgspec.json.Encoder()
+
+
+def encode_json(obj: Any) -> bytes:
+    """
+    Serialize a response (dicts, lists and command records) straight to JSON bytes.
+    """
+    return _json_encoder.encode(obj)
+
+
+class JSONBytesResponse(Response):
+    """
+    JSON response that is encoded once by msgspec.
+
+    Returning it from an endpoint skips FastAPI's jsonable_encoder walk over the
+    response dict; pre-encoded bytes are sent as they are.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return encode_json(content)
+
+
+def _command_records(cmds: Optional[List[Dict[str, Any]]]) -> List[CommandRecord]:
+    # Single pass from v2 command dicts to v1 records, no intermediate dicts
+    return [
+        CommandRecord(cmd.get("command", ""), cmd.get("output", ""), cmd.get("files", []), cmd.get("execute", False))
+        for cmd in (cmds or [])
+    ]
+
+
 def create_response_v1(
         response_text: str,
-        payload: Optional[Dict[str, Any]] = None,
+        payload: Optional[ChatRequestV1] = None,
         cmds: Optional[List[Dict[str, Any]]] = None,
         executed_cmds: Optional[List[Dict[str, Any]]] = None,
         url_configs: Optional[List[Dict[str, Any]]] = None
         ) -> Dict[str, Any]:
     """
     Generate a chat response based on the payload.
+
+    Commands are converted to fixed-layout records in a single pass; the
+    result can be encoded directly with encode_json / JSONBytesResponse, which
+    writes the raw pastMessages and platform_context back without decoding them.
     """
-    # Transform commands if they exist
-    transformed_cmds = [transform_v2_command_to_v1_format(cmd) for cmd in (cmds or [])]
-    transformed_executed_cmds = [transform_v2_command_to_v1_format(cmd) for cmd in (executed_cmds or [])]
+    payload = payload or ChatRequestV1()
 
     return {
-        "pastMessages": payload.get("pastMessages", []) if payload else [],
+        "pastMessages": payload.pastMessages,
         "Content": response_text,
         "terminalCommands": [],
-        "thread_id": payload.get("thread_id", ""),
-        "tenant_id": payload.get("tenant_id", ""),
-        "agent_managed_memory": payload.get("agent_managed_memory", True) if payload else True,
-        "platform_context": payload.get("platform_context", {}) if payload else {},
+        "thread_id": payload.thread_id,
+        "tenant_id": payload.tenant_id,
+        "agent_managed_memory": payload.agent_managed_memory,
+        "platform_context": payload.platform_context,
         "data": {
             "response_type": "success",
             "processed_at": datetime.datetime.utcnow().isoformat() + "Z",
-            "Cmds": transformed_cmds,
-            "executedCmds": transformed_executed_cmds or [],
+            "Cmds": _command_records(cmds),
+            "executedCmds": _command_records(executed_cmds),
             "url_configs": url_configs or []
         },
-        "id": payload.get("id", "") 
+        "id": payload.id
     }
 
 
 def parse_request_v2(
-        payload: Dict[str, Any],
-        ) -> str:
+        payload: ChatRequestV2,
+        ) -> Dict[str, Any]:
     """
     Parse the incoming chat payload and convert it to the format expected by HumanInLoop.
     
     Args:
-        payload: The incoming JSON payload from the REST API
+        payload: The decoded v2 request
         
     Returns:
-        List of message dictionaries in the format expected by HumanInLoop
-        
-    Raises:
-        ValueError: If required fields are missing or invalid
+        Dictionary with the content of the last message, the earlier messages
+        (contents still encoded) and the commands
     """
-    # Extract the current message content
-    if not payload.get("messages"):
-            return ""
-        
-    last_message = payload["messages"][-1]
+    # Extract the current message content; only its content is decoded
+    content = ""
+    if payload.messages:
+        content = str(msgspec.json.decode(payload.messages[-1].content))
 
     return {
-        "content": str(last_message["content"]),
-        "cmds": payload.get("data", {}).get("cmds", []),
-        "executed_cmds": payload.get("data", {}).get("executed_cmds", []),
-        "url_configs": payload.get("data", {}).get("url_configs", [])
+        "content": content,
+        "messages": payload.messages[:-1],
+        "cmds": payload.data.cmds,
+        "executed_cmds": payload.data.executed_cmds,
+        "url_configs": payload.data.url_configs
     }
 
 def create_response_v2(
         response_text: str,
-        payload: Optional[Dict[str, Any]] = None,
+        payload: Optional[ChatRequestV2] = None,
         cmds: Optional[List[Dict[str, Any]]] = None,
         executed_cmds: Optional[List[Dict[str, Any]]] = None,
         url_configs: Optional[List[Dict[str, Any]]] = None
@@ -185,32 +352,53 @@ def create_response_v2(
 
 class Endpoint:
     @staticmethod
-    def parse(payload: Dict[str, Any]) -> Dict[str, Any]:
+    def decode(body: bytes, protocol: Optional[str] = None) -> Union[ChatRequestV1, ChatRequestV2]:
+        """
+        Decode a raw request body in its wire format, rejecting malformed payloads with a 422.
+        
+        Args:
+            body: The raw request body
+            protocol: The X-Chat-Protocol header, if the client sent one
+        
+        Returns:
+            The decoded v1 or v2 request
+        """
+        try:
+            if detect_protocol(body, protocol) == "v2":
+                return decode_request_v2(body)
+            return decode_request_v1(body)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Invalid request payload: {e}")
+
+    @staticmethod
+    def parse(payload: Union[ChatRequestV1, ChatRequestV2]) -> Dict[str, Any]:
         """
         Parse and extract content from the last message.
         
         Args:
-            payload: The request payload dictionary containing messages array
+            payload: The decoded request
         
         Returns:
-            Extracted content string from the last message
+            The parsed request dictionary (see parse_request_v1 / parse_request_v2)
         """
+        if isinstance(payload, ChatRequestV2):
+            return parse_request_v2(payload)
         return parse_request_v1(payload)
     
     @staticmethod
     def success(
         content: str,
-        payload: Optional[Dict[str, Any]] = None,
+        payload: Optional[Union[ChatRequestV1, ChatRequestV2]] = None,
         cmds: Optional[List[Dict[str, Any]]] = None,
         executed_cmds: Optional[List[Dict[str, Any]]] = None,
         url_configs: Optional[List[Dict[str, Any]]] = None
     ) -> Dict[str, Any]:
         """
-        Create a standardized success response payload in the new format.
+        Create a standardized success response in the wire format of the request.
         
         Args:
             content: The main response content
-            payload: The original request payload (for compatibility)
+            payload: The decoded request; v1 requests get the v1 envelope with their thread fields echoed back
             cmds: Optional list of commands to propose (with execute: false)
             executed_cmds: Optional list of commands that were executed
             url_configs: Optional list of URL configurations for browser actions
@@ -218,9 +406,20 @@ class Endpoint:
         Returns:
             Standardized success response dictionary
         """
+        if isinstance(payload, ChatRequestV2):
+            return create_response_v2(content, payload, cmds, executed_cmds, url_configs)
         response = create_response_v1(content, payload, cmds, executed_cmds, url_configs)
         return response
 
+    @staticmethod
+    def respond(content: str, **kwargs) -> JSONBytesResponse:
+        """
+        Create the same payload as success() as a pre-encoded JSON response.
+
+        Takes the same arguments as success().
+        """
+        return JSONBytesResponse(Endpoint.success(content, **kwargs))
+
 
 def run_subprocess_command(command: str, shell=True, capture_stderr=True, text=True, timeout=None,cwd=None):
     """
@@ -379,16 +578,17 @@ def run_command(executed_commands, command, command_text, files):
                             # Write the file
             with open(full_path, 'w') as f:
                 f.write(file_content)
-                                    
-            command_text = f"cd {temp_dir} && {command_text}"
-            response = run_subprocess_command(command_text, cwd=temp_dir)
-                            # Add the response to the payload
-            command["output"] = response.get("stdout", "") # json.dumps(response, indent=2)
-            print(f"[CHAT EXECUTE COMMAND] Response: {json.dumps(response, indent=2)}")
-
-            executed_commands.append(command)
+
+        # Run the command once, after every file is in place
+        command_text = f"cd {temp_dir} && {command_text}"
+        response = run_subprocess_command(command_text, cwd=temp_dir)
+        # Add the response to the payload
+        command["output"] = response.get("stdout", "") # json.dumps(response, indent=2)
+        logger.info("[CHAT EXECUTE COMMAND] Response: %s", preview(response), extra=PAYLOAD)
+
+        executed_commands.append(command)
     except Exception as e:
-        print(f"[CHAT EXECUTE COMMAND] Error: {e}")
+        logger.error("[CHAT EXECUTE COMMAND] Error: %s", e)
         command["output"] = f"Error: {e}"
     finally:
                         # Clean up the temporary directory
@@ -407,6 +607,9 @@ def get_conversation_history(request: any) -> list[dict[str, Any]]:
     """
     try:
         past_messages = request.get("pastMessages", [])
+        if isinstance(past_messages, msgspec.Raw):
+            # Requests keep the history encoded until it is needed here
+            past_messages = msgspec.json.decode(past_messages)
         messages = []
         
         for msg in past_messages:
@@ -423,5 +626,5 @@ def get_conversation_history(request: any) -> list[dict[str, Any]]:
         
         return messages
     except Exception as e:
-        print(f"Error converting conversation history: {str(e)}")
+        logger.warning("Error converting conversation history: %s", e)
         return []
\ No newline at end of file
@@ -0,0 +1,306 @@
+import asyncio
+import math
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+# Admission control for /chat: per-tenant token-bucket rate limits, caps on
+# requests in flight per tenant and per worker process, and a bounded wait
+# queue. Limits apply per worker process; multiply by SERVER_WORKERS for the
+# whole server.
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "true").lower() in ("1", "true", "yes")
+# Requests being handled at once by this worker (0: unlimited).
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "64"))
+# Requests being handled at once for a single tenant (0: unlimited).
+ADMISSION_TENANT_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_TENANT_MAX_IN_FLIGHT", "16"))
+# Sustained requests per second per tenant and the burst above it (0: no rate limit).
+ADMISSION_TENANT_RATE = float(os.environ.get("ADMISSION_TENANT_RATE", "0"))
+ADMISSION_TENANT_BURST = int(os.environ.get("ADMISSION_TENANT_BURST", "20"))
+# Requests waiting for a slot, in total and per tenant; beyond this they are rejected at once.
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "128"))
+ADMISSION_TENANT_QUEUE_SIZE = int(os.environ.get("ADMISSION_TENANT_QUEUE_SIZE", "32"))
+# Longest a request may wait for a slot before it is shed.
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+
+# Idle tenant buckets are dropped once this many tenants are tracked
+MAX_TRACKED_TENANTS = 10000
+# Weight of the latest request in the moving average of how long requests hold a slot
+SERVICE_TIME_SMOOTHING = 0.1
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is not admitted. Carries the HTTP status to answer
+    with and the seconds after which the client may retry.
+    """
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class TenantRateLimited(AdmissionRejected):
+    """The tenant exceeded its rate limit or its share of the server (429)."""
+
+    status_code = 429
+
+
+class ServerOverloaded(AdmissionRejected):
+    """The server has no capacity for the request within its deadline (503)."""
+
+    status_code = 503
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average, with bursts of up to
+    `burst`. Tokens are refilled lazily on each take.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Take a token if one is available.
+
+        Returns:
+            0 when a token was taken, otherwise the seconds until one is available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated_at) * self.rate >= self.burst
+
+
+class Ticket:
+    """
+    A request's slot. Release it when the request (or the background work it
+    started) is done; releasing more than once has no effect.
+    """
+
+    __slots__ = ("controller", "tenant_id", "admitted_at", "released")
+
+    def __init__(self, controller: "AdmissionController", tenant_id: str):
+        self.controller = controller
+        self.tenant_id = tenant_id
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class _Waiter:
+    __slots__ = ("tenant_id", "future")
+
+    def __init__(self, tenant_id: str, future: "asyncio.Future[Ticket]"):
+        self.tenant_id = tenant_id
+        self.future = future
+
+
+class AdmissionController:
+    """
+    Decide which requests to serve now, which to queue and which to turn away.
+
+    A request first takes a token from its tenant's bucket (429 when the
+    tenant is over its rate). It is admitted at once if both the worker and
+    its tenant are under their in-flight caps; otherwise it joins a FIFO
+    queue (429 when the tenant already has its share of the queue, 503 when
+    the queue is full). A queued request is shed with 503 when its deadline
+    passes, or at once when the expected wait, from the queue length and how
+    long requests have been holding their slots, is already longer than the
+    deadline.
+
+    Slots are handed to waiters in arrival order, skipping waiters whose
+    tenant is at its cap, so one busy tenant cannot block the others. Runs on
+    the event loop; it is not thread-safe.
+    """
+
+    def __init__(
+            self,
+            max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+            tenant_max_in_flight: int = ADMISSION_TENANT_MAX_IN_FLIGHT,
+            tenant_rate: float = ADMISSION_TENANT_RATE,
+            tenant_burst: int = ADMISSION_TENANT_BURST,
+            queue_size: int = ADMISSION_QUEUE_SIZE,
+            tenant_queue_size: int = ADMISSION_TENANT_QUEUE_SIZE,
+            queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+            ):
+        self.max_in_flight = max_in_flight
+        self.tenant_max_in_flight = tenant_max_in_flight
+        self.tenant_rate = tenant_rate
+        self.tenant_burst = tenant_burst
+        self.queue_size = queue_size
+        self.tenant_queue_size = tenant_queue_size
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._tenant_in_flight: Dict[str, int] = {}
+        self._tenant_queued: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._queue: Deque[_Waiter] = deque()
+        # Moving average of how long a request holds its slot, for Retry-After and early shedding
+        self._service_time = 0.0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+
+    def _has_room(self, tenant_id: str) -> bool:
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return False
+        return not self.tenant_max_in_flight or self._tenant_in_flight.get(tenant_id, 0) < self.tenant_max_in_flight
+
+    def _grant(self, tenant_id: str) -> Ticket:
+        self.in_flight += 1
+        self._tenant_in_flight[tenant_id] = self._tenant_in_flight.get(tenant_id, 0) + 1
+        self.admitted += 1
+        return Ticket(self, tenant_id)
+
+    def _expected_wait(self, position: int) -> float:
+        # Every max_in_flight releases let one more batch of waiters in
+        return (position + 1) * self._service_time / max(1, self.max_in_flight)
+
+    def _take_token(self, tenant_id: str) -> None:
+        if self.tenant_rate <= 0:
+            return
+        bucket = self._buckets.get(tenant_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_TENANTS:
+                # A full bucket is what a new one would start as, so dropping it changes nothing
+                self._buckets = {key: value for key, value in self._buckets.items() if not value.full()}
+            bucket = self._buckets[tenant_id] = TokenBucket(self.tenant_rate, self.tenant_burst)
+        wait = bucket.take()
+        if wait:
+            self.rate_limited += 1
+            raise TenantRateLimited(f"Tenant {tenant_id!r} is over its rate limit", wait)
+
+    async def admit(self, tenant_id: str = "", timeout: Optional[float] = None) -> Ticket:
+        """
+        Wait for a slot for a request of the tenant.
+
+        Args:
+            tenant_id: Tenant of the request, as parsed from the payload
+            timeout: Longest wait for a slot. Defaults to the queue timeout
+
+        Returns:
+            The request's ticket, to be released when it is done
+
+        Raises:
+            TenantRateLimited: The tenant is over its rate limit or its share of the queue
+            ServerOverloaded: The queue is full or no slot frees up before the deadline
+        """
+        self._take_token(tenant_id)
+        # Waiters are woken as soon as there is room for them, so any still
+        # queued are blocked by a cap that has_room checks as well
+        if self._has_room(tenant_id):
+            return self._grant(tenant_id)
+
+        timeout = self.queue_timeout if timeout is None else timeout
+        retry_after = max(self._service_time, 1.0)
+        if len(self._queue) >= self.queue_size:
+            self.shed += 1
+            raise ServerOverloaded("Too many requests are waiting", retry_after)
+        queued = self._tenant_queued.get(tenant_id, 0)
+        if queued >= self.tenant_queue_size:
+            self.rate_limited += 1
+            raise TenantRateLimited(f"Tenant {tenant_id!r} has too many requests waiting", retry_after)
+        if self._expected_wait(len(self._queue)) > timeout:
+            self.shed += 1
+            raise ServerOverloaded("Requests are waiting longer than the queue timeout", retry_after)
+
+        waiter = _Waiter(tenant_id, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        self._tenant_queued[tenant_id] = queued + 1
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            self.shed += 1
+            raise ServerOverloaded(f"No capacity within {timeout:g} seconds", retry_after)
+        except asyncio.CancelledError:
+            # The client went away while waiting
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        if waiter.future.done() and not waiter.future.cancelled():
+            # A slot was granted just as the wait ended; hand it on
+            waiter.future.result().release()
+            return
+        waiter.future.cancel()
+        self._dequeue(waiter)
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        try:
+            self._queue.remove(waiter)
+        except ValueError:
+            return
+        self._untrack_queued(waiter.tenant_id)
+
+    def _untrack_queued(self, tenant_id: str) -> None:
+        remaining = self._tenant_queued[tenant_id] - 1
+        if remaining:
+            self._tenant_queued[tenant_id] = remaining
+        else:
+            del self._tenant_queued[tenant_id]
+
+    def _release(self, ticket: Ticket) -> None:
+        held = time.monotonic() - ticket.admitted_at
+        self._service_time += SERVICE_TIME_SMOOTHING * (held - self._service_time)
+        self.in_flight -= 1
+        remaining = self._tenant_in_flight[ticket.tenant_id] - 1
+        if remaining:
+            self._tenant_in_flight[ticket.tenant_id] = remaining
+        else:
+            del self._tenant_in_flight[ticket.tenant_id]
+        self._wake()
+
+    def _wake(self) -> None:
+        # Hand free slots to the oldest waiters whose tenant has room
+        for waiter in list(self._queue):
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return
+            if waiter.future.done() or not self._has_room(waiter.tenant_id):
+                continue
+            self._queue.remove(waiter)
+            self._untrack_queued(waiter.tenant_id)
+            waiter.future.set_result(self._grant(waiter.tenant_id))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Describe the controller for monitoring: limits, load and outcomes.
+        """
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queued": len(self._queue),
+            "queue_size": self.queue_size,
+            "active_tenants": len(self._tenant_in_flight),
+            "service_time_seconds": round(self._service_time, 3),
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+        }
+
+
+def create_admission_controller(enabled: bool = ADMISSION_CONTROL) -> Optional[AdmissionController]:
+    """
+    Build the admission controller, or None when admission control is disabled.
+    """
+    return AdmissionController() if enabled else None
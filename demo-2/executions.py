@@ -0,0 +1,201 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from utils import encode_json, run_command_batch
+
+# How long finished executions stay available for streaming or polling, and
+# how many output events each one keeps for subscribers that join late.
+EXECUTION_RETENTION_SECONDS = float(os.environ.get("EXECUTION_RETENTION_SECONDS", "600"))
+EXECUTION_MAX_EVENTS = int(os.environ.get("EXECUTION_MAX_EVENTS", "10000"))
+# Run stream_execution batches in the background, to be followed through
+# /executions/{id}. Executions live in the worker process that started them,
+# so multi-worker servers turn this off and run every batch within its request.
+BACKGROUND_EXECUTIONS = os.environ.get("BACKGROUND_EXECUTIONS", "true").lower() in ("1", "true", "yes")
+# How long shutdown waits for running executions before cancelling them.
+EXECUTION_DRAIN_SECONDS = float(os.environ.get("EXECUTION_DRAIN_SECONDS", "30"))
+
+# Output without a newline is flushed as a line once it reaches this size.
+MAX_LINE_BYTES = 16 * 1024
+
+
+class Execution:
+    """
+    A batch of approved commands running in the background.
+
+    Output is published as a sequence of events that any number of
+    subscribers can follow, from the beginning or while it is still running.
+    """
+
+    def __init__(self, commands: List[Dict[str, Any]], max_events: int = EXECUTION_MAX_EVENTS):
+        self.id = uuid.uuid4().hex
+        self.commands = commands
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.executed_commands: Optional[List[Dict[str, Any]]] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self._events = deque(maxlen=max_events)
+        self._next_seq = 0
+        self._wakeup = asyncio.Event()
+        self._partial: Dict[tuple, bytes] = {}
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self._events.append((self._next_seq, event))
+        self._next_seq += 1
+        # Wake every follower, then arm a fresh event for the next publish
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def output_handler(self, index: int) -> Callable[[str, bytes], None]:
+        """
+        Return an on_output callback that publishes complete lines for one command.
+        """
+        def on_output(stream: str, chunk: bytes) -> None:
+            buffered = self._partial.get((index, stream), b"") + chunk
+            *lines, rest = buffered.split(b"\n")
+            while len(rest) >= MAX_LINE_BYTES:
+                lines.append(rest[:MAX_LINE_BYTES])
+                rest = rest[MAX_LINE_BYTES:]
+            self._partial[(index, stream)] = rest
+            for line in lines:
+                self.publish({"event": stream, "index": index, "line": line.decode("utf-8", errors="replace")})
+
+        return on_output
+
+    def flush(self, index: int) -> None:
+        for stream in ("stdout", "stderr"):
+            rest = self._partial.pop((index, stream), b"")
+            if rest:
+                self.publish({"event": stream, "index": index, "line": rest.decode("utf-8", errors="replace")})
+
+    async def follow(self) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yield every retained event, then new ones as they are published, until the execution ends.
+        """
+        position = 0
+        while True:
+            wakeup = self._wakeup
+            for seq, event in list(self._events):
+                if seq >= position:
+                    position = seq + 1
+                    yield event
+            if self.finished and position >= self._next_seq:
+                return
+            await wakeup.wait()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "execution_id": self.id,
+            "state": "finished" if self.finished else "running",
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "executed_cmds": self.executed_commands,
+        }
+
+
+class ExecutionManager:
+    """
+    Start command batches independently of the HTTP request that approved them.
+
+    The request returns an execution id at once; clients then stream the
+    output from /executions/{id}/stream, so proxies never see a request that
+    sits silent for the whole run.
+    """
+
+    def __init__(self, retention: float = EXECUTION_RETENTION_SECONDS):
+        self.retention = retention
+        self._executions: Dict[str, Execution] = {}
+
+    def get(self, execution_id: str) -> Optional[Execution]:
+        return self._executions.get(execution_id)
+
+    def start(self, commands: List[Dict[str, Any]], runner) -> Execution:
+        """
+        Run a batch in the background.
+
+        Args:
+            commands: Commands in the v2 format
+            runner: Coroutine function runner(executed_commands, command, on_output) -> bool
+
+        Returns:
+            The running execution
+        """
+        self._expire()
+        execution = Execution(commands)
+        self._executions[execution.id] = execution
+        execution.task = asyncio.create_task(self._run(execution, runner))
+        return execution
+
+    async def _run(self, execution: Execution, runner) -> None:
+        indexes = {id(command): index for index, command in enumerate(execution.commands)}
+
+        async def run(executed_commands, command):
+            index = indexes[id(command)]
+            execution.publish({"event": "start", "index": index, "command": command.get("command", "")})
+            try:
+                return await runner(executed_commands, command, execution.output_handler(index))
+            finally:
+                execution.flush(index)
+                execution.publish({
+                    "event": "exit",
+                    "index": index,
+                    "returncode": command.get("returncode"),
+                })
+
+        try:
+            execution.executed_commands = await run_command_batch(execution.commands, run)
+        except asyncio.CancelledError:
+            execution.error = "Execution cancelled"
+            raise
+        except Exception as e:
+            execution.error = str(e)
+        finally:
+            execution.finished_at = time.time()
+            execution.publish({
+                "event": "done",
+                "returncodes": [command.get("returncode") for command in execution.commands],
+                "executed_cmds": execution.executed_commands or [],
+                "error": execution.error,
+            })
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.retention
+        for execution_id, execution in list(self._executions.items()):
+            if execution.finished and execution.finished_at < cutoff:
+                del self._executions[execution_id]
+
+    async def shutdown(self, timeout: Optional[float] = EXECUTION_DRAIN_SECONDS) -> None:
+        """
+        Wait for running executions to finish, cancelling whatever is left after the timeout.
+        """
+        tasks = [e.task for e in self._executions.values() if e.task is not None and not e.task.done()]
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+def sse_event(event: str, data: Any) -> str:
+    """
+    Format a single server-sent event.
+
+    Args:
+        event: The event name
+        data: JSON-serialisable event payload
+
+    Returns:
+        The encoded event, terminated by a blank line
+    """
+    return f"event: {event}\ndata: {encode_json(data).decode()}\n\n"
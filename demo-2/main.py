@@ -1,31 +1,79 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, Any
-import uvicorn
+from typing import Dict, Any, Optional
 import traceback
-from utils import Endpoint, run_command
-import json
+from contextlib import asynccontextmanager
+from utils import ChatRequestV1, PROTOCOL_HEADER, Endpoint, JSONBytesResponse, run_command_async, run_command_batch, COMMAND_TIMEOUT_SECONDS
+import executions
+from admission import AdmissionRejected, Ticket, create_admission_controller
+import logging
+import msgspec
+from logs import configure_logging, start_request, preview, PAYLOAD
 
-app = FastAPI(title="AWS Workshop API", version="0.1.0")
+configure_logging()
+logger = logging.getLogger(__name__)
+
+execution_manager = executions.ExecutionManager()
+admission = create_admission_controller()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Let background command executions finish before the process exits
+    yield
+    await execution_manager.shutdown()
+
+
+app = FastAPI(title="AWS Workshop API", version="0.1.0", lifespan=lifespan)
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    print("[HEALTH] Health check requested")
-    return {"status": "healthy", "service": "aws-workshop-api"}
+    logger.info("[HEALTH] Health check requested")
+    health = {"status": "healthy", "service": "aws-workshop-api"}
+    if admission is not None:
+        health["admission"] = admission.stats()
+    return health
+
+async def admit_request(request: Dict[str, Any]) -> Optional[Ticket]:
+    """
+    Wait for an admission slot for the request's tenant.
+
+    Returns:
+        The ticket to release once the request is done, or None when admission control is off
+
+    Raises:
+        HTTPException: 429 or 503 with Retry-After when the request is turned away
+    """
+    if admission is None:
+        return None
+    try:
+        return await admission.admit(request.get("tenant_id") or "")
+    except AdmissionRejected as e:
+        logger.info("[CHAT REJECTED] Request not admitted: %s", e)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
 @app.post("/chat")
-async def chat(payload: Dict[str, Any] = Body(...)):
+async def chat(http_request: Request):
     """
     Simple echo endpoint that returns what the user sends.
     Accepts a message payload and echoes it back in the original complex format.
     """
+    start_request()
+    payload = Endpoint.decode(await http_request.body(), http_request.headers.get(PROTOCOL_HEADER))
+    ticket = None
     try:
 
         # Parse content from the payload using the utility method
         request = Endpoint.parse(payload)
+        ticket = await admit_request(request)
+        # The demo echoes the thread identifiers but not the history
+        echo = payload
+        if isinstance(payload, ChatRequestV1):
+            echo = msgspec.structs.replace(payload, pastMessages=msgspec.Raw(b"[]"), agent_managed_memory=True)
 
-        print(json.dumps(request, indent=4))
+        logger.info("[CHAT REQUEST] Parsed request: %s", preview(request), extra=PAYLOAD)
 
         request_text = request.get("content", "")
 
@@ -36,9 +84,28 @@ async def chat(payload: Dict[str, Any] = Body(...)):
         browser_use = []
         commands = request.get("cmds", [])     
 
-        if len(commands) > 0:
+        if len(commands) > 0 and payload.stream_execution and executions.BACKGROUND_EXECUTIONS:
+                # Run in the background and let the client stream the output
+                execution = execution_manager.start(commands, run_one_command)
+                if ticket is not None:
+                    # The execution holds the admission slot until it finishes
+                    execution.task.add_done_callback(lambda task, ticket=ticket: ticket.release())
+                    ticket = None
+                response = Endpoint.success(
+                    content="Command execution started",
+                    payload=echo,
+                    cmds=cmds,
+                    executed_cmds=executed_commands,
+                    url_configs=url_configs,
+                    browser_use=browser_use
+                )
+                response["data"]["execution_id"] = execution.id
+                response["data"]["stream_url"] = f"/executions/{execution.id}/stream"
+                return JSONBytesResponse(response)
+
+        elif len(commands) > 0:
                 response_text = "Here are the results of the commands."
-                executed_commands = run_commands(commands)
+                executed_commands = await run_commands(commands)
 
         elif request_text == "command":
             response_text = "Do you want view the content of the file sample.txt?"
@@ -71,52 +138,87 @@ async def chat(payload: Dict[str, Any] = Body(...)):
         else:
             response_text = "How can I help you today? I can execute a command, or I can navigate to a URL, or I can open a browser, by typing 'command', 'url', or 'browser'"
           
-        return Endpoint.success(
+        return Endpoint.respond(
             content=response_text,
-            payload=request,
+            payload=echo,
             cmds=cmds,
             executed_cmds=executed_commands,
             url_configs=url_configs,
             browser_use=browser_use
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
-        
+        logger.error("[CHAT ERROR] Exception occurred: %s", e, exc_info=True)
+        logger.error("[CHAT ERROR] Original payload: %s", preview(payload))
+
         # Return error response with 500 status
         raise HTTPException(status_code=500, detail=traceback.format_exc())
+    finally:
+        if ticket is not None:
+            ticket.release()
 
-def run_commands(commands):
-    executed_commands = []
-    ex=[]
-                
-    for command in commands:
-        command_text = command.get("command", "")
-        execute = command.get("execute", False)
-        files = command.get("files", [])
+@app.get("/executions/{execution_id}")
+async def get_execution(execution_id: str):
+    """Return the state of a background command execution."""
+    execution = execution_manager.get(execution_id)
+    if execution is None:
+        raise HTTPException(status_code=404, detail="Execution not found")
+    return execution.status()
 
-        if execute:
-            run_command(executed_commands, command, command_text, files)
 
-        else:
-            executed_commands.append(command)
+@app.get("/executions/{execution_id}/stream")
+async def stream_execution(execution_id: str):
+    """
+    Stream a background command execution as server-sent events.
 
-        for executed_command in executed_commands:
-            ex.append({
-                "command": executed_command.get("command", ""),
-                "output": executed_command.get("output", "")
-            })
-    
+    Emits "start", "stdout"/"stderr" (one per output line) and "exit" events
+    for each command, then a final "done" event with every return code.
+    """
+    execution = execution_manager.get(execution_id)
+    if execution is None:
+        raise HTTPException(status_code=404, detail="Execution not found")
+
+    async def events():
+        async for event in execution.follow():
+            yield executions.sse_event(event["event"], event)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-            
-    return ex
 
+async def run_one_command(executed_commands, command, on_output=None):
+    command_text = command.get("command", "")
+    execute = command.get("execute", False)
+    files = command.get("files", [])
 
-if __name__ == "__main__":
+    if execute:
+        return await run_command_async(
+            executed_commands, command, command_text, files,
+            timeout=COMMAND_TIMEOUT_SECONDS, on_output=on_output
+        )
 
-        uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8001,
-        reload=True,     # set True for auto-reload in dev
-        log_level="info",
-    )
+    executed_commands.append(command)
+    return True
+
+
+async def run_commands(commands):
+    executed_commands = await run_command_batch(commands, run_one_command)
+
+    return [
+        {
+            "command": executed_command.get("command", ""),
+            "output": executed_command.get("output", "")
+        }
+        for executed_command in executed_commands
+    ]
+
+
+if __name__ == "__main__":
+    # Development server with auto-reload; production runs serve.py
+    import serve
+    serve.main(["--dev"])
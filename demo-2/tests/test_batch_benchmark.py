@@ -0,0 +1,110 @@
+"""
+Batch-size benchmarks for the command result pipeline, run with pytest-benchmark.
+
+Each stage is timed with batches from 1 to 10,000 commands. test_scales_linearly
+guards against regressions like the old quadratic result assembly, which made
+a 10x larger batch about 100x slower. Run without timing with
+--benchmark-disable, or compare runs with --benchmark-autosave and
+--benchmark-compare.
+"""
+import asyncio
+import time
+
+import pytest
+
+from main import run_commands
+from utils import ChatRequestV1, Endpoint, create_response_v1, encode_json, transform_v2_command_to_v1_format
+
+SIZES = [1, 10, 100, 1000, 10000]
+# A 10x larger batch may take at most this many times longer. Linear work
+# scales by ~10x; the old quadratic loop scaled by ~100x.
+MAX_GROWTH_PER_DECADE = 25
+
+
+def make_commands(count):
+    # Proposed (not executed) commands exercise the pipeline without paying
+    # for thousands of real subprocesses.
+    return [{"command": f"echo {i}", "execute": False, "files": []} for i in range(count)]
+
+
+def make_request(count):
+    # A v1 request carrying as many history entries as commands
+    return encode_json({
+        "content": "run",
+        "thread_id": "t",
+        "pastMessages": [{"userMsg": {"content": f"message {i}"}} for i in range(count)],
+        "data": {"Cmds": [{"Command": f"echo {i}", "execute": False, "files": []} for i in range(count)]},
+    })
+
+
+def run_batch(cmds):
+    return asyncio.run(run_commands(cmds))
+
+
+def respond(cmds):
+    executed = [dict(cmd, output="ok") for cmd in cmds]
+    payload = ChatRequestV1(thread_id="t", tenant_id="x", id="1")
+    return lambda: create_response_v1("done", payload, cmds, executed, [], [])
+
+
+def transform(cmds):
+    return [transform_v2_command_to_v1_format(cmd) for cmd in cmds]
+
+
+def decode(body):
+    return Endpoint.parse(Endpoint.decode(body))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_run_commands(benchmark, size):
+    result = benchmark.pedantic(lambda: run_batch(make_commands(size)), rounds=3)
+    assert len(result) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_create_response_v1(benchmark, size):
+    benchmark.pedantic(respond(make_commands(size)), rounds=3)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_transform_v2_command_to_v1_format(benchmark, size):
+    result = benchmark.pedantic(transform, args=(make_commands(size),), rounds=3)
+    assert len(result) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_decode_request_v1(benchmark, size):
+    request = benchmark.pedantic(decode, args=(make_request(size),), rounds=3)
+    assert len(request["cmds"]) == size
+
+
+def best_of(repeat, func):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@pytest.mark.parametrize("stage", [
+    lambda size: (lambda cmds: lambda: run_batch(cmds))(make_commands(size)),
+    lambda size: respond(make_commands(size)),
+    lambda size: (lambda cmds: lambda: transform(cmds))(make_commands(size)),
+    lambda size: (lambda body: lambda: decode(body))(make_request(size)),
+], ids=["run_commands", "create_response_v1", "transform_v2_command_to_v1_format", "decode_request_v1"])
+def test_scales_linearly(stage):
+    # Small batches are dominated by fixed overhead, so compare 1,000 with 10,000
+    small, large = best_of(3, stage(1000)), best_of(3, stage(10000))
+    assert large < small * MAX_GROWTH_PER_DECADE, f"10x more commands took {large / small:.1f}x longer"
+
+
+@pytest.mark.parametrize("file_count", [0, 1, 5])
+def test_command_runs_once_whatever_its_files(file_count):
+    files = [{"file_path": f"dir{i}/file{i}.txt", "file_content": str(i)} for i in range(file_count)]
+    # Each run appends one line to a counter file, so running more than once shows up in the output
+    command = {"command": "echo run >> runs.log; find . -name 'file*.txt' | wc -l; wc -l < runs.log",
+               "execute": True, "files": files}
+    result = run_batch([command])
+    assert len(result) == 1
+    assert result[0]["output"].split() == [str(file_count), "1"]
@@ -1,50 +1,213 @@
+import asyncio
 import json
+import logging
 import os
 import shutil
+import signal
 import tempfile
-from typing import Dict, Any, List, Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Union
 import datetime
+import msgspec
+from fastapi import HTTPException, Response
+import hashlib
 import subprocess
+import threading
 from strands.models.bedrock import BedrockModel
 
+logger = logging.getLogger(__name__)
+
+
+# Limits for running approved commands. Commands in a batch run concurrently up
+# to COMMAND_CONCURRENCY; each one and the batch as a whole have a deadline.
+COMMAND_CONCURRENCY = int(os.environ.get("COMMAND_CONCURRENCY", "4"))
+COMMAND_TIMEOUT_SECONDS = float(os.environ.get("COMMAND_TIMEOUT_SECONDS", "300"))
+BATCH_TIMEOUT_SECONDS = float(os.environ.get("BATCH_TIMEOUT_SECONDS", "900"))
+
+# Output capture limits. Only the first and last bytes of each stream are kept
+# in memory; the bytes in between are counted and dropped.
+OUTPUT_HEAD_BYTES = int(os.environ.get("COMMAND_OUTPUT_HEAD_BYTES", str(64 * 1024)))
+OUTPUT_TAIL_BYTES = int(os.environ.get("COMMAND_OUTPUT_TAIL_BYTES", str(64 * 1024)))
+OUTPUT_CHUNK_BYTES = 64 * 1024
+
+# Reusable command workspaces. tmpfs is preferred so file materialisation never
+# touches disk. Identical file contents are cached once per content hash when
+# they can be placed by hardlink or copy-on-write clone, which tmpfs lacks.
+WORKSPACE_ROOT = os.environ.get(
+    "WORKSPACE_ROOT",
+    "/dev/shm/agent-workspaces" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "agent-workspaces"),
+)
+WORKSPACE_POOL_SIZE = int(os.environ.get("WORKSPACE_POOL_SIZE", "8"))
+WORKSPACE_BLOB_CACHE_BYTES = int(os.environ.get("WORKSPACE_BLOB_CACHE_BYTES", str(64 * 1024 * 1024)))
+WORKSPACE_LINK_MODE = os.environ.get("WORKSPACE_LINK_MODE", "copy")
+FICLONE = 0x40049409
+
+
+class CommandV1(msgspec.Struct):
+    """
+    A command as sent by v1 clients. Its Output is never read, so it is skipped while decoding.
+    id and depends_on order commands within a batch (see run_command_batch).
+    """
+    Command: str = ""
+    execute: bool = False
+    files: Optional[List[Dict[str, Any]]] = []
+    id: Optional[str] = None
+    depends_on: Optional[List[Union[int, str]]] = None
+
+
+class RequestDataV1(msgspec.Struct):
+    """The data section of a v1 chat request."""
+    Cmds: Optional[List[CommandV1]] = None
+    executedCmds: Optional[List[CommandV1]] = None
+    url_configs: Optional[List[Dict[str, Any]]] = None
+
+
+class ChatRequestV1(msgspec.Struct):
+    """
+    A v1 chat request ({content, pastMessages, data: {Cmds, executedCmds}}).
+
+    pastMessages and platform_context are kept as raw JSON: they are echoed
+    back into the response as they are and only decoded when the history is
+    actually needed.
+    """
+    content: str = ""
+    pastMessages: msgspec.Raw = msgspec.Raw(b"[]")
+    thread_id: Optional[str] = ""
+    tenant_id: Optional[str] = ""
+    id: Optional[str] = ""
+    platform_context: msgspec.Raw = msgspec.Raw(b"{}")
+    agent_managed_memory: Optional[bool] = True
+    stream_execution: bool = False
+    data: Optional[RequestDataV1] = None
+
+
+class MessageV2(msgspec.Struct):
+    """A single message of a v2 chat request. The content stays raw until it is read."""
+    content: msgspec.Raw = msgspec.Raw(b'""')
+    role: str = "user"
+
+
+class RequestDataV2(msgspec.Struct):
+    """The data section of a v2 chat request, already in the internal command format."""
+    cmds: List[Dict[str, Any]] = []
+    executed_cmds: List[Dict[str, Any]] = []
+    url_configs: msgspec.Raw = msgspec.Raw(b"[]")
+
+
+class ChatRequestV2(msgspec.Struct):
+    """A v2 chat request ({messages, data: {cmds, executed_cmds}})."""
+    messages: List[MessageV2] = []
+    data: RequestDataV2 = msgspec.field(default_factory=RequestDataV2)
+    stream_execution: bool = False
+
+
+# Compiled once; decoding validates the body straight from the request bytes
+_request_v1_decoder = msgspec.json.Decoder(ChatRequestV1, strict=False)
+_request_v2_decoder = msgspec.json.Decoder(ChatRequestV2, strict=False)
+
+
+def decode_request_v1(body: bytes) -> ChatRequestV1:
+    """
+    Decode and validate a raw v1 request body.
+
+    Raises:
+        msgspec.ValidationError: If the body does not match the v1 schema
+        msgspec.DecodeError: If the body is not valid JSON
+    """
+    return _request_v1_decoder.decode(body)
+
+
+def decode_request_v2(body: bytes) -> ChatRequestV2:
+    """
+    Decode and validate a raw v2 request body.
+
+    Raises:
+        msgspec.ValidationError: If the body does not match the v2 schema
+        msgspec.DecodeError: If the body is not valid JSON
+    """
+    return _request_v2_decoder.decode(body)
+
+
+# Clients may pin the wire format with this header ("v1" or "v2"); otherwise
+# it is inferred from the shape of the payload.
+PROTOCOL_HEADER = "X-Chat-Protocol"
+
+
+class _ProtocolProbe(msgspec.Struct):
+    """The top-level keys that tell the formats apart; their values are skipped, not decoded."""
+    messages: msgspec.Raw = msgspec.Raw(b"")
+    pastMessages: msgspec.Raw = msgspec.Raw(b"")
+
+
+_protocol_probe_decoder = msgspec.json.Decoder(_ProtocolProbe)
+
+
+def detect_protocol(body: bytes, header: Optional[str] = None) -> str:
+    """
+    Work out which wire format a request uses.
+
+    Args:
+        body: The raw request body
+        header: The value of the X-Chat-Protocol header, if any
+
+    Returns:
+        "v2" for a body with messages and no pastMessages (or when the header
+        asks for it), otherwise "v1"
+
+    Raises:
+        ValueError: If the header names an unknown protocol or the body is not a JSON object
+    """
+    if header:
+        protocol = header.strip().lower()
+        if protocol in ("1", "v1"):
+            return "v1"
+        if protocol in ("2", "v2"):
+            return "v2"
+        raise ValueError(f"Unsupported {PROTOCOL_HEADER}: {header}")
+
+    probe = _protocol_probe_decoder.decode(body)
+    if len(probe.messages) and not len(probe.pastMessages):
+        return "v2"
+    return "v1"
+
 
 def parse_request_v1(
-        payload: Dict[str, Any],
+        payload: ChatRequestV1,
         ) -> Dict[str, Any]:
     """
     Parse the incoming chat payload and convert it to the format expected by HumanInLoop.
     
     Args:
-        payload: The incoming JSON payload from the REST API
+        payload: The decoded v1 request
         
     Returns:
-        List of message dictionaries in the format expected by HumanInLoop
-        
-    Raises:
-        ValueError: If required fields are missing or invalid
+        Dictionary with the content, the (still encoded) past messages and the
+        commands converted to the v2 format
     """
     
     response = {}
     # Extract the current message content
-    current_content = payload.get("content", "")
-
-    if current_content:
-        response["content"] = current_content
-    # Extract the past messages
-    past_messages = payload.get("pastMessages", [])
-    response["messages"] = past_messages
-    response["thread_id"] = payload.get("thread_id", "")
-    response["tenant_id"] = payload.get("tenant_id", "")
-    response["id"] = payload.get("id", "")
-    response["platform_context"] = payload.get("platform_context", {})
-    data = payload.get("data", {})
-
-    if data:
-        response["past_messages_count"] = len(past_messages)
-        response["cmds"] = [transform_v1_command_to_v2_format(cmd) for cmd in (data.get("Cmds", []) or [])]
-        response["executed_cmds"] = [transform_v1_command_to_v2_format(cmd) for cmd in (data.get("executedCmds", []) or [])]
-
-        response["url_configs"] = data.get("url_configs", [])
+    if payload.content:
+        response["content"] = payload.content
+    # The past messages stay raw until someone needs the history
+    response["messages"] = payload.pastMessages
+    response["thread_id"] = payload.thread_id
+    response["tenant_id"] = payload.tenant_id
+    response["id"] = payload.id
+    response["platform_context"] = payload.platform_context
+    data = payload.data
+
+    if data is not None:
+        response["cmds"] = [
+            {"command": cmd.Command, "execute": cmd.execute, "files": cmd.files, "id": cmd.id, "depends_on": cmd.depends_on}
+            for cmd in (data.Cmds or [])
+        ]
+        response["executed_cmds"] = [
+            {"command": cmd.Command, "execute": cmd.execute, "files": cmd.files}
+            for cmd in (data.executedCmds or [])
+        ]
+        response["url_configs"] = data.url_configs if data.url_configs is not None else []
     
     return response
 
@@ -84,7 +247,9 @@ def transform_v1_command_to_v2_format(command_dict: Dict[str, Any]) -> Dict[str,
             {
                 "Command": str,
                 "Output": str,
-                "execute": bool
+                "execute": bool,
+                "id": str (optional),
+                "depends_on": List[int | str] (optional)
             }
             
     Returns:
@@ -92,18 +257,77 @@ def transform_v1_command_to_v2_format(command_dict: Dict[str, Any]) -> Dict[str,
             {
                 "command": str,
                 "execute": bool,
-                "files": List[Dict[str, str]]
+                "files": List[Dict[str, str]],
+                "id": str or None,
+                "depends_on": List[int | str] or None
             }
     """
     return {
         "command": command_dict.get("Command", ""),
         "execute": command_dict.get("execute", False),
-        "files": command_dict.get("files", [])
+        "files": command_dict.get("files", []),
+        "id": command_dict.get("id"),
+        "depends_on": command_dict.get("depends_on")
     }
 
+class CommandRecord(msgspec.Struct):
+    """Fixed-layout v1 command entry, encoded as {Command, Output, files, execute}."""
+    Command: Any
+    Output: Any
+    files: Any
+    execute: Any
+
+
+class ExecutedCommandRecord(msgspec.Struct):
+    """Fixed-layout v1 executed command entry, encoded as {Command, Output, execute}."""
+    Command: Any
+    Output: Any
+    execute: bool = True
+
+
+_json_encoder = msgspec.json.Encoder()
+
+
+def encode_json(obj: Any) -> bytes:
+    """
+    Serialize a response (dicts, lists and command records) straight to JSON bytes.
+    """
+    return _json_encoder.encode(obj)
+
+
+class JSONBytesResponse(Response):
+    """
+    JSON response that is encoded once by msgspec.
+
+    Returning it from an endpoint skips FastAPI's jsonable_encoder walk over the
+    response dict; pre-encoded bytes are sent as they are.
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return encode_json(content)
+
+
+def _command_records(cmds: Optional[List[Dict[str, Any]]]) -> List[CommandRecord]:
+    # Single pass from v2 command dicts to v1 records, no intermediate dicts
+    return [
+        CommandRecord(cmd.get("command", ""), cmd.get("output", ""), cmd.get("files", []), cmd.get("execute", False))
+        for cmd in (cmds or [])
+    ]
+
+
+def _executed_command_records(executed_cmds: Optional[List[Dict[str, Any]]]) -> List[ExecutedCommandRecord]:
+    return [
+        ExecutedCommandRecord(cmd.get("command", ""), cmd.get("output", ""))
+        for cmd in (executed_cmds or [])
+    ]
+
+
 def create_response_v1(
         response_text: str,
-        payload: Optional[Dict[str, Any]] = None,
+        payload: Optional[ChatRequestV1] = None,
         cmds: Optional[List[Dict[str, Any]]] = None,
         executed_cmds: Optional[List[Dict[str, Any]]] = None,
         url_configs: Optional[List[Dict[str, Any]]] = None,
@@ -111,137 +335,154 @@ def create_response_v1(
         ) -> Dict[str, Any]:
     """
     Generate a chat response based on the payload.
-    """
-    # Transform commands if they exist
-    transformed_cmds = [transform_v2_command_to_v1_format(cmd) for cmd in (cmds or [])]
-    transformed_executed_cmds = [transform_v2_command_to_v1_format(cmd) for cmd in (executed_cmds or [])]
-
-    ex = []
-    for executed_command in transformed_executed_cmds:
-        ex.append({
-            "Command": executed_command.get("Command", ""),
-            "Output": executed_command.get("Output", ""),
-            "execute": True,
-        })
-
-    transformed_executed_cmds = ex
-
-    browser_use_transformed = {}
 
-    if(len(browser_use) > 0):
-        browser_use_transformed = {
-            "actions": browser_use,
-            "subtask_complete": False,
-            "task_complete": True,
-        }
+    Commands are converted to fixed-layout records in a single pass; the
+    result can be encoded directly with encode_json / JSONBytesResponse, which
+    writes the raw pastMessages and platform_context back without decoding them.
+    """
+    payload = payload or ChatRequestV1()
 
     # Build data dictionary, only including url_configs and browser_use if they have items
     data = {
         "response_type": "success",
         "processed_at": datetime.datetime.utcnow().isoformat() + "Z",
-        "Cmds": transformed_cmds,
-        "executedCmds": transformed_executed_cmds or [],
+        "Cmds": _command_records(cmds),
+        "executedCmds": _executed_command_records(executed_cmds),
     }
-    
+
     # Only include url_configs if it has items
     if url_configs:
         data["url_configs"] = url_configs
-    
+
     # Only include browser_use if it has items
-    if browser_use_transformed:
-        data["browser_use"] = browser_use_transformed
+    if browser_use:
+        data["browser_use"] = {
+            "actions": browser_use,
+            "subtask_complete": False,
+            "task_complete": True,
+        }
 
     return {
-        "pastMessages": payload.get("pastMessages", []) if payload else [],
+        "pastMessages": payload.pastMessages,
         "Content": response_text,
         "terminalCommands": [],
-        "thread_id": payload.get("thread_id", ""),
-        "tenant_id": payload.get("tenant_id", ""),
-        "agent_managed_memory": payload.get("agent_managed_memory", True) if payload else True,
-        "platform_context": payload.get("platform_context", {}) if payload else {},
+        "thread_id": payload.thread_id,
+        "tenant_id": payload.tenant_id,
+        "agent_managed_memory": payload.agent_managed_memory,
+        "platform_context": payload.platform_context,
         "data": data,
-        "id": payload.get("id", "") 
+        "id": payload.id
     }
 
 
 def parse_request_v2(
-        payload: Dict[str, Any],
-        ) -> str:
+        payload: ChatRequestV2,
+        ) -> Dict[str, Any]:
     """
     Parse the incoming chat payload and convert it to the format expected by HumanInLoop.
     
     Args:
-        payload: The incoming JSON payload from the REST API
+        payload: The decoded v2 request
         
     Returns:
-        List of message dictionaries in the format expected by HumanInLoop
-        
-    Raises:
-        ValueError: If required fields are missing or invalid
+        Dictionary with the content of the last message, the earlier messages
+        (contents still encoded) and the commands
     """
-    # Extract the current message content
-    if not payload.get("messages"):
-            return ""
-        
-    last_message = payload["messages"][-1]
+    # Extract the current message content; only its content is decoded
+    content = ""
+    if payload.messages:
+        content = str(msgspec.json.decode(payload.messages[-1].content))
 
     return {
-        "content": str(last_message["content"]),
-        "cmds": payload.get("data", {}).get("cmds", []),
-        "executed_cmds": payload.get("data", {}).get("executed_cmds", []),
-        "url_configs": payload.get("data", {}).get("url_configs", [])
+        "content": content,
+        "messages": payload.messages[:-1],
+        "cmds": payload.data.cmds,
+        "executed_cmds": payload.data.executed_cmds,
+        "url_configs": payload.data.url_configs
     }
 
 def create_response_v2(
         response_text: str,
-        payload: Optional[Dict[str, Any]] = None,
+        payload: Optional[ChatRequestV2] = None,
         cmds: Optional[List[Dict[str, Any]]] = None,
         executed_cmds: Optional[List[Dict[str, Any]]] = None,
-        url_configs: Optional[List[Dict[str, Any]]] = None
+        url_configs: Optional[List[Dict[str, Any]]] = None,
+        browser_use: Optional[List[Dict[str, Any]]] = None
         ) -> Dict[str, Any]:
     """
     Generate a chat response based on the payload.
     """
+    data = {
+        "cmds": cmds or [],
+        "executed_cmds": executed_cmds or [],
+        "url_configs": url_configs or []
+    }
+
+    # Only include browser_use if it has items, as in the v1 envelope
+    if browser_use:
+        data["browser_use"] = {
+            "actions": browser_use,
+            "subtask_complete": False,
+            "task_complete": True,
+        }
+
     return {
             "role": "assistant",
             "content": response_text,
-            "data": {
-                "cmds": cmds or [],
-                "executed_cmds": executed_cmds or [],
-                "url_configs": url_configs or []
-            }
+            "data": data
         }
 
 
 class Endpoint:
     @staticmethod
-    def parse(payload: Dict[str, Any]) -> Dict[str, Any]:
+    def decode(body: bytes, protocol: Optional[str] = None) -> Union[ChatRequestV1, ChatRequestV2]:
+        """
+        Decode a raw request body in its wire format, rejecting malformed payloads with a 422.
+        
+        Args:
+            body: The raw request body
+            protocol: The X-Chat-Protocol header, if the client sent one
+        
+        Returns:
+            The decoded v1 or v2 request
+        """
+        try:
+            if detect_protocol(body, protocol) == "v2":
+                return decode_request_v2(body)
+            return decode_request_v1(body)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Invalid request payload: {e}")
+
+    @staticmethod
+    def parse(payload: Union[ChatRequestV1, ChatRequestV2]) -> Dict[str, Any]:
         """
         Parse and extract content from the last message.
         
         Args:
-            payload: The request payload dictionary containing messages array
+            payload: The decoded request
         
         Returns:
-            Extracted content string from the last message
+            The parsed request dictionary (see parse_request_v1 / parse_request_v2)
         """
+        if isinstance(payload, ChatRequestV2):
+            return parse_request_v2(payload)
         return parse_request_v1(payload)
     
     @staticmethod
     def success(
         content: str,
-        payload: Optional[Dict[str, Any]] = None,
+        payload: Optional[Union[ChatRequestV1, ChatRequestV2]] = None,
         cmds: Optional[List[Dict[str, Any]]] = None,
         executed_cmds: Optional[List[Dict[str, Any]]] = None,
         url_configs: Optional[List[Dict[str, Any]]] = None,
         browser_use: Optional[List[Dict[str, Any]]] = None
     ) -> Dict[str, Any]:
         """
-        Create a standardized success response payload in the new format.
+        Create a standardized success response in the wire format of the request.
         
         Args:
             content: The main response content
-            payload: The original request payload (for compatibility)
+            payload: The decoded request; v1 requests get the v1 envelope with their thread fields echoed back
             cmds: Optional list of commands to propose (with execute: false)
             executed_cmds: Optional list of commands that were executed
             url_configs: Optional list of URL configurations for browser actions
@@ -249,69 +490,209 @@ class Endpoint:
         Returns:
             Standardized success response dictionary
         """
+        if isinstance(payload, ChatRequestV2):
+            return create_response_v2(content, payload, cmds, executed_cmds, url_configs, browser_use)
         response = create_response_v1(content, payload, cmds, executed_cmds, url_configs, browser_use)
         return response
 
+    @staticmethod
+    def respond(content: str, **kwargs) -> JSONBytesResponse:
+        """
+        Create the same payload as success() as a pre-encoded JSON response.
+
+        Takes the same arguments as success().
+        """
+        return JSONBytesResponse(Endpoint.success(content, **kwargs))
+
+
+class BoundedOutput:
+    """
+    Capture a process output stream in bounded memory.
+
+    Keeps the first head_bytes and a ring buffer of the last tail_bytes, and
+    counts everything in between without storing it.
+    """
+
+    def __init__(self, head_bytes: int = OUTPUT_HEAD_BYTES, tail_bytes: int = OUTPUT_TAIL_BYTES):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+
+    def write(self, data: bytes) -> None:
+        self.total_bytes += len(data)
+
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data and self.tail_bytes > 0:
+            self.tail += data
+            # Trim lazily so the ring buffer costs amortised O(1) per byte
+            if len(self.tail) > 2 * self.tail_bytes:
+                del self.tail[:-self.tail_bytes]
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > len(self.head) + min(len(self.tail), self.tail_bytes)
+
+    def getvalue(self, text: bool = True):
+        tail = bytes(self.tail[-self.tail_bytes:]) if self.tail_bytes > 0 else b""
+        if self.truncated:
+            skipped = self.total_bytes - len(self.head) - len(tail)
+            data = bytes(self.head) + f"\n... [{skipped} bytes truncated] ...\n".encode() + tail
+        else:
+            data = bytes(self.head) + tail
+        return data.decode('utf-8', errors='replace') if text else data
+
+
+def _kill_process_group(process) -> None:
+    # Commands run through a shell in their own session, so kill the whole
+    # group; otherwise grandchildren keep the output pipes open.
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def _bounded_result(stdout: BoundedOutput, stderr: BoundedOutput, capture_stderr=True, text=True) -> Dict[str, Any]:
+    return {
+        'stdout': stdout.getvalue(text),
+        'stderr': stderr.getvalue(text) if capture_stderr else None,
+        'stdout_bytes': stdout.total_bytes,
+        'stderr_bytes': stderr.total_bytes,
+        'truncated': stdout.truncated or stderr.truncated,
+    }
+
 
-def run_subprocess_command(command: str, shell=True, capture_stderr=True, text=True, timeout=None,cwd=None):
+def describe_result(response: Dict[str, Any]) -> str:
     """
-    Run a subprocess command and capture all output.
+    Summarise a command result for logging without dumping its output.
+    """
+    return (
+        f"returncode={response.get('returncode')} success={response.get('success')} "
+        f"stdout_bytes={response.get('stdout_bytes', 0)} stderr_bytes={response.get('stderr_bytes', 0)} "
+        f"truncated={response.get('truncated', False)}"
+        + (f" error={response['error']}" if response.get('error') else "")
+    )
+
+
+def run_subprocess_command(command: str, shell=True, capture_stderr=True, text=True, timeout=None, cwd=None,
+                           head_bytes=OUTPUT_HEAD_BYTES, tail_bytes=OUTPUT_TAIL_BYTES):
+    """
+    Run a subprocess command and capture its output in bounded memory.
     
     Args:
-        payload: The original request payload (for compatibility)
         command (str or list): The command to run. Can be a string or list of arguments.
-        shell (bool): Whether to run the command through the shell. Default is False.
+        shell (bool): Whether to run the command through the shell. Default is True.
         capture_stderr (bool): Whether to capture stderr along with stdout. Default is True.
         text (bool): Whether to return output as text (True) or bytes (False). Default is True.
         timeout (int): Maximum time in seconds to wait for command completion. Default is None (no timeout).
+        cwd (str): Working directory for the command. Default is the current directory.
+        head_bytes (int): Bytes kept from the start of each stream.
+        tail_bytes (int): Bytes kept from the end of each stream.
     
     Returns:
         dict: A dictionary containing:
-            - 'stdout': Standard output from the command
+            - 'stdout': Standard output from the command (head and tail if truncated)
             - 'stderr': Standard error from the command (if capture_stderr=True)
             - 'returncode': Exit code of the command
             - 'success': Boolean indicating if command succeeded (returncode == 0)
-    
-    Raises:
-        subprocess.TimeoutExpired: If the command times out
-        FileNotFoundError: If the command is not found
-        subprocess.CalledProcessError: If there are other subprocess errors
+            - 'stdout_bytes' / 'stderr_bytes': Total bytes the command wrote to each stream
+            - 'truncated': Whether any output was dropped from the middle of a stream
     """
+    stdout = BoundedOutput(head_bytes, tail_bytes)
+    stderr = BoundedOutput(head_bytes, tail_bytes)
     try:
-        # Run the command and capture output
-        result = subprocess.run(
+        process = subprocess.Popen(
             command,
             shell=shell,
-            capture_output=True,
-            text=text,
-            timeout=timeout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             cwd=cwd,
-            check=False  # Don't raise exception on non-zero exit codes
+            start_new_session=True,
         )
-        
-        return {
-            'stdout': result.stdout,
-            'stderr': result.stderr if capture_stderr else None,
-            'returncode': result.returncode,
-            'success': result.returncode == 0
-        }
-        
-    except subprocess.TimeoutExpired as e:
+    except FileNotFoundError as e:
         return {
-            'stdout': e.stdout.decode('utf-8') if e.stdout and not text else e.stdout,
-            'stderr': e.stderr.decode('utf-8') if e.stderr and not text else e.stderr,
-            'returncode': None,
+            'stdout': '',
+            'stderr': f'Command not found: {e}',
+            'returncode': -1,
             'success': False,
-            'error': f'Command timed out after {timeout} seconds'
+            'error': str(e)
         }
-    except FileNotFoundError as e:
+    except Exception as e:
         return {
             'stdout': '',
-            'stderr': f'Command not found: {e}',
+            'stderr': f'Unexpected error: {e}',
             'returncode': -1,
             'success': False,
             'error': str(e)
         }
+
+    def pump(stream, output):
+        for chunk in iter(lambda: stream.read(OUTPUT_CHUNK_BYTES), b""):
+            output.write(chunk)
+        stream.close()
+
+    readers = [
+        threading.Thread(target=pump, args=(process.stdout, stdout), daemon=True),
+        threading.Thread(target=pump, args=(process.stderr, stderr), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(process)
+        process.wait()
+        for reader in readers:
+            reader.join()
+        result = _bounded_result(stdout, stderr, capture_stderr, text)
+        result.update({
+            'returncode': None,
+            'success': False,
+            'error': f'Command timed out after {timeout} seconds'
+        })
+        return result
+
+    for reader in readers:
+        reader.join()
+    result = _bounded_result(stdout, stderr, capture_stderr, text)
+    result.update({
+        'returncode': returncode,
+        'success': returncode == 0
+    })
+    return result
+
+
+async def run_subprocess_command_async(command: str, timeout=None, cwd=None,
+                                       head_bytes=OUTPUT_HEAD_BYTES, tail_bytes=OUTPUT_TAIL_BYTES,
+                                       on_output=None):
+    """
+    Run a shell command on the event loop without blocking it.
+
+    Args:
+        command (str): The shell command to run.
+        timeout (float): Maximum time in seconds to wait for command completion. Default is None (no timeout).
+        cwd (str): Working directory for the command. Default is the current directory.
+        head_bytes (int): Bytes kept from the start of each stream.
+        tail_bytes (int): Bytes kept from the end of each stream.
+        on_output (callable): Optional on_output(stream_name, chunk) called with every
+            chunk of output as it arrives, where stream_name is "stdout" or "stderr".
+
+    Returns:
+        dict: The same structure as run_subprocess_command.
+    """
+    try:
+        process = await asyncio.create_subprocess_shell(
+            command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
+        )
     except Exception as e:
         return {
             'stdout': '',
@@ -321,6 +702,47 @@ def run_subprocess_command(command: str, shell=True, capture_stderr=True, text=T
             'error': str(e)
         }
 
+    stdout = BoundedOutput(head_bytes, tail_bytes)
+    stderr = BoundedOutput(head_bytes, tail_bytes)
+
+    async def pump(stream, output, name):
+        while True:
+            chunk = await stream.read(OUTPUT_CHUNK_BYTES)
+            if not chunk:
+                break
+            output.write(chunk)
+            if on_output is not None:
+                on_output(name, chunk)
+
+    async def communicate():
+        await asyncio.gather(pump(process.stdout, stdout, "stdout"), pump(process.stderr, stderr, "stderr"))
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        _kill_process_group(process)
+        await process.wait()
+        result = _bounded_result(stdout, stderr)
+        result.update({
+            'returncode': None,
+            'success': False,
+            'error': f'Command timed out after {timeout} seconds'
+        })
+        return result
+    except asyncio.CancelledError:
+        # Never leave an orphaned process behind when the batch is cancelled
+        _kill_process_group(process)
+        await process.wait()
+        raise
+
+    result = _bounded_result(stdout, stderr)
+    result.update({
+        'returncode': returncode,
+        'success': returncode == 0
+    })
+    return result
+
 
 def read_text_file(file_path, encoding='utf-8', strip_whitespace=False):
     """
@@ -389,8 +811,205 @@ def get_bedrock_model(session: any) -> str:
             boto_session=session
         )
 
+class WorkspacePool:
+    """
+    Pool of reusable working directories for commands that ship files.
+
+    Workspaces are created once under root (tmpfs by default) and emptied
+    between uses instead of being created and deleted for every command. File
+    contents are stored once per content hash in a blob cache and placed into a
+    workspace by copy-on-write clone or, with link_mode="hardlink", by
+    hardlink. Hardlinks are the cheapest option but let a command that edits a
+    file in place modify the cached blob, so they are only suitable for
+    commands that treat their inputs as read-only.
+
+    When the root cannot clone files (tmpfs, ext4) and link_mode is "copy", a
+    cached blob would only be copied again, so files are written directly and
+    no blob cache is kept.
+    """
+
+    def __init__(self, root: str = WORKSPACE_ROOT, size: int = WORKSPACE_POOL_SIZE,
+                 blob_cache_bytes: int = WORKSPACE_BLOB_CACHE_BYTES, link_mode: str = WORKSPACE_LINK_MODE):
+        self.root = root
+        self.size = size
+        self.blob_cache_bytes = blob_cache_bytes
+        self.link_mode = link_mode
+        # Each worker process keeps its own directory so pools never share state
+        self.pool_dir = os.path.join(root, f"pool-{os.getpid()}")
+        self.blob_dir = os.path.join(self.pool_dir, "blobs")
+        self._free: List[str] = []
+        self._blobs: "OrderedDict[str, int]" = OrderedDict()
+        self._blob_bytes = 0
+        self._lock = threading.Lock()
+        self._ready = False
+        self._use_blobs = False
+
+    def _setup(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        # Remove pools left behind by worker processes that no longer exist
+        for entry in os.scandir(self.root):
+            pid = entry.name[len("pool-"):]
+            if entry.name.startswith("pool-") and pid.isdigit() and not _pid_alive(int(pid)):
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+        shutil.rmtree(self.pool_dir, ignore_errors=True)
+        os.makedirs(self.blob_dir)
+        self._use_blobs = self.link_mode == "hardlink" or _supports_clone(self.blob_dir)
+        for _ in range(self.size):
+            self._free.append(tempfile.mkdtemp(prefix="ws-", dir=self.pool_dir))
+        self._ready = True
+
+    def acquire(self) -> str:
+        """
+        Return an empty workspace directory, creating one if the pool is exhausted.
+        """
+        with self._lock:
+            if not self._ready:
+                self._setup()
+            if self._free:
+                return self._free.pop()
+        return tempfile.mkdtemp(prefix="ws-", dir=self.pool_dir)
+
+    def release(self, workspace: str) -> None:
+        """
+        Empty a workspace and return it to the pool, or delete it if the pool is full.
+        """
+        try:
+            for entry in os.scandir(workspace):
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+        except OSError:
+            # Something the command left behind cannot be removed; drop the workspace
+            shutil.rmtree(workspace, ignore_errors=True)
+            return
+
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(workspace)
+                return
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    def write_file(self, workspace: str, file_path: str, file_content: str) -> str:
+        """
+        Place a file into a workspace, reusing the cached blob for identical content.
+
+        Args:
+            workspace: Workspace directory returned by acquire()
+            file_path: Path relative to the workspace
+            file_content: Text content of the file
+
+        Returns:
+            The full path of the file in the workspace
+
+        Raises:
+            ValueError: If file_path points outside the workspace
+        """
+        full_path = os.path.normpath(os.path.join(workspace, file_path))
+        if os.path.commonpath([workspace, full_path]) != workspace or full_path == workspace:
+            raise ValueError(f"File path escapes the workspace: {file_path}")
+
+        dir_path = os.path.dirname(full_path)
+        if dir_path != workspace:
+            os.makedirs(dir_path, exist_ok=True)
+
+        data = file_content.encode("utf-8")
+        blob = self._blob(data) if self._use_blobs else None
+        if blob is not None and self.link_mode == "hardlink":
+            os.link(blob, full_path)
+            return full_path
+        with open(full_path, 'wb') as f:
+            # Without a blob (no cloning, or too large for the cache) or if the
+            # clone fails, write the content directly
+            if blob is None or not _clone_into(blob, f):
+                f.write(data)
+        return full_path
+
+    def _blob(self, data: bytes) -> Optional[str]:
+        if len(data) > self.blob_cache_bytes:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.blob_dir, digest)
+
+        with self._lock:
+            if digest in self._blobs and os.path.exists(path):
+                self._blobs.move_to_end(digest)
+                return path
+
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            if digest not in self._blobs:
+                self._blob_bytes += len(data)
+            self._blobs[digest] = len(data)
+
+            # Evict least recently used blobs; files already placed in
+            # workspaces are unaffected because they are copies or links.
+            while self._blob_bytes > self.blob_cache_bytes and len(self._blobs) > 1:
+                old_digest, old_size = self._blobs.popitem(last=False)
+                self._blob_bytes -= old_size
+                try:
+                    os.unlink(os.path.join(self.blob_dir, old_digest))
+                except FileNotFoundError:
+                    pass
+        return path
+
+    @contextmanager
+    def workspace(self):
+        """
+        Context manager yielding a workspace that is reset when the block exits.
+        """
+        workspace = self.acquire()
+        try:
+            yield workspace
+        finally:
+            self.release(workspace)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _clone_into(source: str, destination) -> bool:
+    # Make the open, empty destination file a copy-on-write clone of source
+    # (btrfs, xfs). Returns False where the filesystem cannot clone.
+    try:
+        import fcntl
+        with open(source, 'rb') as src:
+            fcntl.ioctl(destination.fileno(), FICLONE, src.fileno())
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def _supports_clone(directory: str) -> bool:
+    source = os.path.join(directory, ".clone-probe")
+    try:
+        with open(source, 'wb') as f:
+            f.write(b"probe")
+        with open(f"{source}.copy", 'wb') as destination:
+            return _clone_into(source, destination)
+    finally:
+        for path in (source, f"{source}.copy"):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+workspace_pool = WorkspacePool()
+
+
 def run_command(executed_commands, command, command_text, files):
-    temp_dir = tempfile.mkdtemp()
+    temp_dir = workspace_pool.acquire()
     try:
         for file_info in files:
             file_path = file_info.get("file_path")
@@ -399,31 +1018,129 @@ def run_command(executed_commands, command, command_text, files):
             if not file_path or file_content is None:
                 continue
                                 
-                            # Create full path within the temp directory
-            full_path = os.path.join(temp_dir, file_path)
-                                
-                            # Create directory structure if it doesn't exist
-            dir_path = os.path.dirname(full_path)
-            if dir_path and not os.path.exists(dir_path):
-                os.makedirs(dir_path)
-                                
-                            # Write the file
-            with open(full_path, 'w') as f:
-                f.write(file_content)
-                                    
-            command_text = f"cd {temp_dir} && {command_text}"
-            response = run_subprocess_command(command_text, cwd=temp_dir)
-                            # Add the response to the payload
-            command["output"] = response.get("stdout", "") # json.dumps(response, indent=2)
-            print(f"[CHAT EXECUTE COMMAND] Response: {json.dumps(response, indent=2)}")
-
-            executed_commands.append(command)
+            # Place the file in the workspace, reusing cached content
+            workspace_pool.write_file(temp_dir, file_path, file_content)
+
+        # Run the command once, after every file is in place
+        command_text = f"cd {temp_dir} && {command_text}"
+        response = run_subprocess_command(command_text, cwd=temp_dir)
+        # Add the response to the payload
+        command["output"] = response.get("stdout", "")
+        logger.info("[CHAT EXECUTE COMMAND] Response: %s", describe_result(response))
+
+        executed_commands.append(command)
+    except Exception as e:
+        logger.error("[CHAT EXECUTE COMMAND] Error: %s", e)
+        command["output"] = f"Error: {e}"
+    finally:
+        # Reset the workspace and return it to the pool
+        workspace_pool.release(temp_dir)
+
+
+async def run_command_async(executed_commands, command, command_text, files, timeout=None, on_output=None):
+    """
+    Async counterpart of run_command, running the command with asyncio subprocesses.
+
+    Returns:
+        bool: True if the command succeeded
+    """
+    success = False
+    temp_dir = workspace_pool.acquire()
+    try:
+        for file_info in files:
+            file_path = file_info.get("file_path")
+            file_content = file_info.get("file_content")
+
+            if not file_path or file_content is None:
+                continue
+
+            # Place the file in the workspace, reusing cached content
+            workspace_pool.write_file(temp_dir, file_path, file_content)
+
+        # Run the command once, after every file is in place
+        command_text = f"cd {temp_dir} && {command_text}"
+        response = await run_subprocess_command_async(
+            command_text, timeout=timeout, cwd=temp_dir, on_output=on_output
+        )
+        # Add the response to the payload
+        command["output"] = response.get("stdout", "")
+        command["returncode"] = response.get("returncode")
+        success = response.get("success", False)
+        logger.info("[CHAT EXECUTE COMMAND] Response: %s", describe_result(response))
+
+        executed_commands.append(command)
     except Exception as e:
-        print(f"[CHAT EXECUTE COMMAND] Error: {e}")
+        logger.error("[CHAT EXECUTE COMMAND] Error: %s", e)
         command["output"] = f"Error: {e}"
     finally:
-                        # Clean up the temporary directory
-        shutil.rmtree(temp_dir)
+        # Reset the workspace and return it to the pool
+        workspace_pool.release(temp_dir)
+    return success
+
+
+async def run_command_batch(
+        commands: List[Dict[str, Any]],
+        runner,
+        concurrency: int = COMMAND_CONCURRENCY,
+        batch_timeout: Optional[float] = BATCH_TIMEOUT_SECONDS,
+        ) -> List[Dict[str, Any]]:
+    """
+    Run a batch of commands concurrently and collect their results in the original order.
+
+    A command may list earlier commands it has to wait for in "depends_on",
+    either by position in the batch or by their "id". It only runs once those
+    have finished, and is skipped if any of them failed.
+
+    Args:
+        commands: Commands in the v2 format
+        runner: Coroutine function runner(executed_commands, command) -> bool that
+            runs one command, appends its result(s) and returns whether it succeeded
+        concurrency: Maximum number of commands running at the same time
+        batch_timeout: Deadline in seconds for the whole batch, or None for no limit
+
+    Returns:
+        The executed commands, in the same order as the input
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results: List[List[Dict[str, Any]]] = [[] for _ in commands]
+    ids = {command["id"]: index for index, command in enumerate(commands) if command.get("id") is not None}
+    tasks: List[asyncio.Task] = []
+
+    async def run_one(index: int, command: Dict[str, Any]) -> bool:
+        for dependency in command.get("depends_on", []) or []:
+            dep_index = ids.get(dependency, dependency)
+            if not isinstance(dep_index, int) or not 0 <= dep_index < index:
+                command["output"] = f"Error: unknown or later dependency {dependency!r}"
+                results[index].append(command)
+                return False
+            if not await tasks[dep_index]:
+                command["output"] = f"Skipped: dependency {dependency!r} failed"
+                results[index].append(command)
+                return False
+
+        async with semaphore:
+            return await runner(results[index], command)
+
+    for index, command in enumerate(commands):
+        tasks.append(asyncio.create_task(run_one(index, command)))
+
+    if tasks:
+        _, pending = await asyncio.wait(tasks, timeout=batch_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        for index, task in enumerate(tasks):
+            if task.cancelled():
+                commands[index]["output"] = f"Error: batch timed out after {batch_timeout} seconds"
+                results[index] = [commands[index]]
+            elif task.exception() is not None:
+                commands[index]["output"] = f"Error: {task.exception()}"
+                results[index] = [commands[index]]
+
+    return [executed for result in results for executed in result]
+
+
 
 def get_conversation_history(request: any) -> list[dict[str, Any]]:
     """
@@ -438,6 +1155,9 @@ def get_conversation_history(request: any) -> list[dict[str, Any]]:
     """
     try:
         past_messages = request.get("pastMessages", [])
+        if isinstance(past_messages, msgspec.Raw):
+            # Requests keep the history encoded until it is needed here
+            past_messages = msgspec.json.decode(past_messages)
         messages = []
         
         for msg in past_messages:
@@ -454,7 +1174,7 @@ def get_conversation_history(request: any) -> list[dict[str, Any]]:
         
         return messages
     except Exception as e:
-        print(f"Error converting conversation history: {str(e)}")
+        logger.warning("Error converting conversation history: %s", e)
         return []
 
         
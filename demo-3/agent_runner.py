@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+from metrics import agent_calls_in_flight, agent_call_timeouts, agent_call_disconnects
+from metrics import agent_calls_coalesced, agent_calls_shared_in_flight
+
+logger = logging.getLogger(__name__)
+
+# Size of the thread pool that runs blocking agent calls, and the default
+# per-request deadline for a single agent call.
+AGENT_MAX_WORKERS = int(os.environ.get("AGENT_MAX_WORKERS", "16"))
+AGENT_TIMEOUT_SECONDS = float(os.environ.get("AGENT_TIMEOUT_SECONDS", "120"))
+# Let concurrent requests for the same turn share one agent call.
+AGENT_COALESCE = os.environ.get("AGENT_COALESCE", "true").lower() in ("1", "true", "yes")
+
+# How often to check whether the client that is waiting on a call has gone away.
+DISCONNECT_POLL_SECONDS = 0.5
+
+T = TypeVar("T")
+
+
+class AgentTimeoutError(Exception):
+    """Raised when an agent call does not finish before its deadline."""
+
+
+class ClientDisconnectedError(Exception):
+    """Raised when the client waiting on an agent call disconnects."""
+
+
+class _SharedCall:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Task[Any]"):
+        self.task = task
+        self.waiters = 0
+
+
+class AgentRunner:
+    """
+    Run blocking Strands agent calls on a bounded thread pool.
+
+    The event loop only awaits the result, so a slow Bedrock call no longer
+    stalls every other request (including /health) on the worker.
+    """
+
+    def __init__(self, max_workers: int = AGENT_MAX_WORKERS, timeout: float = AGENT_TIMEOUT_SECONDS,
+                 coalesce: bool = AGENT_COALESCE):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.coalesce = coalesce
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent")
+        self._shared: Dict[Hashable, _SharedCall] = {}
+
+    @staticmethod
+    def _call(agent: Any, content: str, **kwargs: Any) -> Any:
+        agent_calls_in_flight.inc()
+        try:
+            return agent(content, **kwargs)
+        finally:
+            agent_calls_in_flight.dec()
+
+    @staticmethod
+    def _cancel(agent: Any) -> None:
+        # Newer Strands releases can stop an agent mid-stream; older ones
+        # simply finish in the background and their result is discarded.
+        cancel = getattr(agent, "cancel", None)
+        if callable(cancel):
+            try:
+                cancel()
+            except Exception as e:
+                logger.warning("Failed to cancel agent call: %s", e)
+
+    async def invoke(
+            self,
+            agent: Any,
+            content: str,
+            http_request: Optional[Any] = None,
+            timeout: Optional[float] = None,
+            **kwargs: Any,
+            ) -> Any:
+        """
+        Invoke the agent off the event loop and wait for its result.
+
+        Args:
+            agent: The Strands agent to call
+            content: The user prompt
+            http_request: The incoming Starlette request, used to detect client disconnects
+            timeout: Deadline in seconds for this call. Defaults to the runner timeout
+            **kwargs: Extra keyword arguments for the agent call, such as structured_output_model
+
+        Returns:
+            The agent result
+
+        Raises:
+            AgentTimeoutError: If the call does not finish before the deadline
+            ClientDisconnectedError: If the client disconnects while waiting
+        """
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(self._executor, functools.partial(self._call, agent, content, **kwargs))
+        waiters = {call}
+
+        disconnect_watch = None
+        if http_request is not None:
+            disconnect_watch = asyncio.ensure_future(self._wait_for_disconnect(http_request))
+            waiters.add(disconnect_watch)
+
+        try:
+            done, _ = await asyncio.wait(
+                waiters,
+                timeout=timeout if timeout is not None else self.timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        except asyncio.CancelledError:
+            self._cancel(agent)
+            raise
+        finally:
+            if disconnect_watch is not None:
+                disconnect_watch.cancel()
+
+        if call in done:
+            return call.result()
+
+        self._cancel(agent)
+        if disconnect_watch is not None and disconnect_watch in done:
+            agent_call_disconnects.inc()
+            raise ClientDisconnectedError("Client disconnected before the agent call finished")
+
+        agent_call_timeouts.inc()
+        raise AgentTimeoutError(f"Agent call timed out after {timeout or self.timeout} seconds")
+
+    async def single_flight(
+            self,
+            key: Hashable,
+            call: Callable[[], Awaitable[T]],
+            http_request: Optional[Any] = None,
+            ) -> T:
+        """
+        Run call() once for all concurrent requests with the same key.
+
+        The first request starts the call as a task of its own; requests that
+        arrive while it runs wait for the same result (or exception) instead
+        of making their own. A request whose client disconnects stops waiting
+        without affecting the others, and the call is cancelled once nobody
+        is waiting for it.
+
+        Args:
+            key: Identifies the turn: everything the model sees, such as the
+                model id, system prompt, history digest and prompt
+            call: Coroutine function making the agent call. It is shared, so it
+                must not watch any single client for disconnects
+            http_request: The incoming Starlette request, used to detect client disconnects
+
+        Returns:
+            The result of the shared call
+
+        Raises:
+            ClientDisconnectedError: If the client disconnects while waiting
+        """
+        if not self.coalesce:
+            return await self._wait(asyncio.ensure_future(call()), http_request, cancel_on_exit=True)
+
+        shared = self._shared.get(key)
+        if shared is None:
+            shared = _SharedCall(asyncio.ensure_future(call()))
+            self._shared[key] = shared
+            agent_calls_shared_in_flight.inc()
+            shared.task.add_done_callback(lambda task: self._forget(key, shared))
+        else:
+            agent_calls_coalesced.inc()
+
+        shared.waiters += 1
+        try:
+            return await self._wait(shared.task, http_request, cancel_on_exit=False)
+        finally:
+            shared.waiters -= 1
+            if shared.waiters == 0 and not shared.task.done():
+                # Every client has gone away; stop the call rather than finish it for no one
+                shared.task.cancel()
+
+    def _forget(self, key: Hashable, shared: _SharedCall) -> None:
+        agent_calls_shared_in_flight.dec()
+        if self._shared.get(key) is shared:
+            del self._shared[key]
+
+    async def _wait(self, task: "asyncio.Future[T]", http_request: Optional[Any], cancel_on_exit: bool) -> T:
+        disconnect_watch = None
+        waiters = {task}
+        if http_request is not None:
+            disconnect_watch = asyncio.ensure_future(self._wait_for_disconnect(http_request))
+            waiters.add(disconnect_watch)
+        try:
+            # asyncio.wait never cancels the task it waits on, so one waiter
+            # leaving does not cancel the call for the others
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if disconnect_watch is not None:
+                disconnect_watch.cancel()
+            if cancel_on_exit and not task.done():
+                task.cancel()
+        if task in done:
+            return task.result()
+        agent_call_disconnects.inc()
+        raise ClientDisconnectedError("Client disconnected before the agent call finished")
+
+    @staticmethod
+    async def _wait_for_disconnect(http_request: Any) -> None:
+        while not await http_request.is_disconnected():
+            await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop accepting new calls and optionally wait for in-flight ones to finish.
+        """
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,78 @@
+"""
+Benchmark for extracting the JSON reply from model output.
+
+Times extract_json_from_response on whole replies of growing size, and
+JsonObjectScanner on the same replies fed in 8-character chunks as they
+stream. It fails if extraction grows faster than linearly with the size of
+the reply. Correctness is covered by tests/test_streaming.py.
+
+Usage:
+    python benchmark.py [--sizes 10 100 1000 10000] [--repeat 3]
+"""
+import argparse
+import json
+import sys
+import time
+
+from main import extract_json_from_response
+from streaming import JsonObjectScanner
+
+# A 10x larger reply may take at most this many times longer.
+MAX_GROWTH_PER_DECADE = 25
+
+
+def make_reply(count):
+    reply = {
+        "content": "Commands to run",
+        "data": {"cmds": [{"command": f"echo '{{{i}}}' \"quoted\"", "execute": False} for i in range(count)]},
+    }
+    return "Here is the plan:\n```json\n" + json.dumps(reply, indent=2) + "\n```\n"
+
+
+def best_of(repeat, func):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark(sizes, repeat):
+    failures = []
+    previous = None
+    print("[BENCH] extract_json_from_response")
+    for size in sizes:
+        text = make_reply(size)
+        elapsed = best_of(repeat, lambda: extract_json_from_response(text))
+        chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+        streamed = best_of(repeat, lambda: [scanner.feed(chunk) for scanner in [JsonObjectScanner()] for chunk in chunks])
+        print(f"  {size:>6} commands ({len(text):>8} chars): {elapsed * 1000:9.3f} ms whole, {streamed * 1000:9.3f} ms in 8-char chunks")
+
+        if previous and previous[0] >= 100:
+            prev_size, prev_elapsed = previous
+            allowed = prev_elapsed * MAX_GROWTH_PER_DECADE * (size / prev_size) / 10
+            if elapsed > allowed:
+                failures.append(f"scanner: {prev_size} -> {size} commands took {elapsed / prev_elapsed:.1f}x longer")
+        previous = (size, elapsed)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    failures = benchmark(args.sizes, args.repeat)
+
+    if failures:
+        print("[BENCH] Failures:")
+        for failure in failures[:20]:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("[BENCH] JSON extraction scales linearly")
+
+
+if __name__ == "__main__":
+    main()
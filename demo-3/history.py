@@ -0,0 +1,251 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import msgspec
+
+from metrics import history_compactions, history_summary_updates, history_tokens_folded
+
+# Estimated token budget for the history sent to the model, including the
+# system prompt. 0 sends the whole history.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "16000"))
+# The latest turns are always sent verbatim, even if they exceed the budget.
+HISTORY_PINNED_TURNS = int(os.environ.get("HISTORY_PINNED_TURNS", "4"))
+# How turns that no longer fit are folded into a summary: "extractive" keeps a
+# clipped line per message, "model" asks Bedrock, "none" just drops them.
+HISTORY_SUMMARY = os.environ.get("HISTORY_SUMMARY", "extractive")
+HISTORY_SUMMARY_MAX_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", "500"))
+HISTORY_SUMMARY_MAX_THREADS = int(os.environ.get("HISTORY_SUMMARY_MAX_THREADS", "10000"))
+
+# Rough token estimate for English text and JSON
+CHARS_PER_TOKEN = 4
+# Role and framing tokens the model adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# Longest line an extractive summary keeps per message
+SUMMARY_LINE_CHARS = 200
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and a cloud engineering assistant.
+
+You are given the current summary and the turns that follow it. Reply with the updated summary only: the
+user's goals, facts and decisions established so far, and the commands that were proposed or run. Be brief."""
+
+SUMMARY_ACK = "Understood, I will take the earlier conversation into account."
+
+# (summary so far, messages to fold into it) -> updated summary
+Summarizer = Callable[[str, List[Dict[str, Any]]], str]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in text without running a tokenizer."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """Estimate the tokens a Strands message ({role, content: [{text}]}) takes up."""
+    return MESSAGE_OVERHEAD_TOKENS + sum(estimate_tokens(block.get("text", "")) for block in message.get("content", []))
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    return " ".join(block.get("text", "") for block in message.get("content", []))
+
+
+def extractive_summary(summary: str, messages: List[Dict[str, Any]]) -> str:
+    """
+    Append one clipped line per message to the summary, dropping the oldest
+    lines once it is over HISTORY_SUMMARY_MAX_TOKENS.
+    """
+    lines = summary.splitlines() if summary else []
+    for message in messages:
+        text = " ".join(message_text(message).split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS - 3] + "..."
+        speaker = "User" if message.get("role") == "user" else "Assistant"
+        lines.append(f"{speaker}: {text}")
+    while len(lines) > 1 and estimate_tokens("\n".join(lines)) > HISTORY_SUMMARY_MAX_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class ModelSummarizer:
+    """
+    Summarize with the pooled Bedrock model. Blocks on the model call, so it
+    must run off the event loop.
+    """
+
+    def __call__(self, summary: str, messages: List[Dict[str, Any]]) -> str:
+        from strands import Agent
+
+        from replies import get_agent_text
+        from utils import get_bedrock_model
+
+        turns = "\n".join(
+            f"{'User' if message.get('role') == 'user' else 'Assistant'}: {message_text(message)}"
+            for message in messages
+        )
+        agent = Agent(
+            system_prompt=SUMMARY_PROMPT,
+            model=get_bedrock_model(temperature=0.0),
+            callback_handler=None,
+        )
+        prompt = (
+            f"Current summary:\n{summary or '(none)'}\n\nNew turns:\n{turns}\n\n"
+            f"Keep the summary under {HISTORY_SUMMARY_MAX_TOKENS * CHARS_PER_TOKEN} characters."
+        )
+        return get_agent_text(agent(prompt)).strip()
+
+
+class SummaryEntry(msgspec.Struct):
+    """The rolling summary of a thread and the history prefix it covers."""
+    count: int
+    digest: str
+    text: str
+
+
+def prefix_digest(messages: List[Dict[str, Any]]) -> str:
+    return hashlib.sha256(msgspec.json.encode(messages)).hexdigest()
+
+
+class HistoryCompactor:
+    """
+    Fit the conversation history into a token budget.
+
+    The system prompt and the latest pinned turns are always kept. Older
+    messages are added back newest first while they fit, and the ones that do
+    not are folded into a rolling summary sent ahead of the window. Summaries
+    are cached per thread and extended with the newly dropped messages only,
+    as long as the earlier history they cover has not changed.
+    """
+
+    def __init__(
+            self,
+            budget: int = HISTORY_TOKEN_BUDGET,
+            pinned_turns: int = HISTORY_PINNED_TURNS,
+            summarizer: Optional[Summarizer] = extractive_summary,
+            max_threads: int = HISTORY_SUMMARY_MAX_THREADS,
+            ):
+        self.budget = budget
+        self.pinned_turns = pinned_turns
+        self.summarizer = summarizer
+        self.max_threads = max_threads
+        self._summaries: "OrderedDict[Tuple[str, str], SummaryEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pinned_start(self, messages: List[Dict[str, Any]]) -> int:
+        """Index of the first message of the latest pinned turns."""
+        turns = 0
+        for index in range(len(messages) - 1, -1, -1):
+            if messages[index].get("role") == "user":
+                turns += 1
+                if turns == self.pinned_turns:
+                    return index
+        return 0
+
+    def compact(
+            self,
+            messages: List[Dict[str, Any]],
+            system_prompt: str = "",
+            tenant_id: str = "",
+            thread_id: str = "",
+            ) -> List[Dict[str, Any]]:
+        """
+        Return the history to send to the model for this turn.
+
+        Args:
+            messages: The history as returned by get_conversation_history
+            system_prompt: The agent system prompt, which counts towards the budget
+            tenant_id: Tenant of the thread, used to cache its summary
+            thread_id: Thread id, used to cache its summary; without one the summary is rebuilt
+
+        Returns:
+            The history unchanged when it fits, otherwise the summary (as a
+            user/assistant exchange) followed by the most recent messages that fit
+        """
+        available = self.budget - estimate_tokens(system_prompt)
+        sizes = [message_tokens(message) for message in messages]
+        if sum(sizes) <= available:
+            return messages
+
+        pinned = self.pinned_start(messages)
+        if self.summarizer is not None:
+            available -= HISTORY_SUMMARY_MAX_TOKENS + MESSAGE_OVERHEAD_TOKENS * 2 + estimate_tokens(SUMMARY_ACK)
+        used = sum(sizes[pinned:])
+        start = pinned
+        while start > 0 and used + sizes[start - 1] <= available:
+            start -= 1
+            used += sizes[start]
+        # The window has to open with a user message
+        while start < pinned and messages[start].get("role") != "user":
+            start += 1
+        if start == 0:
+            return messages
+
+        key = (tenant_id, thread_id) if thread_id else None
+        entry = self._cached_summary(key, messages, pinned)
+        if entry is not None and entry.count > start:
+            # Messages already in the summary are not sent again
+            start = entry.count
+
+        history_compactions.inc()
+        history_tokens_folded.inc(sum(sizes[:start]))
+        if self.summarizer is None:
+            return messages[start:]
+
+        summary = self._summarize(key, entry, messages, start)
+        if not summary:
+            return messages[start:]
+        return [
+            {"role": "user", "content": [{"text": f"Summary of the earlier conversation:\n{summary}"}]},
+            {"role": "assistant", "content": [{"text": SUMMARY_ACK}]},
+        ] + messages[start:]
+
+    def _cached_summary(
+            self,
+            key: Optional[Tuple[str, str]],
+            messages: List[Dict[str, Any]],
+            pinned: int,
+            ) -> Optional[SummaryEntry]:
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._summaries.get(key)
+            if entry is not None:
+                self._summaries.move_to_end(key)
+        if entry is None or entry.count > pinned or prefix_digest(messages[:entry.count]) != entry.digest:
+            # The client edited or replaced the history it covers
+            return None
+        return entry
+
+    def _summarize(
+            self,
+            key: Optional[Tuple[str, str]],
+            entry: Optional[SummaryEntry],
+            messages: List[Dict[str, Any]],
+            start: int,
+            ) -> str:
+        if entry is not None and entry.count == start:
+            return entry.text
+        covered, text = (entry.count, entry.text) if entry is not None else (0, "")
+        text = self.summarizer(text, messages[covered:start])
+        history_summary_updates.inc()
+        if key is not None:
+            with self._lock:
+                self._summaries[key] = SummaryEntry(start, prefix_digest(messages[:start]), text)
+                self._summaries.move_to_end(key)
+                while len(self._summaries) > self.max_threads:
+                    self._summaries.popitem(last=False)
+        return text
+
+
+def create_history_compactor(
+        budget: int = HISTORY_TOKEN_BUDGET,
+        summary: str = HISTORY_SUMMARY,
+        ) -> Optional[HistoryCompactor]:
+    """
+    Build the configured history compactor, or None when the history is sent whole.
+    """
+    if budget <= 0:
+        return None
+    summarizers = {"extractive": extractive_summary, "model": ModelSummarizer(), "none": None}
+    return HistoryCompactor(budget, summarizer=summarizers.get(summary, extractive_summary))
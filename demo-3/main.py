@@ -1,18 +1,58 @@
-from fastapi import FastAPI, HTTPException, Body
-from typing import Dict, Any
-import uvicorn
-import json
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from typing import Dict, Any, List, Optional, Tuple
+import asyncio
 import traceback
-from utils import get_conversation_history, Endpoint, run_command_simple
+from contextlib import asynccontextmanager
+from utils import ChatRequestV1, PROTOCOL_HEADER, get_conversation_history, Endpoint, JSONBytesResponse, bedrock_registry, get_bedrock_model
+from utils import BEDROCK_MODEL_ID, cached_system_prompt, add_history_cache_point, prompt_cache_usage
+from utils import run_command_simple_async, run_command_batch, COMMAND_TIMEOUT_SECONDS
+from agent_runner import AgentRunner, AgentTimeoutError, ClientDisconnectedError
+import metrics
+import replies
+from streaming import ContentFieldStreamer, JsonObjectScanner, sse_event
+import executions
+from response_cache import create_response_cache, cache_key, cache_headers, is_cacheable
+from semantic_cache import create_semantic_cache
+from history import create_history_compactor
+from admission import AdmissionRejected, Ticket, create_admission_controller
+from tracing import RequestTimingMiddleware, annotate, configure_tracing, stage
+from thread_store import create_thread_store, uses_server_history, load_history, record_turn, HistoryVersionConflict
 from strands import Agent
-from strands.models.bedrock import BedrockModel
-import boto3
+from starlette.background import BackgroundTask
 import logging
+from logs import configure_logging, start_request, preview, PAYLOAD
 
-app = FastAPI(title="AWS Workshop API", version="0.1.0")
+agent_runner = AgentRunner()
+thread_store = create_thread_store()
+response_cache = create_response_cache()
+semantic_cache = create_semantic_cache()
+history_compactor = create_history_compactor()
+admission = create_admission_controller()
+execution_manager = executions.ExecutionManager()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The Bedrock registry and the agent executor live for the whole process;
+    # drain in-flight agent calls and command executions, then close the
+    # pooled clients on shutdown.
+    yield
+    await execution_manager.shutdown()
+    agent_runner.shutdown(wait=True)
+    bedrock_registry.close()
+    if thread_store is not None:
+        thread_store.close()
+    if response_cache is not None:
+        response_cache.close()
+
+
+app = FastAPI(title="AWS Workshop API", version="0.1.0", lifespan=lifespan)
+app.add_middleware(RequestTimingMiddleware)
+configure_tracing()
 
 # Configure basic logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Unified system prompt for the agent (shared across all requests)
@@ -35,6 +75,14 @@ User: "what is git?" → {"content": "Git is a distributed version control syste
 
 IMPORTANT: Start your response with { and end with }. Nothing else."""
 
+# System prompt for AGENT_OUTPUT_MODE=structured, where the reply schema is
+# declared to the model as a tool instead of being spelled out in the prompt
+STRUCTURED_SYSTEM_PROMPT = """You are a helpful cloud engineering assistant.
+
+Answer the user's question in content. When the request needs shell commands, describe
+them in content and propose them in data.cmds with execute set to false; the user
+approves commands before they run."""
+
 # ---------------------------------------------------------------------------
 # Helper utilities
 # ---------------------------------------------------------------------------
@@ -43,168 +91,539 @@ def extract_json_from_response(response_text: str) -> str:
     """Return the JSON portion of a response string.
 
     The model occasionally adds prose or wraps the JSON in code fences. This helper
-    attempts to locate and return the first valid JSON object it can find. If no
-    JSON is found, the original text is returned so that downstream logic can
+    returns the first valid JSON object it can find, including nested objects. If
+    no JSON is found, the original text is returned so that downstream logic can
     handle the error gracefully.
     """
-    response_text = response_text.strip()
+    scanner = JsonObjectScanner()
+    return scanner.feed(response_text) or response_text.strip()
+
 
-    # Fast-path: string already looks like pure JSON
-    if response_text.startswith("{") and response_text.endswith("}"):
-        return response_text
+def get_system_prompt() -> str:
+    """Return the system prompt for the configured output mode."""
+    return STRUCTURED_SYSTEM_PROMPT if replies.structured_output_enabled() else SYSTEM_PROMPT
 
-    import re
 
-    # Look for JSON surrounded by fenced code blocks
-    match = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", response_text, re.DOTALL)
-    if match:
-        return match.group(1)
+def create_agent(conversation_history: List[Dict[str, Any]]) -> Agent:
+    """Build a per-request agent over the pooled Bedrock model."""
+    # Reuse the pooled model so only the inference call is paid per request
+    bedrock_model = get_bedrock_model(temperature=0.1)
 
-    # Fallback: first curly-brace section
-    match = re.search(r"(\{.*?\})", response_text, re.DOTALL)
-    if match:
-        return match.group(1)
+    # Checkpoints after the system prompt and the history let Bedrock reuse
+    # the prefix that every turn of a conversation repeats
+    system_prompt = get_system_prompt()
+    return Agent(
+        system_prompt=cached_system_prompt(system_prompt),
+        model=bedrock_model,
+        # The agent appends the turn to its messages; the caller's history must stay as it was
+        messages=add_history_cache_point(list(conversation_history), system_prompt=system_prompt)
+    )
+
+
+def report_model_usage(agent: Agent) -> Dict[str, int]:
+    """
+    Count the Bedrock tokens of a turn's model calls, log its prompt cache use
+    and attach both to the request span.
+
+    Returns:
+        The prompt cache token counts, {"read": ..., "write": ...}
+    """
+    usage = prompt_cache_usage(agent)
+    tokens = agent.event_loop_metrics.accumulated_usage
+    metrics.model_input_tokens.inc(tokens.get("inputTokens", 0))
+    metrics.model_output_tokens.inc(tokens.get("outputTokens", 0))
+    metrics.prompt_cache_read_tokens.inc(usage["read"])
+    metrics.prompt_cache_write_tokens.inc(usage["write"])
+    annotate({
+        "model.input_tokens": tokens.get("inputTokens", 0),
+        "model.output_tokens": tokens.get("outputTokens", 0),
+        "model.cache_read_tokens": usage["read"],
+        "model.cache_write_tokens": usage["write"],
+    })
+    logger.info("Prompt cache: %d tokens read, %d tokens written", usage["read"], usage["write"])
+    return usage
+
+
+async def admit_request(request: Dict[str, Any]) -> Optional[Ticket]:
+    """
+    Wait for an admission slot for the request's tenant.
+
+    Returns:
+        The ticket to release once the request is done, or None when admission control is off
+
+    Raises:
+        HTTPException: 429 or 503 with Retry-After when the request is turned away
+    """
+    if admission is None:
+        return None
+    try:
+        with stage("admission"):
+            return await admission.admit(request.get("tenant_id") or "")
+    except AdmissionRejected as e:
+        (metrics.admission_rate_limited if e.status_code == 429 else metrics.admission_shed).inc()
+        logger.info("Request not admitted: %s", e)
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+async def compact_conversation_history(
+        conversation_history: List[Dict[str, Any]],
+        request: Dict[str, Any],
+        ) -> List[Dict[str, Any]]:
+    """Fit the history into the token budget, folding older turns into the thread summary."""
+    if history_compactor is None:
+        return conversation_history
+    # Model summaries call Bedrock, so compaction runs off the event loop
+    return await asyncio.to_thread(
+        history_compactor.compact,
+        conversation_history,
+        get_system_prompt(),
+        request.get("tenant_id") or "",
+        request.get("thread_id") or "",
+    )
+
+
+def semantic_context(conversation_history: List[Dict[str, Any]]) -> str:
+    """Digest of everything the model sees apart from the prompt, which scopes semantic matches."""
+    return cache_key(BEDROCK_MODEL_ID, get_system_prompt(), conversation_history, "")
+
+
+async def lookup_cached_reply(
+        conversation_history: List[Dict[str, Any]],
+        content: str,
+        ) -> Tuple[Optional[str], Optional[str], Optional[Dict[str, Any]], Optional[str]]:
+    """
+    Look the turn up in the response cache, then in the semantic cache.
+
+    Returns:
+        (cache key, semantic context, cached reply, tier that had it). The key
+        is None when caching is disabled and the context when the semantic
+        cache is; the reply and tier are None on a miss. The key and context
+        are taken before the model runs and are passed on to store_cached_reply.
+    """
+    if response_cache is None and semantic_cache is None:
+        return None, None, None, None
+    key = cache_key(BEDROCK_MODEL_ID, get_system_prompt(), conversation_history, content)
+    context = reply = tier = None
+    if response_cache is not None:
+        reply, tier = await response_cache.get(key)
+    if semantic_cache is not None:
+        context = semantic_context(conversation_history)
+        if reply is None:
+            reply, similarity = semantic_cache.get(context, content)
+            if reply is not None:
+                logger.info("Semantic cache hit with similarity %.3f", similarity)
+                tier = "semantic"
+    return key, context, reply, tier
+
+
+async def store_cached_reply(
+        key: Optional[str],
+        context: Optional[str],
+        content: str,
+        reply: Optional[Dict[str, Any]],
+        ) -> None:
+    """Remember a fresh reply in every enabled cache, under the key and context from lookup_cached_reply."""
+    if key is None or not is_cacheable(reply):
+        return
+    if response_cache is not None:
+        await response_cache.set(key, reply)
+    if semantic_cache is not None and context is not None:
+        semantic_cache.set(context, content, reply)
+
+
+async def generate_reply(
+        key: Optional[str],
+        context: Optional[str],
+        conversation_history: List[Dict[str, Any]],
+        content: str,
+        ) -> Tuple[Optional[Dict[str, Any]], Dict[str, int]]:
+    """
+    Ask a new agent for the reply to a turn, count its token usage and cache
+    the reply. Runs once for all the requests coalesced on the turn, so it does
+    not watch any one of their clients for disconnects.
+
+    Returns:
+        (reply, prompt cache token counts)
+    """
+    with stage("agent_setup"):
+        agent = create_agent(conversation_history)
+    reply = await replies.get_reply(agent_runner, agent, content)
+    usage = report_model_usage(agent)
+    with stage("cache"):
+        await store_cached_reply(key, context, content, reply)
+    return reply, usage
+
+
+def load_server_history(request: Dict[str, Any], payload: ChatRequestV1) -> bool:
+    """
+    Fill in the request history from the thread store when the client opted in.
+
+    Returns True when the turn uses server-side history, so the response should
+    only carry the new entries.
+    """
+    # Server-side threads are a v1 feature; v2 clients always send their messages
+    if thread_store is None or not isinstance(payload, ChatRequestV1) or not uses_server_history(payload):
+        return False
+    try:
+        _, past_messages = load_history(thread_store, payload)
+    except HistoryVersionConflict as e:
+        raise HTTPException(status_code=409, detail={"error": str(e), "history_version": e.current_version})
+    request["pastMessages"] = past_messages
+    return True
+
+
+def save_server_history(response: Dict[str, Any], payload: ChatRequestV1, content: str) -> Dict[str, Any]:
+    """Record the turn in the thread store and return only the history delta."""
+    try:
+        version, delta = record_turn(thread_store, payload, content, response.get("Content", ""))
+    except HistoryVersionConflict as e:
+        # A concurrent turn on the same thread was recorded first
+        raise HTTPException(status_code=409, detail={"error": str(e), "history_version": e.current_version})
+    response["pastMessages"] = delta
+    response["history_version"] = version
+    return response
+
+
+def build_agent_reply(reply: Optional[Dict[str, Any]], payload: ChatRequestV1) -> Dict[str, Any]:
+    """
+    Turn the parsed model reply into the standard success envelope.
+
+    Args:
+        reply: The {content, data} reply, or None if it could not be parsed even after repair
+        payload: The decoded request
+    """
+    if reply is None:
+        logger.error("Failed to parse AI response")
+
+        # Fallback response
+        return Endpoint.success(
+            content="I apologize, but I encountered an error processing your request. Please try again.",
+            payload=payload
+        )
+
+    response_content = reply.get("content", "")
+    response_data = reply.get("data") or {}
+
+    # Check if this is a command response
+    if response_data.get("cmds"):
+        # It's a command response - return it for user approval
+        logger.info("Commands detected: %s", preview(response_data["cmds"]), extra=PAYLOAD)
+        return Endpoint.success(
+            content=response_content,
+            cmds=response_data["cmds"],
+            payload=payload
+        )
+
+    # It's a general response - return the content
+    logger.info("General response - content: %s", preview(response_content), extra=PAYLOAD)
+    return Endpoint.success(
+        content=response_content,
+        payload=payload
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Metrics in the Prometheus text format, including per-stage latency histograms."""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
 
-    return response_text
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     logger.info("Health check requested")
-    return {"status": "healthy", "service": "aws-workshop-api"}
+    health = {
+        "status": "healthy",
+        "service": "aws-workshop-api",
+        "inflight_agent_calls": metrics.agent_calls_in_flight.value,
+    }
+    if semantic_cache is not None:
+        health["semantic_cache"] = semantic_cache.stats()
+    if admission is not None:
+        health["admission"] = admission.stats()
+    return health
 
 @app.post("/chat")
-async def chat(payload: Dict[str, Any] = Body(...)):
+async def chat(http_request: Request):
     """
     Unified chat endpoint that handles both command generation and general questions.
     Always returns JSON in the specified format.
     """
+    start_request()
+    body = await http_request.body()
+    ticket = None
     try:
-        # Use the shared system prompt
-        system_prompt = SYSTEM_PROMPT
-
         # Log the incoming request
-        logger.debug("Received payload: %s", json.dumps(payload, indent=2))
-        
+        logger.debug("Received payload: %s", preview(body), extra=PAYLOAD)
+        with stage("decode"):
+            payload = Endpoint.decode(body, http_request.headers.get(PROTOCOL_HEADER))
+
         # Parse content from the payload
-        request = Endpoint.parse(payload)
+        with stage("parse"):
+            request = Endpoint.parse(payload)
         content = request.get("content", "")
         cmds = request.get("cmds", [])
-        logger.debug("Content: %s", content)
+        logger.debug("Content: %s", preview(content), extra=PAYLOAD)
+        ticket = await admit_request(request)
 
         # Check if this is a command execution request
+        if len(cmds) > 0 and payload.stream_execution and executions.BACKGROUND_EXECUTIONS:
+            # Run in the background and let the client stream the output; the
+            # execution holds the admission slot until it finishes
+            response = start_execution(cmds, payload, ticket)
+            ticket = None
+            return JSONBytesResponse(response)
         if len(cmds) > 0:
             # This is a command response, process it
-            logger.info("Executing commands: %s", cmds)
-            executed_commands = run_commands(cmds)
-            logger.info("Executed commands: %s", executed_commands)
-            return Endpoint.success(
-                content="Command executed successfully",
-                payload=payload,
-                executed_cmds=executed_commands
-            )
+            logger.info("Executing commands: %s", preview(cmds), extra=PAYLOAD)
+            with stage("commands"):
+                executed_commands = await run_commands(cmds)
+            logger.info("Executed commands: %s", preview(executed_commands), extra=PAYLOAD)
+            with stage("envelope"):
+                return Endpoint.respond(
+                    content="Command executed successfully",
+                    payload=payload,
+                    executed_cmds=executed_commands
+                )
 
         # For new messages, use the unified agent
-        conversation_history = get_conversation_history(request)
+        with stage("history"):
+            server_history = load_server_history(request, payload)
+            conversation_history = await compact_conversation_history(get_conversation_history(request), request)
+        with stage("cache"):
+            key, context, reply, tier = await lookup_cached_reply(conversation_history, content)
+        headers = cache_headers(tier) if key is not None else {}
 
-        session = boto3.Session(region_name='us-east-2', profile_name='test10')
+        if reply is None:
+            # Get unified response without blocking the event loop; concurrent
+            # requests for the same turn share one model call
+            turn = key or cache_key(BEDROCK_MODEL_ID, get_system_prompt(), conversation_history, content)
+            try:
+                reply, usage = await agent_runner.single_flight(
+                    turn, lambda: generate_reply(key, context, conversation_history, content), http_request
+                )
+            except AgentTimeoutError as e:
+                logger.error("Agent call timed out: %s", e)
+                raise HTTPException(status_code=504, detail=str(e))
+            except ClientDisconnectedError:
+                logger.info("Client disconnected, no longer waiting for the agent call")
+                return Response(status_code=499)
 
-        # Create the unified agent
-        bedrock_model = BedrockModel(
-            model="anthropic.claude-3-5-sonnet-20240620-v1:0",
-            temperature=0.1,
-            tools=[],
-            workflow=[],
-            boto_session=session
-        )
+            headers["X-Prompt-Cache-Read-Tokens"] = str(usage["read"])
+            headers["X-Prompt-Cache-Write-Tokens"] = str(usage["write"])
 
-        agent = Agent(
-            system_prompt=system_prompt,
-            model=bedrock_model,
-            messages=conversation_history
-        )
+        with stage("envelope"):
+            response = build_agent_reply(reply, payload)
+            if server_history:
+                response = save_server_history(response, payload, content)
+            return JSONBytesResponse(response, headers=headers)
 
-        # Get unified response
-        agent_response = agent(content)
-        
-        # Extract response - handle different Strands response formats
-        try:
-            if hasattr(agent_response, 'message') and agent_response.message:
-                ai_response = agent_response.message["content"][0]["text"]
-            elif hasattr(agent_response, 'messages') and agent_response.messages:
-                ai_response = agent_response.messages[-1].content
-            else:
-                ai_response = str(agent_response)
-        except (KeyError, IndexError, AttributeError) as e:
-            logger.warning("Response extraction error: %s", e)
-            ai_response = str(agent_response)
-            
-        logger.debug("AI Response: %s", ai_response)
-
-        # Clean and parse the JSON response
-        try:
-            cleaned_response = extract_json_from_response(ai_response)
-            
-            parsed_response = json.loads(cleaned_response)
-            response_content = parsed_response.get("content", "")
-            response_data = parsed_response.get("data", {})
-            
-            # Check if this is a command response
-            if "cmds" in response_data and response_data["cmds"]:
-                # It's a command response - return it for user approval
-                logger.info("Commands detected: %s", response_data["cmds"])
-                return Endpoint.success(
-                    content=response_content,
-                    cmds=response_data["cmds"],
-                    payload=payload
-                )
-            else:
-                # It's a general response - return the content
-                logger.info("General response - content: %s", response_content)
-                return Endpoint.success(
-                    content=response_content,
-                    payload=payload
-                )
-                
-        except json.JSONDecodeError as e:
-            logger.error("Failed to parse AI response: %s", e)
-            logger.debug("Raw response: %s", ai_response)
-            
-            # Fallback response
-            return Endpoint.success(
-                content="I apologize, but I encountered an error processing your request. Please try again.",
-                payload=payload
-            )
-        
+    except HTTPException:
+        raise
     except Exception as e:
         # Log error details
         error_details = traceback.format_exc()
-        logger.error("Exception occurred: %s", e)
-        logger.error("Full traceback:\n%s", error_details)
-        logger.debug("Original payload: %s", json.dumps(payload, indent=2) if payload else 'None')
+        logger.error("Exception occurred: %s", e, exc_info=True)
+        logger.error("Original payload: %s", preview(body))
         
         # Return error response
         raise HTTPException(status_code=500, detail=error_details)
-    
-def run_commands(commands):
-    executed_commands = []
-                
-    for command in commands:
-        command_text = command.get("command", "")
-        execute = command.get("execute", False)
-
-        if execute:
-            run_command_simple(executed_commands, command, command_text)
-        else:
-            executed_commands.append(command)
-            
-    return executed_commands
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+@app.post("/chat/stream")
+async def chat_stream(http_request: Request):
+    """
+    Streaming variant of /chat using server-sent events.
+
+    Emits "token" events with raw model text as it is generated and "content"
+    events with the decoded content field of the JSON reply, a "usage" event
+    with the prompt cache token counts of the model calls, and a final "done"
+    event holding the same envelope /chat would have returned.
+    """
+    start_request()
+    body = await http_request.body()
+    with stage("decode"):
+        payload = Endpoint.decode(body, http_request.headers.get(PROTOCOL_HEADER))
+    with stage("parse"):
+        request = Endpoint.parse(payload)
+    content = request.get("content", "")
+    cmds = request.get("cmds", [])
+    ticket = await admit_request(request)
+    key = context = cached = tier = None
+    try:
+        with stage("history"):
+            server_history = len(cmds) == 0 and load_server_history(request, payload)
+            if len(cmds) == 0:
+                conversation_history = await compact_conversation_history(get_conversation_history(request), request)
+        if len(cmds) == 0:
+            with stage("cache"):
+                key, context, cached, tier = await lookup_cached_reply(conversation_history, content)
+    except BaseException:
+        if ticket is not None:
+            ticket.release()
+        raise
+
+    async def events():
+        try:
+            if len(cmds) > 0:
+                logger.info("Executing commands: %s", preview(cmds), extra=PAYLOAD)
+                with stage("commands"):
+                    executed_commands = await run_commands(cmds)
+                yield sse_event("done", Endpoint.success(
+                    content="Command executed successfully",
+                    payload=payload,
+                    executed_cmds=executed_commands
+                ))
+                return
+
+            if cached is not None:
+                # Replay the cached reply as a single content event
+                yield sse_event("content", {"delta": cached.get("content", "")})
+                response = build_agent_reply(cached, payload)
+                if server_history:
+                    response = save_server_history(response, payload, content)
+                yield sse_event("done", response)
+                return
+
+            with stage("agent_setup"):
+                agent = create_agent(conversation_history)
+            content_streamer = ContentFieldStreamer()
+            json_scanner = JsonObjectScanner()
+            chunks = []
+            result = None
+            options = {}
+            if replies.structured_output_enabled():
+                options["structured_output_model"] = replies.AgentReply
+
+            metrics.agent_calls_in_flight.inc()
+            with stage("model"):
+                try:
+                    async for event in agent.stream_async(content, **options):
+                        if isinstance(event, dict) and "result" in event:
+                            result = event["result"]
+                        text = event.get("data") if isinstance(event, dict) else None
+                        if not text:
+                            continue
+                        chunks.append(text)
+                        yield sse_event("token", {"text": text})
+                        json_scanner.feed(text)
+
+                        delta = content_streamer.feed(text)
+                        if delta:
+                            yield sse_event("content", {"delta": delta})
+                except replies.StructuredOutputException as e:
+                    # Left to the repair step below, like an unparseable text reply
+                    logger.warning("Structured output failed: %s", e)
+                finally:
+                    metrics.agent_calls_in_flight.dec()
+
+            ai_response = "".join(chunks)
+            logger.debug("AI Response: %s", preview(ai_response), extra=PAYLOAD)
+            with stage("extract"):
+                if replies.structured_output_enabled():
+                    reply = replies.structured_reply(result)
+                else:
+                    reply = replies.parse_reply(ai_response, json_scanner)
+            reply = await replies.check_reply(reply, agent_runner, agent)
+            usage = report_model_usage(agent)
+            yield sse_event("usage", {"prompt_cache_read_tokens": usage["read"], "prompt_cache_write_tokens": usage["write"]})
+            with stage("cache"):
+                await store_cached_reply(key, context, content, reply)
+            with stage("envelope"):
+                response = build_agent_reply(reply, payload)
+                if server_history:
+                    response = save_server_history(response, payload, content)
+            yield sse_event("done", response)
+
+        except HTTPException as e:
+            # Status errors found after the stream started, such as a history conflict
+            yield sse_event("error", {"status": e.status_code, "detail": e.detail})
+        except Exception as e:
+            logger.error("Streaming chat failed: %s", e, exc_info=True)
+            yield sse_event("error", {"detail": str(e)})
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if key is not None:
+        headers.update(cache_headers(tier))
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers=headers,
+        # Also releases the slot if the client leaves before the stream starts
+        background=BackgroundTask(ticket.release) if ticket is not None else None,
+    )
+
+
+@app.get("/executions/{execution_id}")
+async def get_execution(execution_id: str):
+    """Return the state of a background command execution."""
+    execution = execution_manager.get(execution_id)
+    if execution is None:
+        raise HTTPException(status_code=404, detail="Execution not found")
+    return execution.status()
+
+
+@app.get("/executions/{execution_id}/stream")
+async def stream_execution(execution_id: str):
+    """
+    Stream a background command execution as server-sent events.
+
+    Emits "start", "stdout"/"stderr" (one per output line) and "exit" events
+    for each command, then a final "done" event with every return code.
+    """
+    execution = execution_manager.get(execution_id)
+    if execution is None:
+        raise HTTPException(status_code=404, detail="Execution not found")
+
+    async def events():
+        async for event in execution.follow():
+            yield sse_event(event["event"], event)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def start_execution(cmds, payload, ticket: Optional[Ticket] = None):
+    execution = execution_manager.start(cmds, run_one_command)
+    if ticket is not None:
+        execution.task.add_done_callback(lambda task: ticket.release())
+    logger.info("Started execution %s for commands: %s", execution.id, preview(cmds), extra=PAYLOAD)
+    response = Endpoint.success(
+        content="Command execution started",
+        payload=payload
+    )
+    response["data"]["execution_id"] = execution.id
+    response["data"]["stream_url"] = f"/executions/{execution.id}/stream"
+    return response
+
+
+async def run_one_command(executed_commands, command, on_output=None):
+    command_text = command.get("command", "")
+    execute = command.get("execute", False)
+
+    if execute:
+        with stage("command") as span:
+            succeeded = await run_command_simple_async(
+                executed_commands, command, command_text, timeout=COMMAND_TIMEOUT_SECONDS, on_output=on_output
+            )
+            span.set_attribute("command.succeeded", bool(succeeded))
+        return succeeded
+    executed_commands.append(command)
+    return True
+
+
+async def run_commands(commands):
+    return await run_command_batch(commands, run_one_command)
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8001,
-        reload=True,     # set True for auto-reload in dev
-        log_level="info",
-    )
\ No newline at end of file
+    # Development server with auto-reload; production runs serve.py
+    import serve
+    serve.main(["--dev"])
@@ -0,0 +1,189 @@
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple
+
+# Every metric, in definition order, for snapshot() and the Prometheus endpoint
+REGISTRY: List["Metric"] = []
+
+# Latency buckets in seconds, from sub-millisecond parsing up to long model calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Metric(ABC):
+    """
+    Base of the metric types: a name, a description and registration.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        """Return the (name, labels, value) samples to export."""
+
+
+class Gauge(Metric):
+    """
+    Thread-safe gauge for values that go up and down, such as in-flight calls.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str = ""):
+        super().__init__(name, description)
+        self._value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: int) -> None:
+        with self._lock:
+            self._value = value
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [(self.name, {}, self._value)]
+
+
+class Counter(Metric):
+    """
+    Thread-safe monotonically increasing counter.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str = ""):
+        super().__init__(name, description)
+        self._value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [(self.name, {}, self._value)]
+
+
+class Histogram(Metric):
+    """
+    Thread-safe histogram with fixed buckets, optionally split by one label.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str = "", label: str = "", buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.label = label
+        self.buckets = buckets
+        # label value -> (per-bucket counts, sum, count)
+        self._series: Dict[str, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, label_value: str = "") -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            counts, totals = series
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    @property
+    def value(self) -> int:
+        """Number of observations across every label value."""
+        with self._lock:
+            return sum(totals[1] for _, totals in self._series.values())
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        samples = []
+        with self._lock:
+            series = {key: (list(counts), list(totals)) for key, (counts, totals) in self._series.items()}
+        for label_value, (counts, (total, count)) in sorted(series.items()):
+            labels = {self.label: label_value} if self.label else {}
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                samples.append((self.name + "_bucket", {**labels, "le": le}, cumulative))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, count))
+        return samples
+
+
+agent_calls_in_flight = Gauge("agent_calls_in_flight", "Model calls currently running on the agent executor")
+agent_call_timeouts = Counter("agent_call_timeouts_total", "Model calls abandoned because they exceeded the timeout")
+agent_call_disconnects = Counter("agent_call_disconnects_total", "Model calls abandoned because the client went away")
+agent_calls_coalesced = Counter("agent_calls_coalesced_total", "Chat requests that shared an identical in-flight model call instead of making their own")
+agent_calls_shared_in_flight = Gauge("agent_calls_shared_in_flight", "Distinct model calls that concurrent chat requests can currently join")
+agent_replies = Counter("agent_replies_total", "Model replies checked against the reply schema")
+agent_reply_parse_failures = Counter("agent_reply_parse_failures_total", "Model replies that did not match the reply schema")
+agent_reply_repair_attempts = Counter("agent_reply_repair_attempts_total", "Repair prompts sent after a reply failed to parse")
+agent_reply_repairs = Counter("agent_reply_repairs_total", "Failed replies recovered by repair, sparing the user a retry")
+response_cache_hits = Counter("response_cache_hits_total", "Agent replies served from the response cache")
+response_cache_misses = Counter("response_cache_misses_total", "Response cache lookups that had to call the model")
+semantic_cache_entries = Gauge("semantic_cache_entries", "Replies held in the semantic cache")
+semantic_cache_hits = Counter("semantic_cache_hits_total", "Agent replies served from the semantic cache")
+semantic_cache_misses = Counter("semantic_cache_misses_total", "Semantic cache lookups with no prompt above the similarity threshold")
+semantic_cache_evictions = Counter("semantic_cache_evictions_total", "Replies evicted from the full semantic cache")
+history_compactions = Counter("history_compactions_total", "Requests whose history was cut down to the token budget")
+history_tokens_folded = Counter("history_tokens_folded_total", "Estimated history tokens left out of prompts by compaction")
+history_summary_updates = Counter("history_summary_updates_total", "Times a thread summary was built or extended")
+prompt_cache_read_tokens = Counter("prompt_cache_read_tokens_total", "Input tokens Bedrock served from its prompt cache")
+prompt_cache_write_tokens = Counter("prompt_cache_write_tokens_total", "Input tokens Bedrock wrote to its prompt cache")
+model_input_tokens = Counter("model_input_tokens_total", "Input tokens sent to Bedrock, outside the prompt cache")
+model_output_tokens = Counter("model_output_tokens_total", "Output tokens generated by Bedrock")
+admission_rate_limited = Counter("admission_rate_limited_total", "Chat requests refused with 429 for exceeding a tenant limit")
+admission_shed = Counter("admission_shed_total", "Chat requests refused with 503 because the server had no capacity in time")
+http_request_seconds = Histogram("http_request_seconds", "Time to handle an HTTP request, by route", label="route")
+chat_stage_seconds = Histogram("chat_stage_seconds", "Time spent in each stage of the chat pipeline", label="stage")
+
+
+def snapshot() -> dict:
+    """
+    Return the current value of every metric, keyed by metric name.
+
+    Histograms report their number of observations.
+    """
+    return {metric.name: metric.value for metric in REGISTRY}
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        key + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render_prometheus() -> str:
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,172 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+from logs import preview, PAYLOAD
+from metrics import agent_replies, agent_reply_parse_failures, agent_reply_repair_attempts, agent_reply_repairs
+from streaming import JsonObjectScanner
+from tracing import stage
+
+try:
+    from strands.types.exceptions import StructuredOutputException
+except ImportError:
+    # Strands releases without structured output never raise it
+    class StructuredOutputException(Exception):
+        pass
+
+logger = logging.getLogger(__name__)
+
+# How the agent returns its {content, data.cmds} reply: "json" relies on the
+# system prompt contract and parses the text, "structured" declares the schema
+# to the model as a structured-output tool so it returns validated arguments.
+AGENT_OUTPUT_MODE = os.environ.get("AGENT_OUTPUT_MODE", "json")
+# How many times a reply that does not match the schema is repaired by asking
+# the model again, before falling back to an apology.
+AGENT_REPAIR_ATTEMPTS = int(os.environ.get("AGENT_REPAIR_ATTEMPTS", "1"))
+
+REPAIR_PROMPT = (
+    "Your previous reply was not valid JSON in the required format. Reply again with only the JSON "
+    'object {"content": "...", "data": {...}} and nothing before or after it.'
+)
+
+
+class ProposedCommand(BaseModel):
+    """A shell command proposed to the user for approval."""
+    command: str = Field(description="The bash command to run")
+    execute: bool = Field(default=False, description="Always false; the user approves commands before they run")
+
+
+class ReplyData(BaseModel):
+    """Structured data attached to a reply."""
+    cmds: List[ProposedCommand] = Field(default_factory=list, description="Commands to propose, if the request needs any")
+
+
+class AgentReply(BaseModel):
+    """The reply to the user: an answer or description, plus any commands to propose."""
+    content: str = Field(description="The answer, or a description of the proposed commands")
+    data: ReplyData = Field(default_factory=ReplyData)
+
+
+def structured_output_enabled() -> bool:
+    return AGENT_OUTPUT_MODE == "structured"
+
+
+def get_agent_text(agent_response: Any) -> str:
+    """Extract the reply text, handling the different Strands response formats."""
+    try:
+        if hasattr(agent_response, 'message') and agent_response.message:
+            return agent_response.message["content"][0]["text"]
+        elif hasattr(agent_response, 'messages') and agent_response.messages:
+            return agent_response.messages[-1].content
+        else:
+            return str(agent_response)
+    except (KeyError, IndexError, AttributeError) as e:
+        logger.warning("Response extraction error: %s", e)
+        return str(agent_response)
+
+
+def parse_reply(ai_response: str, scanner: Optional[JsonObjectScanner] = None) -> Optional[Dict[str, Any]]:
+    """
+    Parse a text reply into the {content, data} dict, or None if it does not match the schema.
+
+    Args:
+        ai_response: The raw model text
+        scanner: A scanner that was already fed the streamed reply, if any
+    """
+    if scanner is None:
+        scanner = JsonObjectScanner()
+        scanner.feed(ai_response)
+    if not scanner.done:
+        return None
+    try:
+        AgentReply.model_validate(scanner.value)
+    except ValidationError as e:
+        logger.debug("Reply does not match the schema: %s", e)
+        return None
+    # Keep the reply as the model wrote it; validation only guarantees its shape
+    return scanner.value
+
+
+def structured_reply(agent_response: Any) -> Optional[Dict[str, Any]]:
+    """Return the validated structured output of an agent result as a dict, if it has one."""
+    reply = getattr(agent_response, "structured_output", None)
+    if reply is None:
+        return None
+    return reply.model_dump()
+
+
+async def _ask(runner: Any, agent: Any, prompt: str, http_request: Any) -> Optional[Dict[str, Any]]:
+    if structured_output_enabled():
+        try:
+            with stage("model"):
+                agent_response = await runner.invoke(agent, prompt, http_request, structured_output_model=AgentReply)
+        except StructuredOutputException as e:
+            # Raised once Strands' own forcing of the output tool has failed
+            logger.warning("Structured output failed: %s", e)
+            return None
+        with stage("extract"):
+            return structured_reply(agent_response)
+
+    with stage("model"):
+        agent_response = await runner.invoke(agent, prompt, http_request)
+    ai_response = get_agent_text(agent_response)
+    logger.debug("AI Response: %s", preview(ai_response), extra=PAYLOAD)
+    with stage("extract"):
+        return parse_reply(ai_response)
+
+
+async def repair_reply(runner: Any, agent: Any, http_request: Any = None) -> Optional[Dict[str, Any]]:
+    """
+    Ask the model again, up to AGENT_REPAIR_ATTEMPTS times, after a reply failed to parse.
+
+    The agent still holds the failed turn in its conversation, so the repair
+    prompt is short and the model only has to restate its answer.
+
+    Returns:
+        The repaired reply, or None if every attempt failed
+    """
+    for attempt in range(AGENT_REPAIR_ATTEMPTS):
+        agent_reply_repair_attempts.inc()
+        reply = await _ask(runner, agent, REPAIR_PROMPT, http_request)
+        if reply is not None:
+            agent_reply_repairs.inc()
+            logger.info("Reply repaired after %d attempt(s)", attempt + 1)
+            return reply
+    return None
+
+
+async def get_reply(runner: Any, agent: Any, content: str, http_request: Any = None) -> Optional[Dict[str, Any]]:
+    """
+    Ask the agent and return its reply as a {content, data} dict.
+
+    Args:
+        runner: The AgentRunner that executes the calls
+        agent: The Strands agent
+        content: The user prompt
+        http_request: The incoming request, used to detect client disconnects
+
+    Returns:
+        The reply, or None if it could not be parsed even after repair
+    """
+    return await check_reply(await _ask(runner, agent, content, http_request), runner, agent, http_request)
+
+
+async def check_reply(
+        reply: Optional[Dict[str, Any]],
+        runner: Any,
+        agent: Any,
+        http_request: Any = None,
+        ) -> Optional[Dict[str, Any]]:
+    """
+    Count a reply and repair it if it failed to parse.
+
+    Returns:
+        The reply, the repaired reply, or None if repair failed too
+    """
+    agent_replies.inc()
+    if reply is not None:
+        return reply
+    agent_reply_parse_failures.inc()
+    return await repair_reply(runner, agent, http_request)
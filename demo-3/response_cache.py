@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgspec
+
+from metrics import response_cache_hits, response_cache_misses
+
+# Which response cache to use: "none", "memory" (in-process only), or
+# "sqlite" / "redis" for an in-process tier in front of a shared one.
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "none")
+RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", "600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "response_cache.db")
+RESPONSE_CACHE_REDIS_URL = os.environ.get("RESPONSE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# How many writes the SQLite tier takes between pruning passes.
+SQLITE_PRUNE_INTERVAL = 100
+
+
+def cache_key(model_id: str, system_prompt: str, history: List[Dict[str, Any]], content: str) -> str:
+    """
+    Hash everything the model sees for a turn into a cache key.
+
+    Args:
+        model_id: The Bedrock model id
+        system_prompt: The agent system prompt
+        history: The conversation as returned by get_conversation_history
+        content: The user prompt
+
+    Returns:
+        A hex digest identifying the turn
+    """
+    # Whitespace differences do not change the answer, so they do not change the key
+    normalized = [
+        [message.get("role", ""), [block.get("text", "").strip() for block in message.get("content", [])]]
+        for message in history
+    ]
+    digest = hashlib.sha256()
+    digest.update(msgspec.json.encode([model_id, system_prompt, normalized, content.strip()]))
+    return digest.hexdigest()
+
+
+def is_cacheable(reply: Optional[Dict[str, Any]]) -> bool:
+    """
+    Whether a reply may be cached: it parsed, and it proposes no command that would run without approval.
+    """
+    if reply is None:
+        return False
+    data = reply.get("data") or {}
+    return not any(cmd.get("execute") for cmd in data.get("cmds") or [])
+
+
+class CacheTier(ABC):
+    """
+    One level of the response cache. Values are encoded replies.
+    """
+
+    name = ""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the value stored under key, or None."""
+
+    @abstractmethod
+    def set(self, key: str, value: bytes) -> None:
+        """Store value under key."""
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryCacheTier(CacheTier):
+    """
+    Process-local LRU bounded by entry count and total size, with a TTL per entry.
+    """
+
+    name = "memory"
+
+    def __init__(
+            self,
+            ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+            max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+            ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self.size += len(value)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, value = self._entries.pop(key)
+        self.size -= len(value)
+
+
+class SQLiteCacheTier(CacheTier):
+    """
+    Cache in a SQLite file, shared by all workers on a node and kept across restarts.
+    """
+
+    name = "sqlite"
+
+    def __init__(
+            self,
+            path: str = RESPONSE_CACHE_PATH,
+            ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+            max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+            ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value BLOB NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            self._writes += 1
+            if self._writes % SQLITE_PRUNE_INTERVAL == 0:
+                self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        # Drop expired entries, then the least recently used beyond the limit
+        self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM response_cache WHERE key IN ("
+            " SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisCacheTier(CacheTier):
+    """
+    Cache in Redis (or any server speaking its protocol), shared across nodes.
+
+    Requires the redis package. Expiry uses the server-side TTL; size-based
+    eviction is left to the server's maxmemory policy.
+    """
+
+    name = "redis"
+    prefix = "agent-reply:"
+
+    def __init__(self, url: str = RESPONSE_CACHE_REDIS_URL, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        import redis
+
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(self.prefix + key)
+
+    def set(self, key: str, value: bytes) -> None:
+        self._client.set(self.prefix + key, value, ex=max(int(self.ttl), 1))
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class ResponseCache:
+    """
+    Cache of parsed agent replies ({content, data}) keyed by cache_key().
+
+    Lookups try the in-process tier first and then the shared tier, if any;
+    a shared hit is copied into the in-process tier. Shared tiers do I/O, so
+    they run in a worker thread to keep the event loop free.
+    """
+
+    def __init__(self, memory: MemoryCacheTier, shared: Optional[CacheTier] = None):
+        self.memory = memory
+        self.shared = shared
+
+    async def get(self, key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Look up a reply.
+
+        Returns:
+            (reply, name of the tier that had it), or (None, None) on a miss
+        """
+        value = self.memory.get(key)
+        tier = self.memory.name
+        if value is None and self.shared is not None:
+            value = await asyncio.to_thread(self.shared.get, key)
+            tier = self.shared.name
+            if value is not None:
+                self.memory.set(key, value)
+
+        if value is None:
+            response_cache_misses.inc()
+            return None, None
+        response_cache_hits.inc()
+        return msgspec.json.decode(value), tier
+
+    async def set(self, key: str, reply: Optional[Dict[str, Any]]) -> bool:
+        """
+        Store a reply in every tier, unless it is not cacheable.
+
+        Returns:
+            Whether the reply was stored
+        """
+        if not is_cacheable(reply):
+            return False
+        value = msgspec.json.encode(reply)
+        self.memory.set(key, value)
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.set, key, value)
+        return True
+
+    def close(self) -> None:
+        self.memory.close()
+        if self.shared is not None:
+            self.shared.close()
+
+
+def create_response_cache(kind: str = RESPONSE_CACHE) -> Optional[ResponseCache]:
+    """
+    Build the configured response cache, or None when caching is disabled.
+    """
+    if kind == "memory":
+        return ResponseCache(MemoryCacheTier())
+    if kind == "sqlite":
+        return ResponseCache(MemoryCacheTier(), SQLiteCacheTier())
+    if kind == "redis":
+        return ResponseCache(MemoryCacheTier(), RedisCacheTier())
+    return None
+
+
+def cache_headers(tier: Optional[str]) -> Dict[str, str]:
+    """
+    Response headers reporting whether the reply came from the cache.
+    """
+    if tier is None:
+        return {"X-Cache": "MISS"}
+    return {"X-Cache": "HIT", "X-Cache-Tier": tier}
@@ -0,0 +1,269 @@
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metrics import semantic_cache_entries, semantic_cache_evictions, semantic_cache_hits, semantic_cache_misses
+
+# Opt-in near-duplicate cache: prompts worded slightly differently from one
+# that was already answered (in the same conversation context) reuse its reply.
+SEMANTIC_CACHE = os.environ.get("SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", "600"))
+# "lru" evicts the entry that was hit least recently, "fifo" the oldest one.
+SEMANTIC_CACHE_EVICTION = os.environ.get("SEMANTIC_CACHE_EVICTION", "lru")
+# "numpy" searches every entry; "hnsw" uses an approximate hnswlib index.
+SEMANTIC_CACHE_INDEX = os.environ.get("SEMANTIC_CACHE_INDEX", "numpy")
+SEMANTIC_CACHE_DIMENSIONS = int(os.environ.get("SEMANTIC_CACHE_DIMENSIONS", "1024"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+# Whole tokens such as 3, i-0abc123, 10.0.0.1 or web-app_v2 name the exact
+# resource or amount a prompt is about
+_TOKEN = re.compile(r"[a-z0-9][a-z0-9._:/@-]*")
+_IDENTIFIER = re.compile(r"[0-9._:/@-]")
+# Filler words that do not change what is being asked
+_STOP_WORDS = frozenset(
+    "a an the please can could would you i me my do does to of for in on this that is are".split()
+)
+
+# Neighbours fetched from the HNSW index, so that entries from other
+# conversation contexts can be skipped.
+HNSW_CANDIDATES = 8
+
+
+class HashingVectorizer:
+    """
+    Embed text on the CPU without a model: hashed word, word-pair and
+    character-trigram features (filler words dropped), signed to reduce
+    collisions and L2-normalised so that a dot product is the cosine similarity.
+    """
+
+    def __init__(self, dimensions: int = SEMANTIC_CACHE_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def features(self, text: str) -> List[str]:
+        words = [word for word in _WORD.findall(text.lower()) if word not in _STOP_WORDS]
+        features = [f"w:{word}" for word in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f" {word} "
+            features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for feature in self.features(text):
+            digest = zlib.crc32(feature.encode())
+            vector[digest % self.dimensions] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector
+
+
+class NumpyIndex:
+    """
+    Exact nearest-neighbour search by brute force over a preallocated matrix.
+    """
+
+    def __init__(self, capacity: int, dimensions: int):
+        self._vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self._contexts = np.zeros(capacity, dtype=np.int64)
+        self._used = np.zeros(capacity, dtype=bool)
+
+    def add(self, slot: int, vector: np.ndarray, context: int) -> None:
+        self._vectors[slot] = vector
+        self._contexts[slot] = context
+        self._used[slot] = True
+
+    def remove(self, slot: int) -> None:
+        self._used[slot] = False
+
+    def search(self, vector: np.ndarray, context: int) -> Tuple[Optional[int], float]:
+        scores = self._vectors @ vector
+        scores[~(self._used & (self._contexts == context))] = -1.0
+        slot = int(np.argmax(scores))
+        if scores[slot] < 0:
+            return None, 0.0
+        return slot, float(scores[slot])
+
+
+class HnswIndex:
+    """
+    Approximate nearest-neighbour search with hnswlib, for large caches.
+
+    Requires the hnswlib package.
+    """
+
+    def __init__(self, capacity: int, dimensions: int):
+        import hnswlib
+
+        self._index = hnswlib.Index(space="ip", dim=dimensions)
+        self._index.init_index(max_elements=capacity, ef_construction=100, M=16, allow_replace_deleted=True)
+        self._index.set_ef(32)
+        self._contexts = np.zeros(capacity, dtype=np.int64)
+        self._count = 0
+
+    def add(self, slot: int, vector: np.ndarray, context: int) -> None:
+        self._contexts[slot] = context
+        try:
+            self._index.unmark_deleted(slot)
+        except RuntimeError:
+            pass
+        self._index.add_items(vector.reshape(1, -1), np.array([slot]), replace_deleted=False)
+        self._count = self._index.get_current_count()
+
+    def remove(self, slot: int) -> None:
+        self._index.mark_deleted(slot)
+
+    def search(self, vector: np.ndarray, context: int) -> Tuple[Optional[int], float]:
+        if self._count == 0:
+            return None, 0.0
+        k = min(HNSW_CANDIDATES, self._count)
+        try:
+            labels, distances = self._index.knn_query(vector.reshape(1, -1), k=k)
+        except RuntimeError:
+            # Fewer live entries than k
+            return None, 0.0
+        for slot, distance in zip(labels[0], distances[0]):
+            if self._contexts[slot] == context:
+                # Inner-product space reports 1 - dot product
+                return int(slot), 1.0 - float(distance)
+        return None, 0.0
+
+
+def identifiers(text: str) -> Tuple[str, ...]:
+    """
+    The numbers and identifiers in a prompt, which must match exactly for a
+    semantic hit however similar the rest of the wording is.
+    """
+    tokens = (token.rstrip(".:/-") for token in _TOKEN.findall(text.lower()))
+    return tuple(sorted({token for token in tokens if _IDENTIFIER.search(token)}))
+
+
+def has_commands(reply: Dict[str, Any]) -> bool:
+    data = reply.get("data") if isinstance(reply, dict) else None
+    return isinstance(data, dict) and bool(data.get("cmds"))
+
+
+def context_id(context: str) -> int:
+    """Map a conversation context digest (hex) to the integer stored in the index."""
+    return int(context[:15], 16)
+
+
+class SemanticCache:
+    """
+    Cache of agent replies looked up by the similarity of the user prompt.
+
+    Entries are only matched within the same conversation context (model,
+    system prompt and history), so a paraphrased question is never answered
+    with a reply that was given in a different conversation.
+
+    Similar wording says nothing about which resource a prompt targets
+    ("terminate i-0abc123" and "terminate i-0abc124" score above 0.9), so a
+    hit also needs the same numbers and identifiers, and replies that
+    propose commands are never cached at all.
+    """
+
+    def __init__(
+            self,
+            threshold: float = SEMANTIC_CACHE_THRESHOLD,
+            max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+            ttl: float = SEMANTIC_CACHE_TTL_SECONDS,
+            eviction: str = SEMANTIC_CACHE_EVICTION,
+            index: str = SEMANTIC_CACHE_INDEX,
+            vectorizer: Optional[HashingVectorizer] = None,
+            ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.eviction = eviction
+        self.index_kind = index
+        self.vectorizer = vectorizer or HashingVectorizer()
+        index_class = HnswIndex if index == "hnsw" else NumpyIndex
+        self._index = index_class(max_entries, self.vectorizer.dimensions)
+        self._replies: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self._identifiers: List[Tuple[str, ...]] = [()] * max_entries
+        self._expires_at = np.zeros(max_entries)
+        # Per-slot age used by the eviction policy: insert time, refreshed on hit for LRU
+        self._touched_at = np.full(max_entries, np.inf)
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.max_entries - len(self._free)
+
+    def get(self, context: str, content: str) -> Tuple[Optional[Dict[str, Any]], float]:
+        """
+        Find the reply to the most similar earlier prompt in the same context.
+
+        Returns:
+            (reply, similarity), or (None, best similarity) when nothing is close enough
+        """
+        vector = self.vectorizer.embed(content)
+        with self._lock:
+            slot, similarity = self._index.search(vector, context_id(context))
+            if slot is not None and self._expires_at[slot] <= time.monotonic():
+                self._remove(slot)
+                slot = None
+            if slot is None or similarity < self.threshold or self._identifiers[slot] != identifiers(content):
+                semantic_cache_misses.inc()
+                return None, similarity
+            if self.eviction == "lru":
+                self._touched_at[slot] = time.monotonic()
+            semantic_cache_hits.inc()
+            return self._replies[slot], similarity
+
+    def set(self, context: str, content: str, reply: Dict[str, Any]) -> None:
+        """
+        Store the reply to a prompt, evicting an entry if the cache is full.
+        Replies that propose commands are not stored.
+        """
+        if has_commands(reply):
+            return
+        vector = self.vectorizer.embed(content)
+        now = time.monotonic()
+        with self._lock:
+            if not self._free:
+                self._remove(int(np.argmin(self._touched_at)))
+                semantic_cache_evictions.inc()
+            slot = self._free.pop()
+            self._index.add(slot, vector, context_id(context))
+            self._replies[slot] = reply
+            self._identifiers[slot] = identifiers(content)
+            self._expires_at[slot] = now + self.ttl
+            self._touched_at[slot] = now
+            semantic_cache_entries.set(len(self))
+
+    def _remove(self, slot: int) -> None:
+        self._index.remove(slot)
+        self._replies[slot] = None
+        self._touched_at[slot] = np.inf
+        self._free.append(slot)
+        semantic_cache_entries.set(len(self))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Describe the cache for monitoring: size, limits, policy and hit rate.
+        """
+        lookups = semantic_cache_hits.value + semantic_cache_misses.value
+        return {
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "index": self.index_kind,
+            "eviction": self.eviction,
+            "threshold": self.threshold,
+            "hit_rate": semantic_cache_hits.value / lookups if lookups else 0.0,
+        }
+
+
+def create_semantic_cache(enabled: bool = SEMANTIC_CACHE) -> Optional[SemanticCache]:
+    """
+    Build the semantic cache, or None when it is disabled.
+    """
+    return SemanticCache() if enabled else None
@@ -0,0 +1,139 @@
+"""
+Production launcher for the workshop API.
+
+Runs main:app under uvicorn with one worker process per available CPU, uvloop
+and httptools when they are installed, and tuned keep-alive and listen
+backlog. On SIGTERM / SIGINT each worker stops accepting connections, lets
+in-flight requests finish for up to the graceful shutdown timeout, and then
+runs the app's lifespan shutdown, which drains agent calls and command
+executions where the app has them.
+
+Workers do not share memory, and a load balancer may send each request of a
+conversation to a different one. Running more than one worker therefore
+needs the app's per-process state turned off or moved to a shared backend:
+THREAD_STORE=sqlite (or none) instead of memory, and
+BACKGROUND_EXECUTIONS=false, because /executions/{id} only works on the
+worker that started the execution. By default the launcher starts one worker
+per CPU when that holds and a single worker otherwise. It refuses to start
+several workers while such state is enabled.
+
+Usage:
+    python serve.py [--host 0.0.0.0] [--port 8001] [--workers N] [--dev]
+"""
+import argparse
+import importlib.util
+import math
+import os
+from typing import List, Optional
+
+import uvicorn
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", "8001"))
+# Worker processes; 0 uses the number of CPUs available to the container, or
+# a single worker while the app keeps per-process state.
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "0"))
+# Longer than the 60 s idle timeout of common load balancers, so the balancer
+# closes idle connections first and never sends to one the server just closed.
+SERVER_KEEP_ALIVE_SECONDS = int(os.environ.get("SERVER_KEEP_ALIVE_SECONDS", "75"))
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", "2048"))
+SERVER_GRACEFUL_SHUTDOWN_SECONDS = int(os.environ.get("SERVER_GRACEFUL_SHUTDOWN_SECONDS", "30"))
+SERVER_LOG_LEVEL = os.environ.get("SERVER_LOG_LEVEL", "info")
+# Per-request access lines cost more than they tell at production volume
+SERVER_ACCESS_LOG = os.environ.get("SERVER_ACCESS_LOG", "false").lower() in ("1", "true", "yes")
+
+APP = "main:app"
+CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+
+
+def available_cpus() -> int:
+    """
+    Count the CPUs this process may use: its CPU affinity, capped by the
+    container's cgroup v2 CPU quota when one is set.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open(CGROUP_CPU_MAX) as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def enabled(name: str, default: str) -> bool:
+    return os.environ.get(name, default).lower() in ("1", "true", "yes")
+
+
+def per_process_state() -> List[str]:
+    """
+    List the app state that lives in a single worker process as configured,
+    which breaks requests that reach a different worker.
+    """
+    state = []
+    if installed("thread_store") and os.environ.get("THREAD_STORE", "memory") == "memory":
+        state.append("THREAD_STORE=memory keeps conversation history per worker (use sqlite)")
+    if installed("executions") and enabled("BACKGROUND_EXECUTIONS", "true"):
+        state.append("background executions are only visible on the worker that started them "
+                     "(set BACKGROUND_EXECUTIONS=false)")
+    return state
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="worker processes (default: one per available CPU, or one while "
+                             "the app keeps per-process state)")
+    parser.add_argument("--keep-alive", type=int, default=SERVER_KEEP_ALIVE_SECONDS,
+                        help="seconds to keep idle connections open")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG,
+                        help="maximum queued connections waiting to be accepted")
+    parser.add_argument("--graceful-shutdown", type=int, default=SERVER_GRACEFUL_SHUTDOWN_SECONDS,
+                        help="seconds to let in-flight requests finish on shutdown")
+    parser.add_argument("--log-level", default=SERVER_LOG_LEVEL)
+    parser.add_argument("--dev", action="store_true",
+                        help="single process with auto-reload on code changes")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+
+    if args.dev:
+        uvicorn.run(APP, host=args.host, port=args.port, reload=True, log_level=args.log_level)
+        return
+
+    state = per_process_state()
+    if args.workers > 1 and state:
+        raise SystemExit(f"[SERVE] Refusing to start {args.workers} workers: " + "; ".join(state))
+    workers = args.workers or (1 if state else available_cpus())
+    loop = "uvloop" if installed("uvloop") else "asyncio"
+    http = "httptools" if installed("httptools") else "h11"
+    print(f"[SERVE] Starting {workers} worker(s) on {args.host}:{args.port} (loop={loop}, http={http})")
+    uvicorn.run(
+        APP,
+        host=args.host,
+        port=args.port,
+        workers=workers,
+        loop=loop,
+        http=http,
+        backlog=args.backlog,
+        timeout_keep_alive=args.keep_alive,
+        timeout_graceful_shutdown=args.graceful_shutdown,
+        log_level=args.log_level,
+        access_log=SERVER_ACCESS_LOG,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+import json
+import re
+from typing import Any, List, Optional
+
+from utils import encode_json
+
+
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+# Characters that matter while scanning a JSON object, inside and outside strings
+_STRUCTURAL = re.compile(r'[{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+def sse_event(event: str, data: Any) -> str:
+    """
+    Format a single server-sent event.
+
+    Args:
+        event: The event name
+        data: JSON-serialisable event payload
+
+    Returns:
+        The encoded event, terminated by a blank line
+    """
+    return f"event: {event}\ndata: {encode_json(data).decode()}\n\n"
+
+
+class ContentFieldStreamer:
+    """
+    Incrementally decode the top-level "content" string of a streamed JSON reply.
+
+    The agent answers with {"content": "...", "data": {...}}. Feeding the raw
+    model tokens to this parser yields the decoded characters of the content
+    field as soon as they arrive, so the client can render the answer long
+    before the whole object (and its commands) has been generated. Text before
+    the opening brace, such as prose or a code fence, is ignored.
+    """
+
+    def __init__(self, field: str = "content"):
+        self.field = field
+        self.depth = 0
+        self.in_string = False
+        self.escape = ""
+        # A \uXXXX high surrogate waiting for the low half of its pair
+        self.high_surrogate = ""
+        self.expect_key = False
+        self.key: Optional[str] = None
+        self.current = []
+        self.capturing = False
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Consume the next chunk of model output.
+
+        Args:
+            chunk: The next piece of raw model text
+
+        Returns:
+            The newly decoded characters of the content field (possibly empty)
+        """
+        emitted = []
+        for ch in chunk:
+            if self.in_string:
+                if self.escape:
+                    self.escape += ch
+                    decoded = self._decode_escape()
+                    if decoded is None:
+                        continue
+                    self.escape = ""
+                    self._decoded_char(decoded, emitted)
+                elif ch == "\\":
+                    self.escape = "\\"
+                elif ch == '"':
+                    self._end_string(emitted)
+                else:
+                    self._decoded_char(ch, emitted)
+                continue
+
+            if ch == '"':
+                if self.depth == 0:
+                    continue
+                self.in_string = True
+                self.current = []
+                self.capturing = (
+                    not self.done
+                    and self.depth == 1
+                    and not self.expect_key
+                    and self.key == self.field
+                )
+            elif ch in "{[":
+                self.depth += 1
+                self.expect_key = ch == "{"
+            elif ch in "}]":
+                self.depth = max(self.depth - 1, 0)
+                self.expect_key = False
+            elif ch == ",":
+                self.expect_key = self.depth == 1 or self.expect_key
+                if self.depth == 1:
+                    self.key = None
+            elif ch == ":":
+                self.expect_key = False
+
+        return "".join(emitted)
+
+    def _decode_escape(self) -> Optional[str]:
+        # self.escape holds the backslash plus the characters read so far
+        kind = self.escape[1]
+        if kind == "u":
+            if len(self.escape) < 6:
+                return None
+            try:
+                return chr(int(self.escape[2:6], 16))
+            except ValueError:
+                return ""
+        return _ESCAPES.get(kind, kind)
+
+    def _decoded_char(self, ch: str, emitted: list) -> None:
+        # JSON escapes characters outside the BMP, such as emoji, as a pair of
+        # \uXXXX surrogates, which may arrive in different chunks. Join the
+        # pair; a lone surrogate cannot be encoded as UTF-8, so it becomes U+FFFD.
+        if not ch:
+            return
+        code = ord(ch)
+        if self.high_surrogate:
+            high = ord(self.high_surrogate)
+            self.high_surrogate = ""
+            if 0xDC00 <= code <= 0xDFFF:
+                self._string_char(chr(0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00)), emitted)
+                return
+            self._string_char("\ufffd", emitted)
+        if 0xD800 <= code <= 0xDBFF:
+            self.high_surrogate = ch
+        elif 0xDC00 <= code <= 0xDFFF:
+            self._string_char("\ufffd", emitted)
+        else:
+            self._string_char(ch, emitted)
+
+    def _string_char(self, ch: str, emitted: list) -> None:
+        if self.capturing:
+            emitted.append(ch)
+        elif self.depth == 1 and self.expect_key:
+            self.current.append(ch)
+
+    def _end_string(self, emitted: list) -> None:
+        if self.high_surrogate:
+            self.high_surrogate = ""
+            self._string_char("\ufffd", emitted)
+        self.in_string = False
+        if self.capturing:
+            self.capturing = False
+            self.done = True
+        elif self.depth == 1 and self.expect_key:
+            self.key = "".join(self.current)
+            self.expect_key = False
+        self.current = []
+
+
+class JsonObjectScanner:
+    """
+    Find the first complete JSON object in model output, in a single pass.
+
+    The scanner tracks brace depth and skips over string literals (including
+    escaped quotes), so nested objects such as data.cmds and braces inside
+    strings are handled correctly. Text around the object (prose, code fences)
+    is ignored. Output can be fed in chunks as it streams; a balanced object
+    that is not valid JSON is discarded and scanning resumes after it, so the
+    total work stays linear in the length of the text.
+    """
+
+    def __init__(self):
+        self.text: Optional[str] = None
+        self.value: Any = None
+        self._parts: List[str] = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def done(self) -> bool:
+        return self.text is not None
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """
+        Consume the next chunk of model output.
+
+        Args:
+            chunk: The next piece of raw model text
+
+        Returns:
+            The text of the first valid JSON object once it is complete, otherwise None
+        """
+        if self.done:
+            return self.text
+
+        pos = 0
+        end = len(chunk)
+        # Start of the current object within this chunk
+        segment = 0
+        while pos < end:
+            if self._depth == 0:
+                pos = chunk.find("{", pos)
+                if pos < 0:
+                    return None
+                segment = pos
+                self._parts = []
+                self._depth = 1
+                pos += 1
+            elif self._escape:
+                self._escape = False
+                pos += 1
+            elif self._in_string:
+                match = _STRING_SPECIAL.search(chunk, pos)
+                if match is None:
+                    pos = end
+                elif match.group() == "\\":
+                    pos = match.end() + 1
+                    self._escape = pos > end
+                else:
+                    self._in_string = False
+                    pos = match.end()
+            else:
+                match = _STRUCTURAL.search(chunk, pos)
+                if match is None:
+                    pos = end
+                    continue
+                char = match.group()
+                pos = match.end()
+                if char == '"':
+                    self._in_string = True
+                elif char == "{":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0 and self._accept("".join(self._parts) + chunk[segment:pos]):
+                        return self.text
+
+        if self._depth > 0:
+            self._parts.append(chunk[segment:])
+        return None
+
+    def _accept(self, candidate: str) -> bool:
+        self._parts = []
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            return False
+        self.text = candidate
+        self.value = value
+        return True
@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+from typing import Any, AsyncIterator, Dict, List
+
+import pytest
+from strands.models.model import Model
+
+# The demo's modules live next to this directory and are imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubModel(Model):
+    """
+    A Strands model that answers every turn with the same JSON reply and
+    counts its calls, so the app can be tested without Bedrock.
+    """
+
+    def __init__(self, reply: Dict[str, Any]):
+        self.reply = reply
+        self.calls = 0
+        self.seen: List[List[Dict[str, Any]]] = []
+
+    def update_config(self, **model_config: Any) -> None:
+        pass
+
+    def get_config(self) -> Any:
+        return {}
+
+    async def structured_output(self, output_model, prompt, system_prompt=None, **kwargs):
+        raise NotImplementedError
+        yield
+
+    async def stream(self, messages, tool_specs=None, system_prompt=None, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        self.calls += 1
+        self.seen.append(list(messages))
+        yield {"messageStart": {"role": "assistant"}}
+        yield {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": json.dumps(self.reply)}}}
+        yield {"contentBlockStop": {"contentBlockIndex": 0}}
+        yield {"messageStop": {"stopReason": "end_turn"}}
+        yield {"metadata": {"usage": {"inputTokens": 10, "outputTokens": 10, "totalTokens": 20}, "metrics": {"latencyMs": 1}}}
+
+
+@pytest.fixture(scope="session")
+def app_client():
+    """A client for main.app. The lifespan shuts the agent runner down, so it runs once per session."""
+    from fastapi.testclient import TestClient
+
+    import main
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+@pytest.fixture
+def stub_model(monkeypatch):
+    """Route main's agents to a StubModel."""
+    import main
+
+    model = StubModel({"content": "A security group is a virtual firewall.", "data": {}})
+    monkeypatch.setattr(main, "get_bedrock_model", lambda **kwargs: model)
+    return model
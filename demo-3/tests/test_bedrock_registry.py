@@ -0,0 +1,26 @@
+import boto3
+
+from utils import BedrockRegistry
+
+
+def test_models_share_one_client_per_region(monkeypatch):
+    built = []
+    real_client = boto3.Session.client
+
+    def counting_client(self, *args, **kwargs):
+        client = real_client(self, *args, **kwargs)
+        built.append(client)
+        return client
+
+    monkeypatch.setattr(boto3.Session, "client", counting_client)
+    registry = BedrockRegistry()
+    sonnet = registry.get_model("anthropic.claude-3-5-sonnet-20240620-v1:0", 0.1, "us-east-1", None)
+    haiku = registry.get_model("anthropic.claude-3-5-haiku-20241022-v1:0", 0.1, "us-east-1", None)
+    other_region = registry.get_model("anthropic.claude-3-5-sonnet-20240620-v1:0", 0.1, "us-west-2", None)
+
+    assert registry.get_model("anthropic.claude-3-5-sonnet-20240620-v1:0", 0.1, "us-east-1", None) is sonnet
+    assert sonnet.client is haiku.client
+    assert other_region.client.meta.region_name == "us-west-2"
+    assert built == [sonnet.client, other_region.client]
+    assert "strands-agents" in sonnet.client.meta.config.user_agent_extra
+    registry.close()
@@ -0,0 +1,40 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client(app_client, monkeypatch):
+    monkeypatch.setattr(main, "admission", None)
+    return app_client
+
+
+def run_v1(client, cmds):
+    response = client.post("/chat", json={"content": "", "pastMessages": [], "data": {"Cmds": cmds}})
+    assert response.status_code == 200
+    return [cmd["Output"] for cmd in response.json()["data"]["executedCmds"]]
+
+
+def test_v1_command_waits_for_its_dependency(client, tmp_path):
+    marker = tmp_path / "marker"
+    outputs = run_v1(client, [
+        {"Command": f"cat {marker}", "execute": True, "depends_on": ["write"]},
+        {"Command": f"sleep 0.2 && echo ready > {marker}", "execute": True, "id": "write"},
+    ])
+    # A dependency must come earlier in the batch
+    assert outputs[0].startswith("Error: unknown or later dependency")
+
+    outputs = run_v1(client, [
+        {"Command": f"sleep 0.2 && echo ready > {marker}", "execute": True, "id": "write"},
+        {"Command": f"cat {marker}", "execute": True, "depends_on": ["write"]},
+        {"Command": f"cat {marker}", "execute": True, "depends_on": [0]},
+    ])
+    assert outputs[1:] == ["ready\n", "ready\n"]
+
+
+def test_v1_command_is_skipped_when_its_dependency_fails(client):
+    outputs = run_v1(client, [
+        {"Command": "exit 1", "execute": True, "id": "check"},
+        {"Command": "echo ran", "execute": True, "depends_on": ["check"]},
+    ])
+    assert outputs[1] == "Skipped: dependency 'check' failed"
@@ -0,0 +1,37 @@
+import json
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client(app_client, monkeypatch):
+    monkeypatch.setattr(main, "admission", None)
+    return app_client
+
+
+def parse_events(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        name, data = block.split("\n")
+        events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def test_background_execution_is_streamed(client):
+    response = client.post("/chat", json={
+        "content": "",
+        "stream_execution": True,
+        "data": {"Cmds": [{"Command": "echo one; echo two >&2", "execute": True}]},
+    })
+    assert response.status_code == 200
+    execution_id = response.json()["data"]["execution_id"]
+
+    events = parse_events(client.get(f"/executions/{execution_id}/stream").text)
+    names = [name for name, _ in events]
+    assert names[0] == "start" and names[-1] == "done"
+    assert ("stdout", "one") in [(name, data.get("line")) for name, data in events]
+    # The payload repeats the event name, as /executions clients expect
+    assert all(data["event"] == name for name, data in events)
+    assert client.get(f"/executions/{execution_id}").json()["state"] == "finished"
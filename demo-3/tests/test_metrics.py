@@ -0,0 +1,31 @@
+import pytest
+
+import metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.chat_stage_seconds
+    before = histogram.value
+    histogram.observe(0.003, "test")
+    histogram.observe(7, "test")
+    samples = {(name, labels.get("le")): value for name, labels, value in histogram.samples() if labels.get("stage") == "test"}
+    assert samples[("chat_stage_seconds_bucket", "0.005")] == 1
+    assert samples[("chat_stage_seconds_bucket", "+Inf")] == 2
+    assert samples[("chat_stage_seconds_count", None)] == 2
+    assert histogram.value == before + 2
+
+
+def test_every_metric_is_rendered():
+    text = metrics.render_prometheus()
+    for metric in metrics.REGISTRY:
+        assert f"# TYPE {metric.name} {metric.kind}\n" in text
+
+
+def test_incomplete_metric_fails_when_created():
+    class Untyped(metrics.Metric):
+        pass
+
+    registered = len(metrics.REGISTRY)
+    with pytest.raises(TypeError):
+        Untyped("untyped")
+    assert len(metrics.REGISTRY) == registered
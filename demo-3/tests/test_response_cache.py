@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from response_cache import CacheTier, MemoryCacheTier, ResponseCache, SQLiteCacheTier
+
+REPLY = {"content": "Git tracks changes in source code.", "data": {}}
+
+
+def test_shared_hit_is_copied_into_memory(tmp_path):
+    shared = SQLiteCacheTier(str(tmp_path / "cache.db"))
+    asyncio.run(ResponseCache(MemoryCacheTier(), shared).set("key", REPLY))
+
+    cache = ResponseCache(MemoryCacheTier(), shared)
+    assert asyncio.run(cache.get("key")) == (REPLY, shared.name)
+    assert asyncio.run(cache.get("key")) == (REPLY, cache.memory.name)
+    cache.close()
+
+
+def test_replies_that_execute_commands_are_not_cached():
+    cache = ResponseCache(MemoryCacheTier())
+    reply = {"content": "Deleting", "data": {"cmds": [{"command": "rm -rf build", "execute": True}]}}
+    assert asyncio.run(cache.set("key", reply)) is False
+    assert asyncio.run(cache.get("key")) == (None, None)
+
+
+def test_incomplete_tier_fails_when_created():
+    class ReadOnlyTier(CacheTier):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        ReadOnlyTier()
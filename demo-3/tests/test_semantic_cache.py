@@ -0,0 +1,80 @@
+import pytest
+
+import main
+from semantic_cache import SemanticCache
+
+
+@pytest.fixture
+def client(app_client, monkeypatch, stub_model):
+    monkeypatch.setattr(main, "response_cache", None)
+    monkeypatch.setattr(main, "semantic_cache", SemanticCache(max_entries=8))
+    monkeypatch.setattr(main, "admission", None)
+    return app_client
+
+
+CONTEXT = "0" * 64
+
+# (cached prompt, new prompt, whether the new prompt may reuse the reply)
+PAIRS = [
+    ("terminate ec2 instance i-0abc123", "terminate ec2 instance i-0abc124", False),
+    ("delete pod web-7d9f in namespace prod", "delete pod web-7d9g in namespace prod", False),
+    ("scale the web deployment to 3 replicas", "scale the web deployment to 5 replicas", False),
+    ("what is the status of instance i-0abc123", "what is the status of the instance i-0abc123?", True),
+    ("can you explain what a security group is", "explain what a security group is", True),
+]
+
+
+@pytest.mark.parametrize("cached, prompt, may_hit", PAIRS)
+def test_hits_require_the_same_targets(cached, prompt, may_hit):
+    cache = SemanticCache(max_entries=8)
+    cache.set(CONTEXT, cached, {"content": f"About: {cached}", "data": {}})
+    reply, similarity = cache.get(CONTEXT, prompt)
+    assert (reply is not None) == may_hit, similarity
+
+
+def test_replies_with_commands_are_never_served():
+    cache = SemanticCache(max_entries=8)
+    command = {"content": "Terminate it", "data": {"cmds": [{"command": "aws ec2 terminate-instances", "execute": True}]}}
+    cache.set(CONTEXT, "terminate ec2 instance i-0abc123", command)
+    assert cache.get(CONTEXT, "terminate ec2 instance i-0abc123")[0] is None
+
+
+def chat(client, content, past_messages=()):
+    response = client.post("/chat", json={"content": content, "pastMessages": list(past_messages)})
+    assert response.status_code == 200
+    return response
+
+
+def test_repeated_prompt_is_served_from_the_semantic_cache(client, stub_model):
+    assert chat(client, "explain what a security group is").headers["X-Cache"] == "MISS"
+    second = chat(client, "explain what a security group is")
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.headers["X-Cache-Tier"] == "semantic"
+    assert chat(client, "can you explain what a security group is").headers["X-Cache"] == "HIT"
+    assert stub_model.calls == 1
+
+
+def test_history_scopes_the_semantic_cache(client, stub_model):
+    past = [
+        {"userMsg": {"content": "hello"}},
+        {"agentResponse": {"content": "Hi, how can I help?"}},
+    ]
+    assert chat(client, "explain what a security group is", past).headers["X-Cache"] == "MISS"
+    assert chat(client, "explain what a security group is", past).headers["X-Cache"] == "HIT"
+    assert chat(client, "explain what a security group is").headers["X-Cache"] == "MISS"
+    assert stub_model.calls == 2
+
+
+def test_agent_does_not_modify_the_request_history(stub_model):
+    history = [{"role": "user", "content": [{"text": "hello"}]}, {"role": "assistant", "content": [{"text": "Hi"}]}]
+    agent = main.create_agent(history)
+    agent("explain what a security group is")
+    assert len(history) == 2
+
+
+def test_streamed_reply_is_cached_for_the_next_turn(client, stub_model):
+    response = client.post("/chat/stream", json={"content": "explain what a security group is", "pastMessages": []})
+    assert response.status_code == 200
+    assert "event: done" in response.text
+    assert chat(client, "explain what a security group is").headers["X-Cache"] == "HIT"
+    assert stub_model.calls == 1
@@ -0,0 +1,120 @@
+import json
+import random
+
+import pytest
+
+from main import extract_json_from_response
+from streaming import ContentFieldStreamer, JsonObjectScanner, sse_event
+
+LIST_FILES = {"content": "Command to list directory contents", "data": {"cmds": [{"command": "ls -la", "execute": False}]}}
+GIT = {"content": "Git is a distributed version control system for tracking changes in source code.", "data": {}}
+NESTED = {
+    "content": "Here are the commands to inspect the cluster",
+    "data": {"cmds": [
+        {"command": "kubectl get pods -n default", "execute": False},
+        {"command": "kubectl describe deploy web", "execute": False, "files": [{"file_path": "a.yaml", "file_content": "x: {y: 1}"}]},
+    ]},
+}
+BRACES_IN_STRINGS = {
+    "content": "Use awk '{print $1}' to print the first column, and \"quote\" paths with \\ escapes",
+    "data": {"cmds": [{"command": "awk '{print $1}' file.txt | sed 's/}/]/g'", "execute": False}]},
+}
+EMOJI = {"content": "Deployed \U0001F600 to prod é", "data": {}}
+
+# (reply text as the model produces it, expected object)
+CORPUS = [
+    (json.dumps(LIST_FILES), LIST_FILES),
+    (json.dumps(GIT), GIT),
+    ("```json\n" + json.dumps(NESTED, indent=2) + "\n```", NESTED),
+    ("```\n" + json.dumps(LIST_FILES) + "\n```", LIST_FILES),
+    ("Sure! Here is the response:\n\n" + json.dumps(NESTED), NESTED),
+    (json.dumps(NESTED) + "\n\nLet me know if you need anything else.", NESTED),
+    ("I'll use {braces} in prose first. " + json.dumps(LIST_FILES) + " Done {ok}", LIST_FILES),
+    (json.dumps(BRACES_IN_STRINGS), BRACES_IN_STRINGS),
+    ("Answer:\n```json\n" + json.dumps(BRACES_IN_STRINGS, indent=4) + "\n```\n", BRACES_IN_STRINGS),
+    (json.dumps({"content": "Unicode é中\U0001F600 and \\u escapes", "data": {}}, ensure_ascii=False),
+     {"content": "Unicode é中\U0001F600 and \\u escapes", "data": {}}),
+    (json.dumps(GIT) + json.dumps(LIST_FILES), GIT),
+    # ASCII-only JSON escapes the emoji as the surrogate pair \ud83d\ude00
+    (json.dumps(EMOJI), EMOJI),
+]
+
+
+@pytest.mark.parametrize("text, expected", CORPUS)
+def test_reply_is_extracted(text, expected):
+    assert json.loads(extract_json_from_response(text)) == expected
+
+
+@pytest.mark.parametrize("text, expected", CORPUS)
+@pytest.mark.parametrize("size", range(1, 9))
+def test_content_field_is_streamed(text, expected, size):
+    # Every chunk size splits the escapes somewhere, including between the two halves of a pair
+    streamer = ContentFieldStreamer()
+    deltas = [streamer.feed(text[i:i + size]) for i in range(0, len(text), size)]
+    assert "".join(deltas) == expected["content"]
+    for delta in deltas:
+        sse_event("content", {"delta": delta})
+
+
+def test_lone_surrogate_is_replaced():
+    streamer = ContentFieldStreamer()
+    assert streamer.feed('{"content": "a \\ud83d b \\ude00"}') == "a \ufffd b \ufffd"
+
+
+def random_string(rng):
+    alphabet = 'abc xyz{}[]":,\\/\n\té中'
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+
+
+def random_value(rng, depth):
+    kind = rng.randint(0, 6 if depth < 4 else 3)
+    if kind == 0:
+        return random_string(rng)
+    if kind == 1:
+        return rng.randint(-1000, 1000)
+    if kind == 2:
+        return rng.choice([True, False, None])
+    if kind == 3:
+        return rng.random()
+    if kind == 4:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return random_object(rng, depth + 1)
+
+
+def random_object(rng, depth=0):
+    return {random_string(rng): random_value(rng, depth) for _ in range(rng.randint(0, 5))}
+
+
+def random_noise(rng):
+    # Prose and fences around the reply; braces here never form valid JSON
+    return rng.choice(["", "Sure!\n", "```json\n", "\n```", " {note} ", "Here {you go: ", "}}", "text \"with quotes\" "])
+
+
+def random_chunks(rng, text):
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 16)
+        yield text[pos:pos + size]
+        pos += size
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_scanner_agrees_chunked_and_whole(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        expected = random_object(rng)
+        encoded = json.dumps(expected, ensure_ascii=rng.random() < 0.5, indent=rng.choice([None, 2]))
+        prefix = random_noise(rng)
+        # Unbalanced braces before the reply would swallow it, so only balanced noise goes first
+        if prefix.count("{") != prefix.count("}"):
+            prefix = ""
+        text = prefix + encoded + random_noise(rng)
+
+        one_shot = JsonObjectScanner()
+        one_shot.feed(text)
+        chunked = JsonObjectScanner()
+        for chunk in random_chunks(rng, text):
+            chunked.feed(chunk)
+
+        assert one_shot.value == expected, text
+        assert chunked.text == one_shot.text, text
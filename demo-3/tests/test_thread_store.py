@@ -0,0 +1,55 @@
+import msgspec
+import pytest
+
+from thread_store import HistoryVersionConflict, InMemoryThreadStore, SQLiteThreadStore, ThreadStore, load_history, record_turn
+from utils import ChatRequestV1
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    store = InMemoryThreadStore() if request.param == "memory" else SQLiteThreadStore(str(tmp_path / "threads.db"))
+    yield store
+    store.close()
+
+
+def entry(i):
+    return {"userMsg": {"content": f"question {i}"}}
+
+
+def turn(past_messages, version):
+    return msgspec.json.decode(
+        msgspec.json.encode({"content": "next", "pastMessages": past_messages, "thread_id": "t", "history_version": version}),
+        type=ChatRequestV1,
+    )
+
+
+def test_append_is_a_compare_and_set(store):
+    assert store.append("", "t", [entry(0)], expected_version=0) == 1
+    with pytest.raises(HistoryVersionConflict) as conflict:
+        store.append("", "t", [entry(1)], expected_version=0)
+    assert conflict.value.current_version == 1
+    assert store.get("", "t") == (1, [entry(0)])
+
+
+def test_client_ahead_of_the_store_resyncs_it(store):
+    store.append("", "t", [entry(0)])
+    past = [entry(0), entry(1), entry(2)]
+    assert load_history(store, turn(past, 3)) == (3, past)
+    assert store.get("", "t")[0] == 3
+
+
+def test_concurrent_turns_on_one_thread_conflict(store):
+    payload = turn([], 0)
+    load_history(store, payload)
+    assert record_turn(store, payload, "first", "reply")[0] == 2
+    with pytest.raises(HistoryVersionConflict):
+        record_turn(store, payload, "second", "reply")
+
+
+def test_incomplete_backend_fails_when_created():
+    class GetOnlyStore(ThreadStore):
+        def get(self, tenant_id, thread_id):
+            return 0, []
+
+    with pytest.raises(TypeError):
+        GetOnlyStore()
@@ -0,0 +1,289 @@
+import json
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgspec
+
+from utils import ChatRequestV1
+
+# Which store keeps conversation history server-side: "memory", "sqlite" or "none".
+THREAD_STORE = os.environ.get("THREAD_STORE", "memory")
+THREAD_STORE_PATH = os.environ.get("THREAD_STORE_PATH", "threads.db")
+THREAD_STORE_MAX_THREADS = int(os.environ.get("THREAD_STORE_MAX_THREADS", "10000"))
+
+
+class HistoryVersionConflict(Exception):
+    """Raised when the client's history version does not match the stored thread."""
+
+    def __init__(self, current_version: int):
+        super().__init__(f"History version conflict, server is at version {current_version}")
+        self.current_version = current_version
+
+
+class ThreadStore(ABC):
+    """
+    Server-side conversation history keyed by tenant and thread.
+
+    Each thread is an append-only list of pastMessages entries
+    ({"userMsg": ...} / {"agentResponse": ...}). Its version is the number of
+    entries stored, so a client that sends its last known version can be told
+    exactly which entries it is missing.
+    """
+
+    @abstractmethod
+    def get(self, tenant_id: str, thread_id: str) -> Tuple[int, List[Dict[str, Any]]]:
+        """
+        Return (version, messages) for a thread. Unknown threads are at version 0.
+        """
+
+    @abstractmethod
+    def append(
+            self,
+            tenant_id: str,
+            thread_id: str,
+            messages: List[Dict[str, Any]],
+            expected_version: Optional[int] = None,
+            ) -> int:
+        """
+        Append entries to a thread and return its new version.
+
+        Raises:
+            HistoryVersionConflict: If expected_version is given and the thread is at another version
+        """
+
+    @abstractmethod
+    def replace(self, tenant_id: str, thread_id: str, messages: List[Dict[str, Any]], expected_version: int) -> int:
+        """
+        Replace a thread's entries, if it is still at expected_version, and return its new version.
+
+        Raises:
+            HistoryVersionConflict: If the thread is at another version
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class InMemoryThreadStore(ThreadStore):
+    """
+    Process-local store that evicts the least recently used thread when full.
+    """
+
+    def __init__(self, max_threads: int = THREAD_STORE_MAX_THREADS):
+        self.max_threads = max_threads
+        self._threads: "OrderedDict[Tuple[str, str], List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id: str, thread_id: str) -> Tuple[int, List[Dict[str, Any]]]:
+        key = (tenant_id, thread_id)
+        with self._lock:
+            messages = self._threads.get(key)
+            if messages is None:
+                return 0, []
+            self._threads.move_to_end(key)
+            return len(messages), list(messages)
+
+    def append(
+            self,
+            tenant_id: str,
+            thread_id: str,
+            messages: List[Dict[str, Any]],
+            expected_version: Optional[int] = None,
+            ) -> int:
+        key = (tenant_id, thread_id)
+        with self._lock:
+            stored = self._threads.get(key, [])
+            if expected_version is not None and len(stored) != expected_version:
+                raise HistoryVersionConflict(len(stored))
+            self._store(key, stored + list(messages))
+            return len(stored) + len(messages)
+
+    def replace(self, tenant_id: str, thread_id: str, messages: List[Dict[str, Any]], expected_version: int) -> int:
+        key = (tenant_id, thread_id)
+        with self._lock:
+            version = len(self._threads.get(key, []))
+            if version != expected_version:
+                raise HistoryVersionConflict(version)
+            self._store(key, list(messages))
+            return len(messages)
+
+    def _store(self, key: Tuple[str, str], messages: List[Dict[str, Any]]) -> None:
+        self._threads[key] = messages
+        self._threads.move_to_end(key)
+        while len(self._threads) > self.max_threads:
+            self._threads.popitem(last=False)
+
+
+class SQLiteThreadStore(ThreadStore):
+    """
+    Store backed by a SQLite file, so history survives restarts and can be
+    shared by all workers on a node.
+    """
+
+    def __init__(self, path: str = THREAD_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS thread_messages ("
+            " tenant_id TEXT NOT NULL,"
+            " thread_id TEXT NOT NULL,"
+            " seq INTEGER NOT NULL,"
+            " message TEXT NOT NULL,"
+            " PRIMARY KEY (tenant_id, thread_id, seq))"
+        )
+
+    def get(self, tenant_id: str, thread_id: str) -> Tuple[int, List[Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT message FROM thread_messages WHERE tenant_id = ? AND thread_id = ? ORDER BY seq",
+                (tenant_id, thread_id),
+            ).fetchall()
+        return len(rows), [json.loads(row[0]) for row in rows]
+
+    def append(
+            self,
+            tenant_id: str,
+            thread_id: str,
+            messages: List[Dict[str, Any]],
+            expected_version: Optional[int] = None,
+            ) -> int:
+        return self._write(tenant_id, thread_id, messages, expected_version, replace=False)
+
+    def replace(self, tenant_id: str, thread_id: str, messages: List[Dict[str, Any]], expected_version: int) -> int:
+        return self._write(tenant_id, thread_id, messages, expected_version, replace=True)
+
+    def _write(
+            self,
+            tenant_id: str,
+            thread_id: str,
+            messages: List[Dict[str, Any]],
+            expected_version: Optional[int],
+            replace: bool,
+            ) -> int:
+        with self._lock:
+            # The version check and the write share one transaction, which
+            # other workers on the same file cannot interleave with
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                (version,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM thread_messages WHERE tenant_id = ? AND thread_id = ?",
+                    (tenant_id, thread_id),
+                ).fetchone()
+                if expected_version is not None and version != expected_version:
+                    raise HistoryVersionConflict(version)
+                if replace:
+                    self._conn.execute(
+                        "DELETE FROM thread_messages WHERE tenant_id = ? AND thread_id = ?",
+                        (tenant_id, thread_id),
+                    )
+                    version = 0
+                self._conn.executemany(
+                    "INSERT INTO thread_messages (tenant_id, thread_id, seq, message) VALUES (?, ?, ?, ?)",
+                    [
+                        (tenant_id, thread_id, version + i, json.dumps(message))
+                        for i, message in enumerate(messages)
+                    ],
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return version + len(messages)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_thread_store(kind: str = THREAD_STORE) -> Optional[ThreadStore]:
+    """
+    Build the configured thread store, or None when server-side history is disabled.
+    """
+    if kind == "memory":
+        return InMemoryThreadStore()
+    if kind == "sqlite":
+        return SQLiteThreadStore()
+    return None
+
+
+def uses_server_history(payload: ChatRequestV1) -> bool:
+    """
+    Whether this request opted in to server-side history.
+
+    Clients opt in by sending a history_version together with a thread_id, and
+    only while the agent manages the conversation memory.
+    """
+    return (
+        payload.history_version is not None
+        and bool(payload.thread_id)
+        and payload.agent_managed_memory is not False
+    )
+
+
+def load_history(store: ThreadStore, payload: ChatRequestV1) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Resolve the full history for a server-side thread.
+
+    If the client is at the stored version its history comes from the store.
+    A client that is ahead of the store (for example after the thread was
+    evicted, or was last written on another worker) may resend its full
+    pastMessages list, with history_version equal to its length, which then
+    replaces the stored thread.
+
+    Args:
+        store: The thread store
+        payload: The decoded request
+
+    Returns:
+        (version, messages) for the thread
+
+    Raises:
+        HistoryVersionConflict: If the versions differ and no full history was sent
+    """
+    tenant_id = payload.tenant_id or ""
+    thread_id = payload.thread_id
+    client_version = payload.history_version
+
+    version, messages = store.get(tenant_id, thread_id)
+    if client_version == version:
+        return version, messages
+
+    # Only a client that is out of step pays for decoding the history it sent
+    past_messages = msgspec.json.decode(payload.pastMessages)
+    if past_messages and len(past_messages) == client_version and client_version > version:
+        version = store.replace(tenant_id, thread_id, past_messages, expected_version=version)
+        return version, list(past_messages)
+
+    raise HistoryVersionConflict(version)
+
+
+def record_turn(
+        store: ThreadStore,
+        payload: ChatRequestV1,
+        user_content: str,
+        agent_content: str,
+        ) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    Append one user/agent exchange to a server-side thread, if the thread is
+    still at the version the turn was based on.
+
+    Returns:
+        (new version, the appended entries) so the response can carry only the delta
+
+    Raises:
+        HistoryVersionConflict: If another turn was recorded on the thread in the meantime
+    """
+    delta = [
+        {"userMsg": {"content": user_content}},
+        {"agentResponse": {"content": agent_content}},
+    ]
+    # load_history succeeded, so the turn was based on the client's version
+    version = store.append(payload.tenant_id or "", payload.thread_id, delta, expected_version=payload.history_version)
+    return version, delta
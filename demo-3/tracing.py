@@ -0,0 +1,103 @@
+import os
+import time
+from typing import Any, Dict
+
+from opentelemetry import trace
+
+from metrics import chat_stage_seconds, http_request_seconds
+
+# Export OpenTelemetry traces of each request and its pipeline stages (and
+# the spans Strands records for agent and model calls) over OTLP, configured
+# by the standard OTEL_EXPORTER_OTLP_* variables. Stage timings are always
+# recorded as histograms for /metrics.
+CHAT_TRACING = os.environ.get("CHAT_TRACING", "false").lower() in ("1", "true", "yes")
+
+_tracer = trace.get_tracer("aws-workshop-api")
+
+
+def configure_tracing(enabled: bool = CHAT_TRACING) -> None:
+    """
+    Install the Strands tracer provider with an OTLP exporter when tracing is enabled.
+
+    Requires the opentelemetry-exporter-otlp package.
+    """
+    if not enabled:
+        return
+    from strands.telemetry import StrandsTelemetry
+
+    StrandsTelemetry().setup_otlp_exporter()
+
+
+def annotate(attributes: Dict[str, Any]) -> None:
+    """Set attributes on the current span; a no-op when tracing is disabled."""
+    trace.get_current_span().set_attributes(attributes)
+
+
+class stage:
+    """
+    Time one stage of the chat pipeline into chat_stage_seconds and, when
+    tracing is enabled, record it as a span of the current request.
+
+    Used as a context manager that yields the span, for attributes such as
+    token counts; a non-recording span when tracing is disabled. A class
+    rather than @contextmanager, which costs a generator per stage.
+    """
+
+    __slots__ = ("name", "enabled", "_start", "_span")
+
+    def __init__(self, name: str, enabled: bool = CHAT_TRACING):
+        self.name = name
+        self.enabled = enabled
+
+    def __enter__(self) -> Any:
+        self._start = time.perf_counter()
+        if not self.enabled:
+            return trace.INVALID_SPAN
+        self._span = _tracer.start_as_current_span(f"chat.{self.name}")
+        return self._span.__enter__()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        try:
+            if self.enabled:
+                self._span.__exit__(*exc_info)
+        finally:
+            chat_stage_seconds.observe(time.perf_counter() - self._start, self.name)
+
+
+def _route(scope: dict) -> str:
+    # Route templates keep the label set bounded (/executions/{execution_id})
+    return getattr(scope.get("route"), "path", "unmatched")
+
+
+class RequestTimingMiddleware:
+    """
+    ASGI middleware that times every HTTP request into http_request_seconds,
+    by route template, and opens the request's root span when tracing is
+    enabled and the framework has not opened one.
+
+    Plain ASGI rather than BaseHTTPMiddleware, which would add a task and a
+    memory stream to every request.
+    """
+
+    def __init__(self, app: Any, enabled: bool = CHAT_TRACING):
+        self.app = app
+        self.enabled = enabled
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        try:
+            # Newer FastAPI releases open the server span themselves
+            if self.enabled and not trace.get_current_span().is_recording():
+                with _tracer.start_as_current_span(scope["method"], kind=trace.SpanKind.SERVER) as span:
+                    try:
+                        await self.app(scope, receive, send)
+                    finally:
+                        span.update_name(f"{scope['method']} {_route(scope)}")
+            else:
+                await self.app(scope, receive, send)
+        finally:
+            http_request_seconds.observe(time.perf_counter() - start, _route(scope))
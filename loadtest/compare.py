@@ -0,0 +1,91 @@
+"""
+Compare two load test results written by run.py.
+
+Matches the rate steps of both runs and prints each metric side by side with
+the relative change. Exits with status 1 if any watched metric of the new run
+is worse than the baseline by more than the tolerance, so it can gate a change.
+
+Usage:
+    python compare.py results/baseline.json results/candidate.json [--tolerance 0.10]
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+# (path in a step, whether higher is better)
+WATCHED = [
+    (("throughput",), True),
+    (("error_rate",), False),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("event_loop_lag_ms", "p99"), False),
+    (("rss_mb", "peak"), False),
+]
+# Differences below these are noise, whatever their relative size
+ABSOLUTE_SLACK = {"error_rate": 0.005, "latency_ms": 5.0, "event_loop_lag_ms": 5.0, "rss_mb": 5.0, "throughput": 0.1}
+CONFIG_KEYS = ("demo", "scenario", "duration_s", "workers", "seed", "bedrock", "env")
+
+
+def lookup(step: Dict[str, Any], path: Tuple[str, ...]) -> float:
+    value: Any = step
+    for key in path:
+        value = value.get(key, 0.0)
+    return float(value)
+
+
+def regressed(path: Tuple[str, ...], higher_is_better: bool, old: float, new: float, tolerance: float) -> bool:
+    change = new - old if not higher_is_better else old - new
+    return change > ABSOLUTE_SLACK[path[0]] and change > abs(old) * tolerance
+
+
+def compare(baseline: Dict[str, Any], candidate: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Print the comparison and return the regressions found.
+    """
+    for key in CONFIG_KEYS:
+        if baseline["config"].get(key) != candidate["config"].get(key):
+            print(f"[COMPARE] Warning: {key} differs: {baseline['config'].get(key)} vs {candidate['config'].get(key)}")
+
+    regressions = []
+    steps = {step["rate"]: step for step in candidate["steps"]}
+    for old_step in baseline["steps"]:
+        new_step: Optional[Dict[str, Any]] = steps.get(old_step["rate"])
+        if new_step is None:
+            continue
+        print(f"\n{old_step['rate']} req/s")
+        for path, higher_is_better in WATCHED:
+            old, new = lookup(old_step, path), lookup(new_step, path)
+            change = f"{(new - old) / old:+.1%}" if old else "n/a"
+            flag = ""
+            if regressed(path, higher_is_better, old, new, tolerance):
+                flag = "  REGRESSION"
+                regressions.append(f"{old_step['rate']} req/s {'.'.join(path)}: {old} -> {new}")
+            print(f"  {'.'.join(path):<24} {old:>10.2f} {new:>10.2f} {change:>8}{flag}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    print(f"[COMPARE] {baseline['git'].get('commit', '')[:8]} -> {candidate['git'].get('commit', '')[:8]}")
+    regressions = compare(baseline, candidate, args.tolerance)
+    if regressions:
+        print(f"\n[COMPARE] {len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\n[COMPARE] No regressions")
+
+
+if __name__ == "__main__":
+    main()
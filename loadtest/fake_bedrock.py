@@ -0,0 +1,218 @@
+"""
+Stand-in for the Bedrock runtime API, for load tests.
+
+Answers Converse, ConverseStream and CountTokens for any model id the way
+bedrock-runtime does (JSON bodies, AWS event-stream framing for streams), so
+the demo apps run unchanged with BEDROCK_ENDPOINT_URL pointing here. Replies
+are JSON in the shape the demo-3 system prompt asks for.
+
+Latency, token rate and failures are configurable: each call waits for the
+time to first token, then streams tokens at the given rate, and a share of
+calls fails with ThrottlingException (as a throttled account would) or
+ModelStreamErrorException mid-stream.
+
+Usage:
+    python fake_bedrock.py [--port 8100] [--latency-ms 400] [--tokens-per-second 60]
+                           [--output-tokens 120] [--failure-rate 0.0] [--seed 0]
+"""
+import argparse
+import asyncio
+import binascii
+import json
+import random
+import struct
+import time
+from typing import AsyncIterator, Dict, List
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Words the fake model's replies are made of
+VOCABULARY = (
+    "the deployment uses a load balancer in front of two services and the database runs in a private "
+    "subnet so check the security group rules the pod logs and the recent rollout history before you "
+    "scale the node group or change the ingress annotations"
+).split()
+# Fraction of failures that happen mid-stream rather than before the reply starts
+MID_STREAM_FAILURE_SHARE = 0.25
+# Longest pause between stream chunks; faster token rates send several tokens per chunk
+MAX_CHUNK_INTERVAL = 0.05
+
+
+def encode_message(headers: Dict[str, str], payload: Dict) -> bytes:
+    """
+    Frame one message in the AWS event-stream encoding: a prelude with the
+    total and header lengths and its CRC32, string headers, the JSON payload
+    and a CRC32 of the whole message.
+    """
+    encoded_headers = b""
+    for name, value in headers.items():
+        encoded_name, encoded_value = name.encode(), value.encode()
+        # Header value type 7 is a string with a 2-byte length
+        encoded_headers += struct.pack(">B", len(encoded_name)) + encoded_name
+        encoded_headers += struct.pack(">BH", 7, len(encoded_value)) + encoded_value
+    body = json.dumps(payload).encode()
+    prelude = struct.pack(">II", 16 + len(encoded_headers) + len(body), len(encoded_headers))
+    message = prelude + struct.pack(">I", binascii.crc32(prelude)) + encoded_headers + body
+    return message + struct.pack(">I", binascii.crc32(message))
+
+
+def encode_event(event_type: str, payload: Dict) -> bytes:
+    return encode_message(
+        {":event-type": event_type, ":content-type": "application/json", ":message-type": "event"}, payload
+    )
+
+
+def encode_exception(exception_type: str, message: str) -> bytes:
+    return encode_message(
+        {":exception-type": exception_type, ":content-type": "application/json", ":message-type": "exception"},
+        {"message": message},
+    )
+
+
+def count_input_tokens(body: Dict) -> int:
+    # Same 4 characters per token estimate the app uses for its history budget
+    return max(1, len(json.dumps(body.get("messages", [])) + json.dumps(body.get("system", []))) // 4)
+
+
+class FakeBedrock:
+    """
+    The fake model and its counters.
+    """
+
+    def __init__(self, latency: float, tokens_per_second: float, output_tokens: int,
+                 failure_rate: float, seed: int = 0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.stats = {"calls": 0, "streams": 0, "throttled": 0, "stream_errors": 0, "input_tokens": 0, "output_tokens": 0}
+
+    def reply_tokens(self) -> List[str]:
+        """
+        A reply in the JSON shape the demo system prompt asks for, as a list of
+        roughly token-sized pieces.
+        """
+        # Words average about 1.5 tokens; the JSON around them takes about 20
+        words = [self.random.choice(VOCABULARY) for _ in range(max(1, (self.output_tokens - 20) * 2 // 3))]
+        reply = json.dumps({
+            "content": " ".join(words).capitalize() + ".",
+            "data": {"cmds": [{"command": "kubectl get pods -n default", "execute": False}]},
+        })
+        return [reply[i:i + 4] for i in range(0, len(reply), 4)]
+
+    def usage(self, body: Dict, output_tokens: int) -> Dict:
+        input_tokens = count_input_tokens(body)
+        self.stats["input_tokens"] += input_tokens
+        self.stats["output_tokens"] += output_tokens
+        return {"inputTokens": input_tokens, "outputTokens": output_tokens, "totalTokens": input_tokens + output_tokens}
+
+    def failure(self, streaming: bool) -> str:
+        """
+        Decide whether this call fails: "" for success, "throttled" before the
+        reply starts, or "stream" part-way through a streamed reply.
+        """
+        if self.random.random() >= self.failure_rate:
+            return ""
+        if streaming and self.random.random() < MID_STREAM_FAILURE_SHARE:
+            self.stats["stream_errors"] += 1
+            return "stream"
+        self.stats["throttled"] += 1
+        return "throttled"
+
+    async def converse(self, request: Request) -> Response:
+        body = await request.json()
+        self.stats["calls"] += 1
+        await asyncio.sleep(self.latency)
+        if self.failure(streaming=False):
+            return throttling_error()
+        tokens = self.reply_tokens()
+        await asyncio.sleep(len(tokens) / self.tokens_per_second)
+        return JSONResponse({
+            "output": {"message": {"role": "assistant", "content": [{"text": "".join(tokens)}]}},
+            "stopReason": "end_turn",
+            "usage": self.usage(body, len(tokens)),
+            "metrics": {"latencyMs": int(self.latency * 1000)},
+        })
+
+    async def converse_stream(self, request: Request) -> Response:
+        body = await request.json()
+        self.stats["calls"] += 1
+        self.stats["streams"] += 1
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        failure = self.failure(streaming=True)
+        if failure == "throttled":
+            return throttling_error()
+        return StreamingResponse(
+            self.events(body, start, fail=failure == "stream"), media_type="application/vnd.amazon.eventstream"
+        )
+
+    async def events(self, body: Dict, start: float, fail: bool = False) -> AsyncIterator[bytes]:
+        tokens = self.reply_tokens()
+        per_chunk = max(1, int(self.tokens_per_second * MAX_CHUNK_INTERVAL))
+        yield encode_event("messageStart", {"role": "assistant"})
+        for index in range(0, len(tokens), per_chunk):
+            chunk = tokens[index:index + per_chunk]
+            await asyncio.sleep(len(chunk) / self.tokens_per_second)
+            if fail and index >= len(tokens) // 2:
+                yield encode_exception("modelStreamErrorException", "Injected failure")
+                return
+            yield encode_event("contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": "".join(chunk)}})
+        yield encode_event("contentBlockStop", {"contentBlockIndex": 0})
+        yield encode_event("messageStop", {"stopReason": "end_turn"})
+        yield encode_event("metadata", {
+            "usage": self.usage(body, len(tokens)),
+            "metrics": {"latencyMs": int((time.perf_counter() - start) * 1000)},
+        })
+
+    async def count_tokens(self, request: Request) -> Response:
+        body = await request.json()
+        converse = body.get("input", {}).get("converse", {})
+        return JSONResponse({"inputTokens": count_input_tokens(converse)})
+
+    async def get_stats(self, request: Request) -> Response:
+        return JSONResponse(self.stats)
+
+
+def throttling_error() -> Response:
+    return JSONResponse(
+        {"message": "Too many requests, please wait before trying again."},
+        status_code=429,
+        headers={"x-amzn-ErrorType": "ThrottlingException"},
+    )
+
+
+def create_app(fake: FakeBedrock) -> Starlette:
+    return Starlette(routes=[
+        Route("/model/{model_id:path}/converse-stream", fake.converse_stream, methods=["POST"]),
+        Route("/model/{model_id:path}/converse", fake.converse, methods=["POST"]),
+        Route("/model/{model_id:path}/count-tokens", fake.count_tokens, methods=["POST"]),
+        Route("/stats", fake.get_stats),
+    ])
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency-ms", type=float, default=400, help="time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60, help="output token rate")
+    parser.add_argument("--output-tokens", type=int, default=120, help="approximate reply length")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of calls that fail")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    fake = FakeBedrock(args.latency_ms / 1000, args.tokens_per_second, args.output_tokens, args.failure_rate, args.seed)
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+
+if __name__ == "__main__":
+    main()
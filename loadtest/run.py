@@ -0,0 +1,467 @@
+"""
+Load test for the demo apps.
+
+Starts a demo app (through its serve.py) against the fake Bedrock server in
+this directory, drives POST /chat at one or more fixed request rates with
+generated v1 payloads, and writes the results as JSON so that runs on
+different commits can be compared with compare.py.
+
+Requests are sent open-loop: each one leaves at its scheduled time whether or
+not earlier ones have finished, and its latency is measured from that time,
+so a server that falls behind shows up as growing latency instead of a lower
+send rate. Per rate step it reports throughput, latency percentiles, errors,
+the event-loop lag of the server (the latency of /health probes sent
+alongside the load, which queue behind any blocking work on the loop), the
+lag of the load generator itself, and the server's RSS.
+
+Scenarios:
+    chat      short prompts with a short history
+    history   long pastMessages, as in a conversation dozens of turns in
+    commands  several Cmds to execute, each with small files
+    files     Cmds with large file bodies
+    mixed     a weighted mix of the above
+
+Usage:
+    python run.py --demo demo-3 [--rates 2 5 10] [--duration 30] [--scenario mixed]
+                  [--latency-ms 400] [--tokens-per-second 60] [--failure-rate 0.0]
+                  [--workers 1] [--env KEY=VALUE ...] [--output results/run.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+RESULTS_DIR = os.path.join(HERE, "results")
+RESULTS_VERSION = 1
+
+# Interval between /health probes and RSS samples
+PROBE_INTERVAL = 0.1
+# How often the load generator checks its own event loop
+DRIVER_TICK = 0.01
+STARTUP_TIMEOUT = 60
+REQUEST_TIMEOUT = 120
+
+TOPICS = (
+    "why is my ECS service failing its health checks after the last deploy",
+    "list the pods in the default namespace that restarted in the last hour",
+    "how do I rotate the credentials of the RDS instance without downtime",
+    "show the S3 buckets in this tenant that are publicly readable",
+    "what changed in the load balancer listeners since yesterday",
+    "scale the web deployment to four replicas and tell me how to verify it",
+    "explain the difference between a security group and a network ACL",
+    "why does terraform want to replace the node group on every plan",
+)
+ANSWER = (
+    "Check the target group health check path and port first, then compare the task definition revision "
+    "with the previous one. The service events usually show whether tasks fail to start or fail the check. "
+)
+FILE_LINE = "key: value  # generated configuration line for load testing purposes\n"
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    return {
+        "p50": round(percentile(values, 0.50) * 1000, 2),
+        "p95": round(percentile(values, 0.95) * 1000, 2),
+        "p99": round(percentile(values, 0.99) * 1000, 2),
+        "max": round(max(values, default=0.0) * 1000, 2),
+        "mean": round(statistics.fmean(values) * 1000, 2) if values else 0.0,
+    }
+
+
+class PayloadFactory:
+    """
+    Generate v1 /chat payloads for a scenario from a seeded random source, so
+    that runs with the same seed send the same requests.
+
+    Args:
+        history_turns: Turns of pastMessages in the history scenario
+        commands: Cmds per request in the commands and files scenarios
+        file_kb: Size of each file body in the files scenario
+        prompt_pool: Distinct prompts to draw from; 0 makes every prompt unique,
+            so response caches do not skew the results
+    """
+
+    def __init__(self, seed: int = 0, history_turns: int = 40, commands: int = 4, file_kb: int = 256,
+                 prompt_pool: int = 0):
+        self.random = random.Random(seed)
+        self.history_turns = history_turns
+        self.commands = commands
+        self.file_kb = file_kb
+        self.prompt_pool = prompt_pool
+        self.count = 0
+
+    def prompt(self) -> str:
+        self.count += 1
+        number = self.random.randrange(self.prompt_pool) if self.prompt_pool else self.count
+        return f"{TOPICS[number % len(TOPICS)]} (request {number})"
+
+    def history(self, turns: int) -> List[Dict[str, Any]]:
+        messages = []
+        for turn in range(turns):
+            messages.append({"userMsg": {"content": f"{self.random.choice(TOPICS)} (turn {turn})"}})
+            messages.append({"agentResponse": {"content": ANSWER * self.random.randint(1, 4)}})
+        return messages
+
+    def request(self, content: str, past_messages: List[Dict[str, Any]], cmds: Optional[List[Dict]] = None) -> Dict:
+        payload = {
+            "content": content,
+            "pastMessages": past_messages,
+            "thread_id": f"load-{self.count % 100}",
+            "tenant_id": "load-test",
+            # Send the history explicitly rather than relying on server-side threads
+            "agent_managed_memory": False,
+        }
+        if cmds:
+            payload["data"] = {"Cmds": cmds}
+        return payload
+
+    def chat(self) -> Dict:
+        return self.request(self.prompt(), self.history(2))
+
+    def long_history(self) -> Dict:
+        return self.request(self.prompt(), self.history(self.history_turns))
+
+    def commands_request(self, file_bytes: int) -> Dict:
+        cmds = []
+        for index in range(self.commands):
+            path = f"config/app-{index}.yaml"
+            content = FILE_LINE * max(1, file_bytes // len(FILE_LINE))
+            cmds.append({
+                "Command": f"wc -l {path} && echo checked {index}",
+                "execute": True,
+                "files": [{"file_path": path, "file_content": content}],
+            })
+        return self.request("run these", self.history(2), cmds)
+
+    def commands_scenario(self) -> Dict:
+        return self.commands_request(512)
+
+    def files(self) -> Dict:
+        return self.commands_request(self.file_kb * 1024)
+
+    def mixed(self) -> Dict:
+        return self.random.choices(
+            [self.chat, self.long_history, self.commands_scenario, self.files], weights=[5, 3, 1, 1]
+        )[0]()
+
+    def for_scenario(self, scenario: str) -> Callable[[], Dict]:
+        return {
+            "chat": self.chat,
+            "history": self.long_history,
+            "commands": self.commands_scenario,
+            "files": self.files,
+            "mixed": self.mixed,
+        }[scenario]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree_rss(pid: int) -> int:
+    """Resident memory of a process and all its descendants (uvicorn workers), in bytes."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def git_revision() -> Dict[str, Any]:
+    def git(*args: str) -> str:
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ""
+
+    return {"commit": git("rev-parse", "HEAD"), "subject": git("log", "-1", "--format=%s"),
+            "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def start_process(args: List[str], cwd: str, env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    log = open(log_path, "w")
+    return subprocess.Popen([sys.executable, *args], cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=35)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def wait_until_healthy(client: httpx.AsyncClient, url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode} during startup")
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not become healthy within {STARTUP_TIMEOUT}s")
+
+
+class Step:
+    """Measurements of one rate step."""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.health: List[float] = []
+        self.driver_lag: List[float] = []
+        self.rss: List[int] = []
+        self.sent = 0
+        self.bytes_sent = 0
+        self.elapsed = 0.0
+
+
+async def send(client: httpx.AsyncClient, url: str, body: bytes, scheduled: float, step: Step) -> None:
+    try:
+        response = await client.post(url, content=body, headers={"Content-Type": "application/json"})
+        status = str(response.status_code)
+    except httpx.TimeoutException:
+        status = "timeout"
+    except httpx.TransportError as e:
+        status = type(e).__name__
+    step.statuses[status] = step.statuses.get(status, 0) + 1
+    if status == "200":
+        step.latencies.append(time.perf_counter() - scheduled)
+
+
+async def probe(client: httpx.AsyncClient, url: str, pid: int, step: Step, stop: asyncio.Event) -> None:
+    # Probes run one at a time, so a slow one is not hidden behind the next
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            await client.get(url)
+            step.health.append(time.perf_counter() - start)
+        except httpx.TransportError:
+            pass
+        step.rss.append(process_tree_rss(pid))
+        await asyncio.sleep(max(0.0, PROBE_INTERVAL - (time.perf_counter() - start)))
+
+
+async def watch_driver(step: Step, stop: asyncio.Event) -> None:
+    # If the load generator itself lags, requests leave late and the results understate latency
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(DRIVER_TICK)
+        step.driver_lag.append(max(0.0, time.perf_counter() - start - DRIVER_TICK))
+
+
+async def run_step(
+        base_url: str,
+        pid: int,
+        rate: float,
+        duration: float,
+        next_payload: Callable[[], Dict],
+        ) -> Step:
+    step = Step()
+    stop = asyncio.Event()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=200)
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT, limits=limits) as client, \
+            httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as probe_client:
+        watchers = [
+            asyncio.create_task(probe(probe_client, f"{base_url}/health", pid, step, stop)),
+            asyncio.create_task(watch_driver(step, stop)),
+        ]
+        # Build the payloads up front so that encoding them does not delay sending
+        bodies = [json.dumps(next_payload()).encode() for _ in range(max(1, int(rate * duration)))]
+        requests = []
+        start = time.perf_counter()
+        for index, body in enumerate(bodies):
+            scheduled = start + index / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            requests.append(asyncio.create_task(send(client, f"{base_url}/chat", body, scheduled, step)))
+            step.sent += 1
+            step.bytes_sent += len(body)
+        await asyncio.gather(*requests)
+        step.elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*watchers)
+    return step
+
+
+def step_result(rate: float, step: Step, bedrock: Dict[str, int]) -> Dict[str, Any]:
+    ok = step.statuses.get("200", 0)
+    return {
+        "rate": rate,
+        "sent": step.sent,
+        "ok": ok,
+        "errors": {status: count for status, count in step.statuses.items() if status != "200"},
+        "error_rate": round(1 - ok / step.sent, 4) if step.sent else 0.0,
+        "throughput": round(ok / step.elapsed, 2),
+        "elapsed_s": round(step.elapsed, 2),
+        "request_kb_mean": round(step.bytes_sent / max(1, step.sent) / 1024, 1),
+        "latency_ms": summarize(step.latencies),
+        "event_loop_lag_ms": summarize(step.health),
+        "driver_lag_ms": summarize(step.driver_lag),
+        "rss_mb": {
+            "start": round(step.rss[0] / 2 ** 20, 1) if step.rss else 0.0,
+            "peak": round(max(step.rss, default=0) / 2 ** 20, 1),
+            "end": round(step.rss[-1] / 2 ** 20, 1) if step.rss else 0.0,
+        },
+        "bedrock": bedrock,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    demo_dir = os.path.join(ROOT, args.demo)
+    app_port, bedrock_port = free_port(), free_port()
+    base_url = f"http://127.0.0.1:{app_port}"
+    bedrock_url = f"http://127.0.0.1:{bedrock_port}"
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    env = dict(os.environ)
+    env.update({
+        "BEDROCK_ENDPOINT_URL": bedrock_url,
+        "BEDROCK_PROFILE": "",
+        "BEDROCK_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "load-test",
+        "AWS_SECRET_ACCESS_KEY": "load-test",
+        "AWS_EC2_METADATA_DISABLED": "true",
+        "LOG_LEVEL": "WARNING",
+    })
+    env.update(dict(item.split("=", 1) for item in args.env))
+
+    bedrock = start_process(
+        ["fake_bedrock.py", "--port", str(bedrock_port), "--latency-ms", str(args.latency_ms),
+         "--tokens-per-second", str(args.tokens_per_second), "--output-tokens", str(args.output_tokens),
+         "--failure-rate", str(args.failure_rate), "--seed", str(args.seed)],
+        HERE, env, os.path.join(RESULTS_DIR, "fake_bedrock.log"),
+    )
+    app = start_process(
+        ["serve.py", "--host", "127.0.0.1", "--port", str(app_port), "--workers", str(args.workers)],
+        demo_dir, env, os.path.join(RESULTS_DIR, f"{args.demo}.log"),
+    )
+    payloads = PayloadFactory(args.seed, args.history_turns, args.commands, args.file_kb, args.prompt_pool)
+    next_payload = payloads.for_scenario(args.scenario)
+    steps = []
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            await wait_until_healthy(client, f"{bedrock_url}/stats", bedrock)
+            await wait_until_healthy(client, f"{base_url}/health", app)
+            if args.warmup > 0:
+                print(f"[LOAD] Warming up for {args.warmup}s at {args.rates[0]} req/s")
+                await run_step(base_url, app.pid, args.rates[0], args.warmup, next_payload)
+            for rate in args.rates:
+                before = (await client.get(f"{bedrock_url}/stats")).json()
+                print(f"[LOAD] {args.demo} {args.scenario}: {rate} req/s for {args.duration}s")
+                step = await run_step(base_url, app.pid, rate, args.duration, next_payload)
+                after = (await client.get(f"{bedrock_url}/stats")).json()
+                result = step_result(rate, step, {key: after[key] - before[key] for key in after})
+                latency = result["latency_ms"]
+                print(f"[LOAD]   {result['throughput']} req/s ok, errors {result['errors'] or 'none'}, "
+                      f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, p99 {latency['p99']} ms, "
+                      f"loop lag p99 {result['event_loop_lag_ms']['p99']} ms, RSS peak {result['rss_mb']['peak']} MB")
+                steps.append(result)
+    finally:
+        stop_process(app)
+        stop_process(bedrock)
+
+    return {
+        "version": RESULTS_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git": git_revision(),
+        "config": {
+            "demo": args.demo,
+            "scenario": args.scenario,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "workers": args.workers,
+            "seed": args.seed,
+            "history_turns": args.history_turns,
+            "commands": args.commands,
+            "file_kb": args.file_kb,
+            "prompt_pool": args.prompt_pool,
+            "env": args.env,
+            "bedrock": {
+                "latency_ms": args.latency_ms,
+                "tokens_per_second": args.tokens_per_second,
+                "output_tokens": args.output_tokens,
+                "failure_rate": args.failure_rate,
+            },
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+        },
+        "steps": steps,
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--demo", default="demo-3", choices=["demo-1", "demo-2", "demo-3"])
+    parser.add_argument("--scenario", default="mixed", choices=["chat", "history", "commands", "files", "mixed"])
+    parser.add_argument("--rates", type=float, nargs="+", default=[2, 5, 10], help="requests per second, one step each")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per rate step")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds of load before the first step")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--latency-ms", type=float, default=400, help="fake Bedrock time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=60, help="fake Bedrock output token rate")
+    parser.add_argument("--output-tokens", type=int, default=120, help="fake Bedrock reply length")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of fake Bedrock calls that fail")
+    parser.add_argument("--history-turns", type=int, default=40)
+    parser.add_argument("--commands", type=int, default=4, help="Cmds per command request")
+    parser.add_argument("--file-kb", type=int, default=256, help="file body size in the files scenario")
+    parser.add_argument("--prompt-pool", type=int, default=0, help="distinct prompts (0: all unique)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE", help="extra server environment")
+    parser.add_argument("--output", help="results file (default: results/<demo>-<scenario>-<commit>-<time>.json)")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    output = args.output or os.path.join(
+        RESULTS_DIR,
+        f"{args.demo}-{args.scenario}-{results['git']['commit'][:8] or 'nogit'}-"
+        f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json",
+    )
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[LOAD] Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()